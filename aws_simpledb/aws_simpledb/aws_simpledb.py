@@ -5,13 +5,20 @@ import hmac
 import base64
 import datetime
 import httplib
+import os
 import socket
-from time import sleep
+import select
+import threading
 from collections import defaultdict
 from orderedset import OrderedSet
 
 import settings
 import status
+import deadlines
+from deadlines import deadline, DeadlineExceeded
+from breaker import CircuitOpen, shared_breaker
+from coalescing import SingleFlight
+from hedging import HedgingPolicy, AttemptPool, run_hedged
 
 try:
     import xml.etree.ElementTree as ET
@@ -19,8 +26,31 @@ except ImportError:
     import elementtree.ElementTree as ET
 
 class SimpleDBError(Exception):
-    """We use this exception to represent errors returned by simpledb"""
-    pass
+    """We use this exception to represent errors returned by simpledb.
+
+    code is simpledb's error code and status the response's HTTP status (None
+    for errors raised before a request was made).
+
+    """
+
+    # Error codes of simpledb failing to serve a request, rather than of a
+    # request it rejected
+    server_error_codes = set(['ServiceUnavailable', 'InternalError'])
+
+    def __init__(self, message, code=None, status=None):
+        Exception.__init__(self, message)
+
+        self.code = code
+        self.status = status
+
+    def server_error(self):
+        """Returns whether simpledb failed to serve the request (a 5xx
+        response), as opposed to rejecting it (a 4xx client error).
+
+        """
+
+        return (self.status is not None and self.status >= 500) or \
+               self.code in self.server_error_codes
 
 class SimpleDBFailure(Exception):
     """We use this exception for sdb connection failures"""
@@ -86,6 +116,12 @@ class SignatureMethod_HMAC_SHA256(SignatureMethod):
         hashed = hmac.new(aws_secret, base, hashlib.sha256)
         return base64.b64encode(hashed.digest())
 
+try:
+    import hashlib # 2.5+
+    default_signature_method = SignatureMethod_HMAC_SHA256
+except ImportError:
+    default_signature_method = SignatureMethod_HMAC_SHA1
+
 class Response(object):
     def __init__(self, response, content, request_id, usage):
         self.response = response
@@ -147,11 +183,11 @@ class SimpleDB(object):
 
     ns = 'http://sdb.amazonaws.com/doc/2009-04-15/'
     service_version = '2009-04-15'
-    try:
-        import hashlib # 2.5+
-        signature_method = SignatureMethod_HMAC_SHA256
-    except ImportError:
-        signature_method = SignatureMethod_HMAC_SHA1
+
+    # The maximum amount of items simpledb accepts in a single
+    # BatchPutAttributes or BatchDeleteAttributes request
+    max_batch_items = 25
+    signature_method = default_signature_method
 
     def __init__(self,
                  aws_access_key=None,
@@ -192,8 +228,29 @@ class SimpleDB(object):
 
         self.last_http_object_initialization = None
 
-        self.sdb_connection = \
-            httplib.HTTPSConnection(self.db, timeout=settings.amazon_timeout)
+        # Concurrent identical reads share a single request, see
+        # get_attributes()
+        self._reads = SingleFlight(lambda: status.increment('coalesced_reads'))
+
+        # Slow reads are hedged according to the recent reads latencies, see
+        # _make_read_request()
+        self._hedging = HedgingPolicy(
+                                      settings.hedge_latency_percentile,
+                                      settings.hedge_budget_ratio,
+                                      settings.hedge_latency_window,
+                                      settings.hedge_min_samples
+                                     )
+        self._hedge_pool = AttemptPool(settings.hedge_workers)
+
+        # httplib connections can't be shared by concurrent requests, so each
+        # request takes an idle connection (or opens a new one) and returns it
+        # once the response was read. The idle connections are kept as
+        # (connection, idle since) tuples, see _connection_is_alive(), up to
+        # settings.max_idle_connections of them. Connections are opened on
+        # first use (or by warmup()), no network call is made here.
+        self._idle_connections = []
+        self._connections_lock = threading.Lock()
+        self._connections_pid = os.getpid()
 
         # The following list lists simpledb request parameters that doesn't
         # relate to the request's action. We will ignore this parameters when
@@ -208,6 +265,117 @@ class SimpleDB(object):
                                               'Signature',
                                               'Action'
                                              ]
+
+    def _acquire_connection(self):
+        while True:
+            with self._connections_lock:
+                # Connections opened by a parent process can't be shared with
+                # it, we drop them (without closing, the parent still uses
+                # them)
+                if self._connections_pid != os.getpid():
+                    self._connections_pid = os.getpid()
+                    self._idle_connections = []
+
+                if not self._idle_connections:
+                    break
+
+                # The most recently used connection is the least likely to
+                # have been closed by simpledb
+                sdb_connection, idle_since = self._idle_connections.pop()
+
+            if self._connection_is_alive(sdb_connection, idle_since):
+                return sdb_connection
+
+            sdb_connection.close()
+            status.increment('dead_connections_replaced')
+
+        return httplib.HTTPSConnection(self.db, timeout=settings.amazon_timeout)
+
+    def _release_connection(self, sdb_connection):
+        excess_connection = None
+
+        with self._connections_lock:
+            if self._connections_pid != os.getpid():
+                return
+
+            self._idle_connections.append((sdb_connection, time.time()))
+
+            # A burst of concurrent requests leaves many idle connections, we
+            # keep only the most recently used ones
+            if len(self._idle_connections) > settings.max_idle_connections:
+                excess_connection, idle_since = self._idle_connections.pop(0)
+
+        if excess_connection is not None:
+            excess_connection.close()
+
+    def _connection_is_alive(self, sdb_connection, idle_since):
+        # Simpledb closes keep-alive connections that idle for a while, a
+        # request sent on such a connection fails (or times out). We don't use
+        # connections that idled for longer than settings.max_connection_idle,
+        # and connections whose socket is readable while idle (simpledb closed
+        # it, or it's in an unknown state).
+        if time.time() - idle_since > settings.max_connection_idle:
+            return False
+
+        if sdb_connection.sock is None: # not connected yet
+            return True
+
+        # poll() rather than select(), which can't watch descriptors above
+        # FD_SETSIZE (1024) and would find every connection of a busy process
+        # dead
+        poller = select.poll()
+        poller.register(sdb_connection.sock, select.POLLIN | select.POLLPRI)
+
+        try:
+            events = poller.poll(0)
+        except (select.error, socket.error):
+            return False
+
+        # Any event (readable, hung up or failed) means the connection isn't
+        # idle as it should be
+        return not events
+
+    def warmup(self, connections=None):
+        """Opens connections to simpledb ahead of the first requests (up to
+        settings.warmup_connections by default), so the requests don't pay the
+        DNS, TCP and TLS handshakes. The connections are opened concurrently,
+        and kept as idle connections of the pool.
+
+        Returns the amount of connections opened, connections that failed to
+        open are ignored.
+
+        """
+
+        if connections is None:
+            connections = settings.warmup_connections
+
+        connect_timeout = deadlines.timeout(settings.amazon_timeout)
+        opened = []
+
+        def connect():
+            sdb_connection = httplib.HTTPSConnection(self.db, timeout=connect_timeout)
+
+            try:
+                sdb_connection.connect()
+            except (socket.error, httplib.HTTPException):
+                sdb_connection.close()
+                return
+
+            opened.append(sdb_connection)
+
+        threads = [threading.Thread(target=connect) for i in range(connections)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        for sdb_connection in opened:
+            self._release_connection(sdb_connection)
+
+        return len(opened)
+
     def __make_request(self, request):
         headers = {'Content-Type': 'application/x-www-form-urlencoded; charset=utf-8', 
                    'host': self.db}
@@ -216,28 +384,49 @@ class SimpleDB(object):
 
         time_request_begin = datetime.datetime.utcnow()
 
-        self.sdb_connection.request(
-                                    request.method,
-                                    '/',
-                                    request.to_postdata(),
-                                    headers
-                                   )
+        # Computed before a connection is taken, it raises DeadlineExceeded
+        # if the deadline passed
+        request_timeout = deadlines.timeout(settings.amazon_timeout)
+
+        sdb_connection = self._acquire_connection()
+
+        # Pooled connections are reused, their timeout is set per request
+        sdb_connection.timeout = request_timeout
+        if sdb_connection.sock is not None:
+            sdb_connection.sock.settimeout(request_timeout)
+
+        try:
+            sdb_connection.request(
+                                   request.method,
+                                   '/',
+                                   request.to_postdata(),
+                                   headers
+                                  )
 
+            execution_time = datetime.datetime.utcnow() - time_request_begin
 
-        execution_time = datetime.datetime.utcnow() - time_request_begin
+            response = sdb_connection.getresponse()
 
-        response = self.sdb_connection.getresponse()
+            response_headers = dict(response.getheaders())
+            response_headers['status'] = response.status
 
-        response_headers = dict(response.getheaders())
-        response_headers['status'] = response.status
+            response_content = response.read()
+        except:
+            # The connection state is unknown, don't let other requests use it
+            sdb_connection.close()
+            raise
 
-        response_content = response.read()
+        self._release_connection(sdb_connection)
 
         e = ET.fromstring(response_content)
 
         error = e.find('Errors/Error')
         if error:
-            raise SimpleDBError(error.find('Message').text)
+            raise SimpleDBError(
+                                error.findtext('Message'),
+                                error.findtext('Code'),
+                                response.status
+                               )
 
         meta = e.find('{%s}ResponseMetadata' % self.ns)
         request_id = meta.find('{%s}RequestId' % self.ns).text
@@ -269,19 +458,120 @@ class SimpleDB(object):
         return Response(response_headers, response_content, request_id, usage)
 
     def _make_request(self, request):
+        """Makes the request (with retries, see _make_request_attempts()),
+        guarded by the circuit breakers of simpledb's endpoint and of the
+        request's domain: while one of them is open the request fails fast
+        with CircuitOpen.
+
+        Requests that failed to reach simpledb, that simpledb failed to serve
+        (see SimpleDBError.server_error()) or that were slower than
+        settings.circuit_breaker_slow_call_seconds count as failures. Client
+        errors don't (simpledb answered, the request was wrong).
+
+        """
+
+        if not settings.circuit_breaker:
+            return self._make_request_attempts(request)
+
+        breakers = self._circuit_breakers(request)
+
+        allowed = []
+        try:
+            for breaker in breakers:
+                breaker.allow()
+                allowed.append(breaker)
+        except CircuitOpen:
+            for breaker in allowed:
+                breaker.cancel()
+            raise
+
+        time_request_begin = time.time()
+
+        try:
+            response = self._make_request_attempts(request)
+        except (SimpleDBFailure, socket.error, httplib.HTTPException):
+            for breaker in breakers:
+                breaker.record(False)
+            raise
+        except SimpleDBError as error:
+            for breaker in breakers:
+                breaker.record(not error.server_error())
+            raise
+        except:
+            # e.g. the caller's deadline passed, that tells nothing about
+            # simpledb
+            for breaker in breakers:
+                breaker.cancel()
+            raise
+
+        for breaker in breakers:
+            breaker.record(True, time.time() - time_request_begin)
+
+        return response
+
+    def _circuit_breakers(self, request):
+        # The breakers of the endpoint and of the request's domain (if it has
+        # one)
+        names = [self.db]
+
+        domain = request.parameters.get('DomainName')
+        if domain is not None:
+            names.append('%s/%s' % (self.db, domain))
+
+        return [
+                shared_breaker(
+                               name,
+                               settings.circuit_breaker_failure_threshold,
+                               settings.circuit_breaker_reset_timeout,
+                               settings.circuit_breaker_slow_call_seconds
+                              ) for
+                name in names
+               ]
+
+    def _make_request_attempts(self, request):
         delay_before_attempts = [0] # lists the delay before each attempt
         delay_before_attempts.extend(settings.amazon_timeout_retries_delay)
 
+        # Neither the attempts nor the delays between them may pass the
+        # deadline in effect (see the deadlines module)
         for delay in delay_before_attempts:
             try:
-                sleep(delay)
+                deadlines.sleep(delay)
+                deadlines.check()
                 return self.__make_request(request)
             except socket.timeout as error: 
-                status.https_timeouts += 1 # keep in status timeout log
+                status.increment('https_timeouts') # keep in status timeout log
 
         # If all our attempts failed
         raise SimpleDBFailure('Timeout')
 
+    def _make_read_request(self, request):
+        """Same as _make_request(), for idempotent requests. If
+        settings.hedged_reads is set, a request that didn't answer within the
+        recent reads latency percentile is sent again on another connection,
+        and the first response is used (see the hedging module).
+
+        """
+
+        if not settings.hedged_reads:
+            return self._make_request(request)
+
+        # The request is signed when it's sent, the duplicate gets its own
+        # parameters
+        hedge_request = Request(request.method, request.url, dict(request.parameters))
+
+        response, hedged = run_hedged(
+                                      self._hedging,
+                                      self._hedge_pool,
+                                      lambda: self._make_request(request),
+                                      lambda: self._make_request(hedge_request)
+                                     )
+
+        if hedged:
+            status.increment('hedged_reads')
+
+        return response
+
     def _sdb_url(self):
         return urlparse.urlunparse((self.scheme, self.db, '', '', '', ''))
 
@@ -439,7 +729,7 @@ class SimpleDB(object):
 
                 idx += 1
 
-        status.actions_count['put_attributes'] += 1
+        status.count_action('put_attributes')
 
         request = Request("POST", self._sdb_url(), data)
         self._make_request(request)
@@ -475,7 +765,7 @@ class SimpleDB(object):
 
                     attr_id += 1
 
-        status.actions_count['put_attributes'] += 1
+        status.count_action('put_attributes')
 
         request = Request("POST", self._sdb_url(), data)
         self._make_request(request)
@@ -512,27 +802,86 @@ class SimpleDB(object):
                 idx += 1
         
         if not attributes: # if attributes is empty, this is item delete request
-            status.actions_count['delete_item'] += 1
+            status.count_action('delete_item')
         else:
-            status.actions_count['delete_attributes'] += 1
+            status.count_action('delete_attributes')
+
+        request = Request("POST", self._sdb_url(), data)
+        self._make_request(request)
+
+    def batch_delete_attributes(self, domain, items):
+        """
+        Performs multiple DeleteAttributes operations in a single call.
+
+        items should be dictionary in which the keys are items names and
+        the values are dictionaries with the structure of delete_attributes()'s
+        'attributes' parameter. An empty (or None) value deletes the entire
+        item.
+
+        Simpledb accepts up to max_batch_items items per call.
+
+        """
+
+        data = {
+            'Action': 'BatchDeleteAttributes',
+            'DomainName': domain,
+        }
+
+        for item_id, (item_name, attributes) in enumerate(items.items()):
+            data['Item.%s.ItemName' % item_id] = item_name
+
+            attr_id = 0
+            for name, values in (attributes or {}).iteritems():
+                if values: # if values isn't empty or None
+                    if not hasattr(values, '__iter__') or isinstance(values, basestring):
+                        values = [values]
+                    for value in values:
+                        data['Item.%s.Attribute.%s.Name' % (item_id, attr_id)] = name
+                        data['Item.%s.Attribute.%s.Value' % (item_id, attr_id)] = value
+                        attr_id += 1
+                else:
+                    data['Item.%s.Attribute.%s.Name' % (item_id, attr_id)] = name
+                    attr_id += 1
+
+        status.count_action('delete_attributes')
 
         request = Request("POST", self._sdb_url(), data)
         self._make_request(request)
 
-    def get_attributes(self, domain, item, attributes=None):
+    def get_attributes(self, domain, item, attributes=None, consistent_read=False):
         """
         Returns all of the attributes associated with the item.
         
         The returned attributes can be limited by passing a list of attribute
         names in the optional `attributes` argument.
 
+        If consistent_read is True, the attributes reflect all the writes that
+        were successful before the call (at a higher latency).
+
         If the item does not exist, an empty set is returned. An error is not
         raised because SimpleDB provides no guarantee that the item does not
         exist on another replica. In other words, if you fetch attributes that 
         should exist, but get an empty set, you may have better luck if you try
         again in a few hundred milliseconds.
+
+        If settings.coalesce_reads is set, concurrent calls with the same
+        arguments share a single request, each gets its own copy of the
+        result. Consistent reads are never shared, since a read already in
+        flight might miss writes that succeeded before the call.
         """
 
+        if settings.coalesce_reads and not consistent_read:
+            return self._reads.do(
+                                  (domain, item, tuple(attributes or ())),
+                                  self._get_attributes,
+                                  domain,
+                                  item,
+                                  attributes
+                                 )
+
+        return self._get_attributes(domain, item, attributes, consistent_read)
+
+    def _get_attributes(self, domain, item, attributes=None, consistent_read=False):
         data = {
             'Action': 'GetAttributes',
             'DomainName': domain,
@@ -542,11 +891,13 @@ class SimpleDB(object):
         if attributes:
             for i, attr in enumerate(attributes):
                 data['AttributeName.%s' % i] = attr
+        if consistent_read:
+            data['ConsistentRead'] = 'true'
         request = Request("POST", self._sdb_url(), data)
-        response = self._make_request(request)
+        response = self._make_read_request(request)
         
         # update status
-        status.actions_count['get_item'] += 1
+        status.count_action('get_item')
 
         # Initiate the result array
         result = defaultdict(set)
@@ -586,24 +937,36 @@ class SimpleDB(object):
 
         return attributes
 
-    def _select(self, domain, query):
+    def _select_pages(self, domain, query):
+        # Generator that yields the list of items of each of the query's result
+        # pages
         data = {
             'Action': 'Select',
             'SelectExpression': query,
         }
 
+        pages_count = 0
+
         while True:
-            status.actions_count['select'] += 1
+            # The pages read so far and the token of the next page let the
+            # caller resume the scan
+            deadlines.check(pages=pages_count, next_token=data.get('NextToken'))
+
+            status.count_action('select')
             request = Request("POST", self._sdb_url(), data)
-            response = self._make_request(request)
+            response = self._make_read_request(request)
 
             e = ET.fromstring(response.content)
             item_node = e.find('{%s}SelectResult' % self.ns)
             if item_node is not None:
+                page = []
                 for item in item_node.findall('{%s}Item' % self.ns):
                     name = item.findtext('{%s}Name' % self.ns)
                     attributes = self._parse_attributes(domain, item)
-                    yield {name: attributes}
+                    page.append({name: attributes})
+
+                yield page
+                pages_count += 1
 
                 # SimpleDB will return a max of 100 items per request, and
                 # will return a NextToken if there are more.
@@ -614,7 +977,12 @@ class SimpleDB(object):
             else:
                 break
 
-    def select(self, output_list, domain_name, expression=None, sort_instructions=None, limit=None):
+    def _select(self, domain, query):
+        for page in self._select_pages(domain, query):
+            for item in page:
+                yield item
+
+    def _select_query(self, output_list, domain_name, expression=None, sort_instructions=None, limit=None):
         # If output_list holds attribute name but isn't compound type, we
         # enclose it in a list
         if not hasattr(output_list, '__iter__') or isinstance(output_list, basestring):
@@ -635,7 +1003,40 @@ class SimpleDB(object):
         if limit is not None:
             query += ' limit ' + str(limit)
 
-        return list(self._select(domain_name, query))
+        return query
+
+    def select(self, output_list, domain_name, expression=None, sort_instructions=None, limit=None):
+        """Returns list of the items matching the query.
+
+        If the deadline in effect (see the deadlines module) passes during the
+        scan, the raised DeadlineExceeded's partial holds the items read so far
+        ('items'), the amount of pages they were read from ('pages') and the
+        NextToken of the following page ('next_token').
+
+        """
+
+        query = self._select_query(output_list, domain_name, expression, sort_instructions, limit)
+
+        items = []
+        try:
+            for item in self._select(domain_name, query):
+                items.append(item)
+        except DeadlineExceeded as error:
+            error.add_partial(items=items)
+            raise
+
+        return items
+
+    def select_pages(self, output_list, domain_name, expression=None, sort_instructions=None, limit=None):
+        """Same as select(), but returns a generator that yields the results
+        page by page (each page is a list of items, as returned by select()),
+        fetching the next page from simpledb only when it's needed.
+
+        """
+
+        query = self._select_query(output_list, domain_name, expression, sort_instructions, limit)
+
+        return self._select_pages(domain_name, query)
 
     def __iter__(self):
         return self._list_domains()
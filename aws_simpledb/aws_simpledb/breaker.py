@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Circuit breakers
+
+A circuit breaker counts the consecutive failures (errors, or calls slower
+than a threshold) of the calls it guards. Once they reach a threshold the
+breaker opens: calls fail fast with CircuitOpen, without being made. After
+reset_timeout seconds the breaker is half-open, a single probe call is let
+through, it closes the breaker if it succeeds and opens it again otherwise.
+
+"""
+
+import time
+import threading
+
+import status
+
+class CircuitOpen(Exception):
+    """Raised instead of making a call while its circuit breaker is open"""
+
+class CircuitBreaker(object):
+    closed = 'closed'
+    open = 'open'
+    half_open = 'half-open'
+
+    def __init__(self, name, failure_threshold, reset_timeout, slow_call_seconds=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call_seconds = slow_call_seconds
+
+        self.state = self.closed
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Raises CircuitOpen if a call can't be made now. Every allowed call
+        must be followed by record().
+
+        """
+
+        with self._lock:
+            if self.state == self.open and \
+               time.time() - self._opened_at >= self.reset_timeout:
+                self.state = self.half_open
+
+            if self.state == self.closed:
+                return
+
+            if self.state == self.half_open and not self._probing:
+                self._probing = True
+                return
+
+        status.increment('circuit_breaker_rejections')
+
+        raise CircuitOpen('Circuit breaker %s is open' % self.name)
+
+    def record(self, succeeded, latency=None):
+        """Records the outcome of an allowed call, a successful call slower
+        than slow_call_seconds counts as a failure.
+
+        """
+
+        if succeeded and latency is not None and \
+           self.slow_call_seconds is not None and \
+           latency > self.slow_call_seconds:
+            succeeded = False
+
+        with self._lock:
+            if self.state == self.half_open:
+                self._probing = False
+
+            if succeeded:
+                self.state = self.closed
+                self._failures = 0
+                return
+
+            self._failures += 1
+
+            if self.state == self.half_open or \
+               self._failures >= self.failure_threshold:
+                if self.state != self.open:
+                    status.increment('circuit_breaker_trips')
+
+                self.state = self.open
+                self._opened_at = time.time()
+
+    def cancel(self):
+        """Gives up an allowed call without making it"""
+
+        with self._lock:
+            if self.state == self.half_open:
+                self._probing = False
+
+# The breakers by name, shared by all the connections of the process
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def shared_breaker(name, failure_threshold, reset_timeout, slow_call_seconds=None):
+    """Returns the process's CircuitBreaker of name, creates it with the
+    given arguments if there's none.
+
+    """
+
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(
+                                             name,
+                                             failure_threshold,
+                                             reset_timeout,
+                                             slow_call_seconds
+                                            )
+
+        return _breakers[name]
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Coalescing of concurrent identical calls
+
+"""
+
+import os
+import sys
+import copy
+import threading
+
+import deadlines
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.followers = 0
+
+class SingleFlight(object):
+    """Runs concurrent calls of the same key once: the first caller of a key
+    runs the call, callers of the key that come while it runs wait for it and
+    share its outcome (its return value or the exception it raised).
+
+    A call that exceeded the deadline of its caller (see the deadlines module)
+    isn't shared, the waiting callers run their own calls, within their own
+    deadlines. Each caller that shares an exception gets its own copy of it.
+
+    When a call was shared, each caller gets its own deep copy of the result,
+    so callers can change their results freely.
+
+    on_coalesced, if given, is called (without arguments) for each call that
+    was saved.
+
+    """
+
+    def __init__(self, on_coalesced=None):
+        self.on_coalesced = on_coalesced
+
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def do(self, key, function, *args, **kwargs):
+        """Returns function(*args, **kwargs), or the result of the call of
+        key in flight.
+
+        """
+
+        with self._lock:
+            # Calls in flight in a parent process never finish in its
+            # children
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._flights = {}
+
+            flight = self._flights.get(key)
+
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.followers += 1
+
+        if leader:
+            try:
+                flight.result = function(*args, **kwargs)
+            except BaseException:
+                flight.exc_info = sys.exc_info()
+            finally:
+                with self._lock:
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+
+                flight.done.set()
+        else:
+            if self.on_coalesced is not None:
+                self.on_coalesced()
+
+            # The call might run longer than the follower's deadline allows
+            if not flight.done.wait(deadlines.timeout(None)):
+                raise deadlines.DeadlineExceeded()
+
+        if flight.exc_info is not None:
+            exc_type, exc_value, exc_traceback = flight.exc_info
+
+            if not leader:
+                if isinstance(exc_value, deadlines.DeadlineExceeded):
+                    return function(*args, **kwargs)
+
+                # Callers add to exceptions as they propagate (e.g.
+                # DeadlineExceeded.add_partial())
+                exc_value = _copied_exception(exc_value)
+
+            raise exc_type, exc_value, exc_traceback
+
+        # No follower can join once the flight is done, a result nobody
+        # shared isn't copied
+        if not flight.followers:
+            return flight.result
+
+        return copy.deepcopy(flight.result)
+
+def _copied_exception(exc_value):
+    # A copy of exc_value, or exc_value itself for exceptions that can't be
+    # copied (whose args don't match their __init__)
+    try:
+        return copy.copy(exc_value)
+    except Exception:
+        return exc_value
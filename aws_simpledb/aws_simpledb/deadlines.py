@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Per-call deadlines
+
+A deadline bounds the time of every call made in its scope, including their
+socket timeouts, retry delays and pagination:
+
+    with deadline(2.5):
+        connection.select('*', 'domain')
+
+Once the deadline passes the call raises DeadlineExceeded, scans attach the
+progress they made to it (see DeadlineExceeded.partial).
+
+The deadline is kept per thread, calls that run parts of their work on other
+threads pass it on them (see inherited()). Nested deadlines can only shorten
+the deadline in effect.
+
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+_local = threading.local()
+
+class DeadlineExceeded(Exception):
+    """Raised when a call didn't finish before its deadline.
+
+    partial is None, or a dictionary describing the progress the call made,
+    e.g. the items a scan read before the deadline passed.
+
+    """
+
+    def __init__(self, message='Deadline exceeded', partial=None):
+        Exception.__init__(self, message)
+
+        self.partial = partial
+
+    def add_partial(self, **progress):
+        """Adds progress to partial (keeping progress added by inner calls)"""
+
+        self.partial = dict(self.partial or {})
+        for name, value in progress.items():
+            self.partial.setdefault(name, value)
+
+class Deadline(object):
+    def __init__(self, seconds):
+        self.expires = time.time() + seconds
+
+    def remaining(self):
+        return max(self.expires - time.time(), 0)
+
+    def expired(self):
+        return time.time() >= self.expires
+
+def current():
+    """Returns the calling thread's Deadline, None if there's none"""
+
+    return getattr(_local, 'deadline', None)
+
+@contextmanager
+def deadline(seconds):
+    """Calls in the scope must finish within seconds (or before the deadline
+    already in effect, if it's earlier).
+
+    """
+
+    new_deadline = Deadline(seconds)
+
+    previous = current()
+    if previous is not None and previous.expires < new_deadline.expires:
+        new_deadline = previous
+
+    with inherited(new_deadline):
+        yield new_deadline
+
+@contextmanager
+def inherited(deadline_in_effect):
+    """Puts deadline_in_effect (a Deadline, or None for no deadline) in effect
+    in the scope, used to pass a deadline to another thread.
+
+    """
+
+    previous = current()
+    _local.deadline = deadline_in_effect
+
+    try:
+        yield deadline_in_effect
+    finally:
+        _local.deadline = previous
+
+def check(**partial):
+    """Raises DeadlineExceeded (with partial, if given) if the deadline in
+    effect passed.
+
+    """
+
+    deadline_in_effect = current()
+
+    if deadline_in_effect is not None and deadline_in_effect.expired():
+        raise DeadlineExceeded(partial=partial or None)
+
+def timeout(default):
+    """Returns default (seconds, None for no timeout) capped by the time left
+    to the deadline in effect, raises DeadlineExceeded if there's no time
+    left.
+
+    """
+
+    deadline_in_effect = current()
+
+    if deadline_in_effect is None:
+        return default
+
+    remaining = deadline_in_effect.remaining()
+    if not remaining:
+        raise DeadlineExceeded()
+
+    if default is None:
+        return remaining
+
+    return min(default, remaining)
+
+def sleep(seconds):
+    """Sleeps seconds, raises DeadlineExceeded right away if the deadline in
+    effect would pass before it ends.
+
+    """
+
+    deadline_in_effect = current()
+
+    if deadline_in_effect is not None and \
+       deadline_in_effect.remaining() < seconds:
+        raise DeadlineExceeded()
+
+    time.sleep(seconds)
@@ -0,0 +1,653 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Parser for the simpledb select language, and compiler of its expressions
+to python predicates.
+
+It lets us evaluate select queries locally, on items structured as
+SimpleDB.get_attributes() results (dictionaries of attribute names and sets
+of values), e.g. on items changed after simpledb returned them.
+
+The evaluation follows simpledb's semantics:
+- Values are compared as strings, lexicographically.
+- A comparison on a multi-valued attribute is true if any of the attribute's
+  values satisfies it, every(attribute) requires all of them to satisfy it.
+- Comparisons of a single attribute combined with 'and', 'or' and 'not' are
+  evaluated against each value individually, e.g. "a = '1' and a = '2'"
+  matches no item. Use 'intersection' to match items whose attribute has
+  both values.
+- 'is null' is true for items that don't have the attribute.
+
+Usage:
+    query = parse_query("select * from `domain` where a > '1' order by a")
+    query.matches(item_name, attributes)
+    query.sort(items) # list of (item_name, attributes) tuples
+
+    matches = compile_expression("a > '1' intersection b like 'x%'")
+    matches(item_name, attributes)
+
+Compiled expressions are cached.
+
+"""
+
+import re
+
+class ExpressionSyntaxError(ValueError):
+    """Raised for select queries and expressions we can't parse"""
+    pass
+
+# TOKENIZER:
+_token_re = re.compile(r'''
+    \s*(?:
+        (?P<string>'(?:[^']|'')*'|"(?:[^"]|"")*") |
+        (?P<quoted_name>`(?:[^`]|``)*`) |
+        (?P<operator>!=|>=|<=|=|>|<|\(|\)|,|\*) |
+        (?P<word>[^\s'"`!=><(),*]+)
+    )''', re.VERBOSE)
+
+class Token(object):
+    def __init__(self, kind, value, position):
+        self.kind = kind # 'string', 'name', 'operator' or 'word'
+        self.value = value
+        self.position = position
+
+    def is_keyword(self, *keywords):
+        return self.kind == 'word' and self.value.lower() in keywords
+
+    def is_operator(self, *operators):
+        return self.kind == 'operator' and self.value in operators
+
+    def __repr__(self):
+        return '<Token %s %r>' % (self.kind, self.value)
+
+def tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+
+    while position < len(text):
+        match = _token_re.match(text, position)
+        if match is None:
+            raise ExpressionSyntaxError(
+                'Unexpected character at %d: %r' % (position, text[position:])
+            )
+
+        if match.group('string') is not None:
+            quote = match.group('string')[0]
+            value = match.group('string')[1:-1].replace(quote * 2, quote)
+            tokens.append(Token('string', value, match.start('string')))
+        elif match.group('quoted_name') is not None:
+            value = match.group('quoted_name')[1:-1].replace('``', '`')
+            tokens.append(Token('name', value, match.start('quoted_name')))
+        elif match.group('operator') is not None:
+            tokens.append(Token('operator', match.group('operator'), match.start('operator')))
+        else:
+            tokens.append(Token('word', match.group('word'), match.start('word')))
+
+        position = match.end()
+
+    return tokens
+
+# EXPRESSION TREE:
+# Each node evaluates against an item (item name and attributes dictionary).
+# Value level nodes (comparisons of a single attribute's values, and 'and',
+# 'or', 'not' nodes of comparisons of the same attribute) are evaluated
+# against each of the attribute's values, see the module docstring.
+ITEM_NAME = object() # stands for itemName() as an attribute
+
+def _attribute_values(attribute, item_name, attributes):
+    if attribute is ITEM_NAME:
+        return [item_name]
+
+    return attributes.get(attribute) or []
+
+class Node(object):
+    def value_attribute(self):
+        """Returns the attribute whose values the node can be evaluated
+        against, value by value. None if the node is an item level node.
+
+        """
+
+        return None
+
+    def evaluate(self, item_name, attributes):
+        attribute = self.value_attribute()
+
+        for value in _attribute_values(attribute, item_name, attributes):
+            if self.evaluate_value(value):
+                return True
+
+        return False
+
+    def evaluate_value(self, value):
+        raise NotImplementedError
+
+class Comparison(Node):
+    def __init__(self, attribute, test):
+        self.attribute = attribute
+        self.test = test
+
+    def value_attribute(self):
+        return self.attribute
+
+    def evaluate_value(self, value):
+        return self.test(value)
+
+class Every(Node):
+    # every(attribute) <comparison>: all the attribute's values satisfy the
+    # comparison (and there is at least one value)
+    def __init__(self, attribute, test):
+        self.attribute = attribute
+        self.test = test
+
+    def evaluate(self, item_name, attributes):
+        values = _attribute_values(self.attribute, item_name, attributes)
+
+        if not values:
+            return False
+
+        for value in values:
+            if not self.test(value):
+                return False
+
+        return True
+
+class IsNull(Node):
+    def __init__(self, attribute, negate):
+        self.attribute = attribute
+        self.negate = negate
+
+    def evaluate(self, item_name, attributes):
+        is_null = not _attribute_values(self.attribute, item_name, attributes)
+
+        return is_null != self.negate
+
+class Logical(Node):
+    # 'and', 'or', 'not'
+    def __init__(self, operator, children):
+        self.operator = operator
+        self.children = children
+
+    def value_attribute(self):
+        attributes = set([child.value_attribute() for child in self.children])
+
+        if len(attributes) == 1:
+            return attributes.pop()
+
+        return None
+
+    def evaluate(self, item_name, attributes):
+        if self.value_attribute() is not None:
+            return Node.evaluate(self, item_name, attributes)
+
+        if self.operator == 'and':
+            for child in self.children:
+                if not child.evaluate(item_name, attributes):
+                    return False
+            return True
+
+        if self.operator == 'or':
+            for child in self.children:
+                if child.evaluate(item_name, attributes):
+                    return True
+            return False
+
+        return not self.children[0].evaluate(item_name, attributes)
+
+    def evaluate_value(self, value):
+        if self.operator == 'and':
+            for child in self.children:
+                if not child.evaluate_value(value):
+                    return False
+            return True
+
+        if self.operator == 'or':
+            for child in self.children:
+                if child.evaluate_value(value):
+                    return True
+            return False
+
+        return not self.children[0].evaluate_value(value)
+
+class Intersection(Node):
+    # Each side is evaluated on its own against the item
+    def __init__(self, children):
+        self.children = children
+
+    def evaluate(self, item_name, attributes):
+        for child in self.children:
+            if not child.evaluate(item_name, attributes):
+                return False
+
+        return True
+
+def like_test(pattern):
+    # '%' matches any sequence of characters
+    regex = re.compile(
+        '^' + '.*'.join([re.escape(part) for part in pattern.split('%')]) + '$',
+        re.DOTALL
+    )
+
+    return lambda value: regex.match(value) is not None
+
+_comparison_tests = {
+    '=': lambda constant: lambda value: value == constant,
+    '!=': lambda constant: lambda value: value != constant,
+    '>': lambda constant: lambda value: value > constant,
+    '>=': lambda constant: lambda value: value >= constant,
+    '<': lambda constant: lambda value: value < constant,
+    '<=': lambda constant: lambda value: value <= constant,
+}
+
+# PARSER:
+class Parser(object):
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def peek(self, offset=0):
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset]
+
+        return None
+
+    def next(self):
+        token = self.peek()
+
+        if token is None:
+            raise ExpressionSyntaxError('Unexpected end of %r' % self.text)
+
+        self.position += 1
+
+        return token
+
+    def error(self, token, expected):
+        if token is None:
+            return ExpressionSyntaxError(
+                'Expected %s at the end of %r' % (expected, self.text)
+            )
+
+        return ExpressionSyntaxError(
+            'Expected %s at %d of %r, found %r' %
+            (expected, token.position, self.text, token.value)
+        )
+
+    def expect_keyword(self, *keywords):
+        token = self.next()
+
+        if not token.is_keyword(*keywords):
+            raise self.error(token, ' or '.join(keywords))
+
+        return token.value.lower()
+
+    def expect_operator(self, operator):
+        token = self.next()
+
+        if not token.is_operator(operator):
+            raise self.error(token, repr(operator))
+
+    def at_keyword(self, *keywords):
+        token = self.peek()
+
+        return token is not None and token.is_keyword(*keywords)
+
+    def at_end(self):
+        return self.peek() is None
+
+    # expression := or_expression ('intersection' or_expression)*
+    def expression(self):
+        children = [self.or_expression()]
+
+        while self.at_keyword('intersection'):
+            self.next()
+            children.append(self.or_expression())
+
+        if len(children) == 1:
+            return children[0]
+
+        return Intersection(children)
+
+    def or_expression(self):
+        children = [self.and_expression()]
+
+        while self.at_keyword('or'):
+            self.next()
+            children.append(self.and_expression())
+
+        if len(children) == 1:
+            return children[0]
+
+        return Logical('or', children)
+
+    def and_expression(self):
+        children = [self.not_expression()]
+
+        while self.at_keyword('and'):
+            self.next()
+            children.append(self.not_expression())
+
+        if len(children) == 1:
+            return children[0]
+
+        return Logical('and', children)
+
+    def not_expression(self):
+        if self.at_keyword('not'):
+            self.next()
+
+            return Logical('not', [self.not_expression()])
+
+        token = self.peek()
+        if token is not None and token.is_operator('('):
+            self.next()
+            node = self.expression()
+            self.expect_operator(')')
+
+            return node
+
+        return self.comparison()
+
+    def attribute(self):
+        # attribute name, backtick quoted attribute name or itemName()
+        token = self.next()
+
+        if token.kind == 'name':
+            return token.value
+
+        if token.kind != 'word':
+            raise self.error(token, 'attribute name')
+
+        if token.value.lower() == 'itemname' and \
+           self.peek() is not None and self.peek().is_operator('('):
+            self.expect_operator('(')
+            self.expect_operator(')')
+
+            return ITEM_NAME
+
+        return token.value
+
+    def constant(self):
+        token = self.next()
+
+        if token.kind != 'string':
+            raise self.error(token, 'quoted value')
+
+        return token.value
+
+    def comparison(self):
+        every = False
+        if self.at_keyword('every') and \
+           self.peek(1) is not None and self.peek(1).is_operator('('):
+            self.next()
+            self.expect_operator('(')
+            attribute = self.attribute()
+            self.expect_operator(')')
+            every = True
+        else:
+            attribute = self.attribute()
+
+        token = self.next()
+
+        if token.kind == 'operator' and token.value in _comparison_tests:
+            test = _comparison_tests[token.value](self.constant())
+        elif token.is_keyword('like'):
+            test = like_test(self.constant())
+        elif token.is_keyword('not'):
+            self.expect_keyword('like')
+            like = like_test(self.constant())
+            test = lambda value: not like(value)
+        elif token.is_keyword('between'):
+            low = self.constant()
+            self.expect_keyword('and')
+            high = self.constant()
+            test = lambda value: low <= value <= high
+        elif token.is_keyword('in'):
+            self.expect_operator('(')
+            constants = set([self.constant()])
+            while self.peek() is not None and self.peek().is_operator(','):
+                self.next()
+                constants.add(self.constant())
+            self.expect_operator(')')
+            test = lambda value: value in constants
+        elif token.is_keyword('is') and not every:
+            negate = self.at_keyword('not')
+            if negate:
+                self.next()
+            self.expect_keyword('null')
+
+            return IsNull(attribute, negate)
+        else:
+            raise self.error(token, 'comparison operator')
+
+        if every:
+            return Every(attribute, test)
+
+        return Comparison(attribute, test)
+
+    def sort_instructions(self):
+        # attribute ['asc' | 'desc']
+        attribute = self.attribute()
+
+        descending = False
+        if self.at_keyword('asc', 'desc'):
+            descending = self.next().value.lower() == 'desc'
+
+        return Sort(attribute, descending)
+
+    def query(self):
+        self.expect_keyword('select')
+        output_list = self.output_list()
+
+        self.expect_keyword('from')
+        domain_token = self.next()
+        if domain_token.kind not in ['name', 'word']:
+            raise self.error(domain_token, 'domain name')
+
+        where = sort = limit = None
+
+        if self.at_keyword('where'):
+            self.next()
+            where = self.expression()
+
+        if self.at_keyword('order'):
+            self.next()
+            self.expect_keyword('by')
+            sort = self.sort_instructions()
+
+        if self.at_keyword('limit'):
+            self.next()
+            limit_token = self.next()
+            if limit_token.kind != 'word' or not limit_token.value.isdigit():
+                raise self.error(limit_token, 'limit number')
+            limit = int(limit_token.value)
+
+        if not self.at_end():
+            raise self.error(self.peek(), 'end of query')
+
+        return Query(output_list, domain_token.value, where, sort, limit)
+
+    def output_list(self):
+        token = self.peek()
+
+        if token is not None and token.is_operator('*'):
+            self.next()
+            return '*'
+
+        if token is not None and token.is_keyword('count') and \
+           self.peek(1) is not None and self.peek(1).is_operator('('):
+            self.next()
+            self.expect_operator('(')
+            self.expect_operator('*')
+            self.expect_operator(')')
+            return 'count(*)'
+
+        attributes = [self.attribute()]
+        while self.peek() is not None and self.peek().is_operator(','):
+            self.next()
+            attributes.append(self.attribute())
+
+        if attributes == [ITEM_NAME]:
+            return 'itemName()'
+
+        return attributes
+
+class Sort(object):
+    def __init__(self, attribute, descending=False):
+        self.attribute = attribute
+        self.descending = descending
+
+    def key(self, item_name, attributes):
+        """Returns the value the item is sorted by: the lowest value of the
+        sort attribute, None if the item doesn't have the attribute.
+
+        """
+
+        values = _attribute_values(self.attribute, item_name, attributes)
+
+        if not values:
+            return None
+
+        return min(values)
+
+    def before(self, key, other_key):
+        """Returns whether an item with the sort key `key` is sorted before
+        an item with `other_key` (items with None keys are placed last).
+
+        """
+
+        if key is None:
+            return False
+
+        if other_key is None:
+            return True
+
+        if self.descending:
+            return key > other_key
+
+        return key < other_key
+
+    def __call__(self, items):
+        """Returns items, a list of (item_name, attributes) tuples, sorted.
+
+        Items are sorted by their key(), items without the sort attribute are
+        placed last.
+
+        """
+
+        with_values = []
+        without_values = []
+
+        for item in items:
+            key = self.key(item[0], item[1])
+
+            if key is not None:
+                with_values.append((key, item))
+            else:
+                without_values.append(item)
+
+        with_values.sort(key=lambda key_item: key_item[0], reverse=self.descending)
+
+        return [item for (key, item) in with_values] + without_values
+
+class Query(object):
+    """A parsed select query.
+
+    output_list is '*', 'itemName()', 'count(*)' or a list of attributes
+    (itemName() in it is expression.ITEM_NAME), where is the expression's
+    tree (None if the query has no where clause), sort is a Sort (or None)
+    and limit an int (or None).
+
+    """
+
+    def __init__(self, output_list, domain, where=None, sort=None, limit=None):
+        self.output_list = output_list
+        self.domain = domain
+        self.where = where
+        self.sort_instructions = sort
+        self.limit = limit
+
+    def matches(self, item_name, attributes):
+        if self.where is None:
+            return True
+
+        return self.where.evaluate(item_name, attributes)
+
+    def sort(self, items):
+        if self.sort_instructions is None:
+            return list(items)
+
+        return self.sort_instructions(items)
+
+def parse_query(query):
+    """Parses a select query, returns a Query"""
+
+    return Parser(query).query()
+
+def parse_expression(expression):
+    """Parses the where clause of a select query, returns its tree's root
+    Node
+
+    """
+
+    parser = Parser(expression)
+    node = parser.expression()
+
+    if not parser.at_end():
+        raise parser.error(parser.peek(), 'end of expression')
+
+    return node
+
+def parse_sort_instructions(sort_instructions):
+    parser = Parser(sort_instructions)
+    sort = parser.sort_instructions()
+
+    if not parser.at_end():
+        raise parser.error(parser.peek(), 'end of sort instructions')
+
+    return sort
+
+# Compiled expressions and sort instructions, by their text
+_compiled_cache = {}
+_compiled_cache_size = 1000
+
+def _cached(kind, text, compile):
+    key = (kind, text)
+
+    try:
+        return _compiled_cache[key]
+    except KeyError:
+        pass
+
+    compiled = compile(text)
+
+    if len(_compiled_cache) >= _compiled_cache_size:
+        _compiled_cache.clear()
+
+    _compiled_cache[key] = compiled
+
+    return compiled
+
+def compile_expression(expression):
+    """Returns a predicate function(item_name, attributes) that returns
+    whether the item matches the expression (the where clause of a select
+    query). A None expression matches all the items.
+
+    """
+
+    if expression is None:
+        return lambda item_name, attributes: True
+
+    return _cached('expression', expression, lambda text: parse_expression(text).evaluate)
+
+def compile_sort(sort_instructions):
+    """Returns a function that sorts a list of (item_name, attributes) tuples
+    according to sort_instructions (the order by clause of a select query,
+    e.g. "a desc"). None sort_instructions keeps the order.
+
+    """
+
+    if sort_instructions is None:
+        return list
+
+    return _cached('sort', sort_instructions, parse_sort_instructions)
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Hedged requests
+
+A hedged request sends a duplicate of a request that didn't answer within a
+percentile of the recent requests' latency, and uses the first reply. Only
+idempotent requests (reads) can be hedged.
+
+"""
+
+import os
+import sys
+import math
+import time
+import Queue
+import threading
+from collections import deque
+
+import deadlines
+
+class HedgingPolicy(object):
+    """Decides when requests are hedged, from the latencies of the recent
+    requests (up to window of them).
+
+    Requests are hedged after the percentile (0-100) of the recent latencies,
+    once at least min_samples latencies were recorded. Up to budget_ratio of
+    the recent requests are hedged, the others wait for their first attempt.
+
+    """
+
+    def __init__(self, percentile, budget_ratio, window, min_samples):
+        self.percentile = percentile
+        self.budget_ratio = budget_ratio
+        self.min_samples = min_samples
+
+        self._latencies = deque(maxlen=window)
+        # 1 for each recent request that was hedged, 0 for the others
+        self._hedged = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record_latency(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def delay(self):
+        """Returns the seconds after which requests are hedged, None if there
+        aren't enough latencies recorded yet.
+
+        """
+
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+
+            latencies = sorted(self._latencies)
+
+        index = int(math.ceil(self.percentile / 100.0 * len(latencies))) - 1
+
+        return latencies[max(index, 0)]
+
+    def count_request(self, hedge):
+        """Counts a request, returns whether it's hedged: if hedge is set and
+        the budget allows.
+
+        """
+
+        with self._lock:
+            if hedge:
+                hedge = sum(self._hedged) + 1 <= \
+                    self.budget_ratio * (len(self._hedged) + 1)
+
+            self._hedged.append(int(hedge))
+
+        return hedge
+
+class AttemptPool(object):
+    """Runs attempts on up to max_workers daemon threads, which are started
+    on demand and kept for following attempts. Attempts submitted while all
+    the threads are busy wait for a free one.
+
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+
+        self._reset()
+
+    def _reset(self):
+        # The threads of a parent process don't run in its children, and its
+        # lock might have been held while it forked
+        self._pid = os.getpid()
+        self._calls = Queue.Queue()
+        self._workers = 0
+        self._idle_workers = 0
+        self._lock = threading.Lock()
+
+    def submit(self, call):
+        """Calls call() on the pool, within the deadline in effect (see the
+        deadlines module). call must not raise.
+
+        """
+
+        if self._pid != os.getpid():
+            self._reset()
+
+        with self._lock:
+            if self._idle_workers:
+                self._idle_workers -= 1
+            elif self._workers < self.max_workers:
+                worker = threading.Thread(target=self._work, args=(self._calls,))
+                worker.daemon = True
+                worker.start()
+
+                self._workers += 1
+
+            self._calls.put((deadlines.current(), call))
+
+    def _work(self, calls):
+        while True:
+            deadline_in_effect, call = calls.get()
+
+            with deadlines.inherited(deadline_in_effect):
+                call()
+
+            with self._lock:
+                self._idle_workers += 1
+
+def run_hedged(policy, pool, attempt, hedge_attempt):
+    """Returns the result of attempt() (a call that sends the request), or of
+    hedge_attempt() (a call that sends a duplicate of it) if attempt() didn't
+    answer within the policy's delay and the duplicate answered first. Both
+    run on pool (an AttemptPool).
+
+    If the first answer is an exception, the other attempt's answer is used
+    (if there's one), the exception is raised only if both failed.
+
+    Returns (result, hedged) tuple.
+
+    """
+
+    delay = policy.delay()
+
+    if delay is None:
+        policy.count_request(False)
+
+        return _timed(policy, attempt), False
+
+    answers = Queue.Queue()
+
+    def run(call):
+        try:
+            answers.put((True, _timed(policy, call)))
+        except Exception:
+            answers.put((False, sys.exc_info()))
+
+    # The request is counted once, either as hedged by the timer or as not
+    # hedged by the first answer, whichever comes first
+    decision = {'decided': False, 'hedged': False}
+    decision_lock = threading.Lock()
+    deadline_in_effect = deadlines.current()
+
+    def hedge():
+        with decision_lock:
+            if decision['decided']:
+                return
+
+            decision['decided'] = True
+            decision['hedged'] = policy.count_request(True)
+
+        if decision['hedged']:
+            with deadlines.inherited(deadline_in_effect):
+                pool.submit(lambda: run(hedge_attempt))
+
+    timer = threading.Timer(delay, hedge)
+    timer.daemon = True
+
+    pool.submit(lambda: run(attempt))
+    timer.start()
+
+    # Blocks without a timeout: on python 2 a timed wait polls, which would
+    # delay the answer
+    answer = answers.get()
+    timer.cancel()
+
+    with decision_lock:
+        if not decision['decided']:
+            decision['decided'] = True
+            policy.count_request(False)
+
+        hedged = decision['hedged']
+
+    pending = int(hedged)
+
+    # A failed attempt is dropped as long as the other might still succeed
+    while not answer[0] and pending:
+        answer = answers.get()
+        pending -= 1
+
+    ok, value = answer
+    if not ok:
+        raise value[0], value[1], value[2]
+
+    return value, hedged
+
+def _timed(policy, call):
+    # Calls call, records its latency if it succeeded
+    start = time.time()
+
+    result = call()
+
+    policy.record_latency(time.time() - start)
+
+    return result
@@ -5,9 +5,27 @@
 
 """
 
+import threading
+
 # counts https timeouts occurred
 https_timeouts = 0
 
+# counts get_attributes() calls that shared the request of an identical call
+coalesced_reads = 0
+
+# counts reads that were sent again since they were slow (see
+# SimpleDB._make_read_request())
+hedged_reads = 0
+
+# circuit breakers (see the breaker module) openings, and requests they failed
+# fast
+circuit_breaker_trips = 0
+circuit_breaker_rejections = 0
+
+# counts idle pooled connections that were found dead and replaced (see
+# SimpleDB._connection_is_alive())
+dead_connections_replaced = 0
+
 actions_count = {
                  'get_item': 0,
                  'delete_item': 0,
@@ -21,6 +39,22 @@ actions_count = {
 # processing times
 requests = []
 
+# The counters are incremented by concurrent threads, so they are changed only
+# through increment() and count_action()
+_lock = threading.Lock()
+
+def increment(counter, amount=1):
+    """Adds amount to the counter named counter, atomically"""
+
+    with _lock:
+        globals()[counter] += amount
+
+def count_action(action):
+    """Counts a request of action (one of actions_count's keys), atomically"""
+
+    with _lock:
+        actions_count[action] += 1
+
 def total_db_box_usage():
     global requests
 
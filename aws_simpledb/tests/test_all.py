@@ -7,7 +7,7 @@
 import unittest
 import helpers
 
-test_modules = ['test_aws_simpledb_domains_actions', 'test_actions']
+test_modules = ['test_aws_simpledb_domains_actions', 'test_actions', 'test_expression', 'test_coalescing', 'test_hedging', 'test_deadlines', 'test_breaker', 'test_connections']
 
 modules_suites = []
 for module in test_modules:
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+import unittest
+
+import startup
+
+import time
+
+from aws_simpledb import breaker
+from aws_simpledb import settings
+from aws_simpledb.breaker import CircuitBreaker, CircuitOpen
+from aws_simpledb.aws_simpledb import SimpleDB, SimpleDBError, Request
+
+class TestBreaker(unittest.TestCase):
+    """Tests the circuit breakers (no simpledb connection required).
+    """
+
+    def tripped(self, reset_timeout=60):
+        circuit_breaker = CircuitBreaker('test', 2, reset_timeout)
+
+        for index in range(2):
+            circuit_breaker.allow()
+            circuit_breaker.record(False)
+
+        return circuit_breaker
+
+    def test_00_trips_on_consecutive_failures(self):
+        circuit_breaker = CircuitBreaker('test', 2, 60)
+
+        circuit_breaker.allow()
+        circuit_breaker.record(False)
+        circuit_breaker.allow()
+        circuit_breaker.record(True)
+        circuit_breaker.allow()
+        circuit_breaker.record(False)
+
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.closed)
+
+        circuit_breaker.allow()
+        circuit_breaker.record(False)
+
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.open)
+        self.assertRaises(CircuitOpen, circuit_breaker.allow)
+
+    def test_01_slow_calls_fail(self):
+        circuit_breaker = CircuitBreaker('test', 1, 60, slow_call_seconds=0.5)
+
+        circuit_breaker.allow()
+        circuit_breaker.record(True, latency=0.1)
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.closed)
+
+        circuit_breaker.allow()
+        circuit_breaker.record(True, latency=1)
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.open)
+
+    def test_02_single_probe(self):
+        circuit_breaker = self.tripped(reset_timeout=0.01)
+        time.sleep(0.02)
+
+        circuit_breaker.allow()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.half_open)
+        self.assertRaises(CircuitOpen, circuit_breaker.allow)
+
+        circuit_breaker.record(True)
+
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.closed)
+        circuit_breaker.allow()
+
+    def test_03_failed_probe_reopens(self):
+        circuit_breaker = self.tripped(reset_timeout=0.05)
+        time.sleep(0.06)
+
+        circuit_breaker.allow()
+        circuit_breaker.record(False)
+
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.open)
+        self.assertRaises(CircuitOpen, circuit_breaker.allow)
+
+    def test_04_cancelled_probe(self):
+        circuit_breaker = self.tripped(reset_timeout=0.01)
+        time.sleep(0.02)
+
+        circuit_breaker.allow()
+        circuit_breaker.cancel()
+
+        # Another call can probe
+        circuit_breaker.allow()
+
+    def test_05_shared_breakers(self):
+        first = breaker.shared_breaker('test_shared', 2, 60)
+
+        self.assertTrue(breaker.shared_breaker('test_shared', 5, 1) is first)
+        self.assertEqual(first.failure_threshold, 2)
+        self.assertFalse(breaker.shared_breaker('test_other', 2, 60) is first)
+
+    def test_06_server_errors(self):
+        self.assertTrue(SimpleDBError('failed', 'InternalError', 500).server_error())
+        self.assertTrue(SimpleDBError('failed', 'ServiceUnavailable').server_error())
+        self.assertTrue(SimpleDBError('failed', 'Unknown', 503).server_error())
+        self.assertFalse(SimpleDBError('failed', 'NoSuchDomain', 400).server_error())
+        self.assertFalse(SimpleDBError('failed').server_error())
+
+    def test_07_requests_errors_classified(self):
+        connection = SimpleDB('key', 'secret', 'test-errors.sdb.example.com')
+        endpoint_breaker = breaker.shared_breaker(
+                                                  connection.db,
+                                                  settings.circuit_breaker_failure_threshold,
+                                                  settings.circuit_breaker_reset_timeout
+                                                 )
+        errors = []
+
+        def attempts(request):
+            raise errors.pop(0)
+
+        connection._make_request_attempts = attempts
+
+        def make_requests(error, amount):
+            errors.extend([error] * amount)
+
+            for index in range(amount):
+                self.assertRaises(
+                                  SimpleDBError,
+                                  connection._make_request,
+                                  Request('POST', connection._sdb_url(), {'Action': 'ListDomains'})
+                                 )
+
+        original = settings.circuit_breaker
+        settings.circuit_breaker = True
+        try:
+            # Rejected requests tell nothing about simpledb's health
+            make_requests(
+                          SimpleDBError('rejected', 'InvalidParameterValue', 400),
+                          settings.circuit_breaker_failure_threshold
+                         )
+            self.assertEqual(endpoint_breaker.state, CircuitBreaker.closed)
+
+            make_requests(
+                          SimpleDBError('failed', 'ServiceUnavailable', 503),
+                          settings.circuit_breaker_failure_threshold
+                         )
+            self.assertEqual(endpoint_breaker.state, CircuitBreaker.open)
+        finally:
+            settings.circuit_breaker = original
+
+if __name__ == '__main__':
+    unittest.main()
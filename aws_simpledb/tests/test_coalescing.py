@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+import unittest
+
+import startup
+
+import time
+import threading
+
+from aws_simpledb import deadlines
+from aws_simpledb.coalescing import SingleFlight
+
+class TestCoalescing(unittest.TestCase):
+    """Tests the coalescing of concurrent identical calls (no simpledb
+    connection required).
+    """
+
+    def setUp(self):
+        self.coalesced = []
+        self.flights = SingleFlight(lambda: self.coalesced.append(1))
+        self.calls = []
+
+    def run_callers(self, key, function, amount):
+        # Calls key concurrently from amount threads, the first one leads,
+        # returns list of (ok, result or exception) in calls order
+        outcomes = [None] * amount
+
+        def caller(index):
+            try:
+                outcomes[index] = (True, self.flights.do(key, function))
+            except Exception as error:
+                outcomes[index] = (False, error)
+
+        threads = [threading.Thread(target=caller, args=(index,)) for index in range(amount)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+
+        for thread in threads:
+            thread.join()
+
+        return outcomes
+
+    def slow_call(self):
+        self.calls.append(1)
+        time.sleep(0.1)
+
+        return {'a': ['1']}
+
+    def test_00_shared_call(self):
+        outcomes = self.run_callers('key', self.slow_call, 3)
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(len(self.coalesced), 2)
+        self.assertEqual(outcomes, [(True, {'a': ['1']})] * 3)
+
+        # Each caller gets its own copy
+        results = [result for (ok, result) in outcomes]
+        self.assertEqual(len(set([id(result) for result in results])), 3)
+
+    def test_01_sequential_calls_not_shared(self):
+        self.flights.do('key', self.slow_call)
+        self.flights.do('key', self.slow_call)
+
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.coalesced, [])
+
+    def test_02_shared_exception_copies(self):
+        def failing_call():
+            self.calls.append(1)
+            time.sleep(0.1)
+
+            raise ValueError('failed')
+
+        outcomes = self.run_callers('key', failing_call, 3)
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertTrue(all([not ok and isinstance(error, ValueError) for (ok, error) in outcomes]))
+        self.assertEqual(len(set([id(error) for (ok, error) in outcomes])), 3)
+
+    def test_03_leader_deadline_not_shared(self):
+        def call():
+            self.calls.append(1)
+            time.sleep(0.1)
+            deadlines.check()
+
+            return 'result'
+
+        outcomes = [None, None]
+
+        def leader():
+            try:
+                with deadlines.deadline(0.05):
+                    self.flights.do('key', call)
+            except deadlines.DeadlineExceeded as error:
+                outcomes[0] = error
+
+        def follower():
+            time.sleep(0.01)
+            outcomes[1] = self.flights.do('key', call)
+
+        threads = [threading.Thread(target=leader), threading.Thread(target=follower)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(isinstance(outcomes[0], deadlines.DeadlineExceeded))
+        # The follower had no deadline, it ran its own call
+        self.assertEqual(outcomes[1], 'result')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_04_follower_deadline(self):
+        outcomes = [None]
+
+        def follower():
+            time.sleep(0.01)
+
+            try:
+                with deadlines.deadline(0.02):
+                    self.flights.do('key', self.slow_call)
+            except deadlines.DeadlineExceeded as error:
+                outcomes[0] = error
+
+        thread = threading.Thread(target=follower)
+        thread.start()
+
+        self.flights.do('key', self.slow_call)
+        thread.join()
+
+        self.assertTrue(isinstance(outcomes[0], deadlines.DeadlineExceeded))
+        self.assertEqual(len(self.calls), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+import unittest
+
+import startup
+
+import os
+import time
+import socket
+import httplib
+
+from aws_simpledb import settings
+from aws_simpledb import status
+from aws_simpledb import deadlines
+from aws_simpledb.aws_simpledb import SimpleDB, Request
+
+class FakeConnection(object):
+    """Stands for an httplib connection in the pool"""
+
+    fail_connect = False
+
+    def __init__(self, host=None, timeout=None, sock=None):
+        self.sock = sock
+        self.closed = False
+
+    def connect(self):
+        if self.fail_connect:
+            raise socket.error('refused')
+
+    def close(self):
+        self.closed = True
+
+class TestConnections(unittest.TestCase):
+    """Tests the simpledb connections pool (no simpledb connection required).
+    """
+
+    def setUp(self):
+        self.connection = SimpleDB('key', 'secret', 'sdb.example.com')
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def socketpair(self):
+        left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sockets.extend([left, right])
+
+        return left, right
+
+    def test_00_most_recent_connection_reused(self):
+        first, second = FakeConnection(), FakeConnection()
+
+        self.connection._release_connection(first)
+        self.connection._release_connection(second)
+
+        self.assertTrue(self.connection._acquire_connection() is second)
+        self.assertTrue(self.connection._acquire_connection() is first)
+
+    def test_01_idle_connections_capped(self):
+        connections = [
+                       FakeConnection() for
+                       index in range(settings.max_idle_connections + 3)
+                      ]
+
+        for sdb_connection in connections:
+            self.connection._release_connection(sdb_connection)
+
+        self.assertEqual(len(self.connection._idle_connections), settings.max_idle_connections)
+        # The least recently used ones are closed
+        self.assertEqual([sdb_connection.closed for sdb_connection in connections[:4]], [True] * 3 + [False])
+
+    def test_02_long_idle_connection_replaced(self):
+        replaced = status.dead_connections_replaced
+        idle = FakeConnection()
+
+        self.connection._idle_connections.append(
+            (idle, time.time() - settings.max_connection_idle - 1)
+        )
+
+        sdb_connection = self.connection._acquire_connection()
+
+        self.assertFalse(sdb_connection is idle)
+        self.assertTrue(idle.closed)
+        self.assertEqual(status.dead_connections_replaced, replaced + 1)
+
+    def test_03_readable_connection_dead(self):
+        left, right = self.socketpair()
+        sdb_connection = FakeConnection(sock=left)
+
+        self.assertTrue(self.connection._connection_is_alive(sdb_connection, time.time()))
+
+        right.sendall('unexpected')
+        self.assertFalse(self.connection._connection_is_alive(sdb_connection, time.time()))
+
+    def test_04_closed_connection_dead(self):
+        left, right = self.socketpair()
+
+        right.close()
+
+        self.assertFalse(
+            self.connection._connection_is_alive(FakeConnection(sock=left), time.time())
+        )
+
+    def test_05_high_descriptors(self):
+        left, right = self.socketpair()
+
+        # A descriptor beyond select()'s FD_SETSIZE
+        try:
+            os.dup2(left.fileno(), 2000)
+        except OSError:
+            self.skipTest('Descriptor 2000 is beyond the process limit')
+
+        class HighSocket(object):
+            def fileno(self):
+                return 2000
+
+        try:
+            self.assertTrue(
+                self.connection._connection_is_alive(FakeConnection(sock=HighSocket()), time.time())
+            )
+
+            right.sendall('unexpected')
+            self.assertFalse(
+                self.connection._connection_is_alive(FakeConnection(sock=HighSocket()), time.time())
+            )
+        finally:
+            os.close(2000)
+
+    def test_06_warmup(self):
+        connections = []
+
+        def connection_class(host, timeout=None):
+            sdb_connection = FakeConnection()
+            sdb_connection.fail_connect = len(connections) % 2 == 1
+            connections.append(sdb_connection)
+
+            return sdb_connection
+
+        original = httplib.HTTPSConnection
+        httplib.HTTPSConnection = connection_class
+        try:
+            opened = self.connection.warmup(4)
+        finally:
+            httplib.HTTPSConnection = original
+
+        # Connections that failed to open are closed, not pooled
+        self.assertEqual(opened, 2)
+        self.assertEqual(len(self.connection._idle_connections), 2)
+        self.assertEqual(len([sdb_connection for sdb_connection in connections if sdb_connection.closed]), 2)
+
+    def test_07_expired_deadline_takes_no_connection(self):
+        idle = FakeConnection()
+        self.connection._release_connection(idle)
+
+        request = Request('POST', self.connection._sdb_url(), {'Action': 'ListDomains'})
+
+        with deadlines.deadline(0.01):
+            time.sleep(0.02)
+
+            self.assertRaises(
+                              deadlines.DeadlineExceeded,
+                              self.connection._SimpleDB__make_request,
+                              request
+                             )
+
+        self.assertEqual([sdb_connection for (sdb_connection, idle_since) in self.connection._idle_connections], [idle])
+        self.assertFalse(idle.closed)
+
+if __name__ == '__main__':
+    unittest.main()
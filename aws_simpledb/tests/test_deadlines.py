@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+import unittest
+
+import startup
+
+import time
+import threading
+
+from aws_simpledb import deadlines
+
+class TestDeadlines(unittest.TestCase):
+    """Tests the per-call deadlines (no simpledb connection required).
+    """
+
+    def test_00_no_deadline(self):
+        self.assertEqual(deadlines.current(), None)
+        self.assertEqual(deadlines.timeout(5), 5)
+        self.assertEqual(deadlines.timeout(None), None)
+
+        deadlines.check()
+
+    def test_01_timeout_capped(self):
+        with deadlines.deadline(1):
+            self.assertTrue(deadlines.timeout(5) <= 1)
+            self.assertEqual(deadlines.timeout(0.5), 0.5)
+            self.assertTrue(0 < deadlines.timeout(None) <= 1)
+
+        self.assertEqual(deadlines.current(), None)
+
+    def test_02_nested_deadlines_only_shorten(self):
+        with deadlines.deadline(1) as outer:
+            with deadlines.deadline(10) as inner:
+                self.assertTrue(inner is outer)
+
+            with deadlines.deadline(0.5) as inner:
+                self.assertTrue(inner.expires < outer.expires)
+
+            self.assertTrue(deadlines.current() is outer)
+
+    def test_03_expired(self):
+        with deadlines.deadline(0.01):
+            time.sleep(0.02)
+
+            self.assertRaises(deadlines.DeadlineExceeded, deadlines.timeout, 5)
+            self.assertRaises(deadlines.DeadlineExceeded, deadlines.sleep, 1)
+
+            try:
+                deadlines.check(items=['item'])
+            except deadlines.DeadlineExceeded as error:
+                self.assertEqual(error.partial, {'items': ['item']})
+            else:
+                self.fail('DeadlineExceeded not raised')
+
+    def test_04_sleep_beyond_deadline(self):
+        start = time.time()
+
+        with deadlines.deadline(0.5):
+            self.assertRaises(deadlines.DeadlineExceeded, deadlines.sleep, 1)
+
+        # It raises right away, without sleeping
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_05_add_partial(self):
+        error = deadlines.DeadlineExceeded(partial={'items': ['inner']})
+        error.add_partial(items=['outer'], pages=2)
+
+        self.assertEqual(error.partial, {'items': ['inner'], 'pages': 2})
+
+    def test_06_threads_and_inheritance(self):
+        seen = []
+
+        with deadlines.deadline(1) as deadline_in_effect:
+            thread = threading.Thread(target=lambda: seen.append(deadlines.current()))
+            thread.start()
+            thread.join()
+
+            with deadlines.inherited(None):
+                self.assertEqual(deadlines.current(), None)
+
+            self.assertTrue(deadlines.current() is deadline_in_effect)
+
+        # Deadlines are per thread
+        self.assertEqual(seen, [None])
+
+if __name__ == '__main__':
+    unittest.main()
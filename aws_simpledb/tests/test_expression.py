@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+import unittest
+
+import startup
+
+from aws_simpledb import expression
+
+class TestExpression(unittest.TestCase):
+    """Tests the select language parser and the local evaluation of select
+    expressions (no simpledb connection required).
+    """
+
+    def setUp(self):
+        self.items = {
+                      'item1': {'a': set(['1', '2']), 'b': set(['x1'])},
+                      'item2': {'a': set(['3']), 'b': set(['y2'])},
+                      'item3': {'b': set(['x3'])}
+                     }
+
+    def matching(self, where):
+        matches = expression.compile_expression(where)
+
+        return sorted([
+                       item_name for item_name, attributes in self.items.items() if
+                       matches(item_name, attributes)
+                      ])
+
+    def test_00_comparisons(self):
+        self.assertEqual(self.matching("a = '1'"), ['item1'])
+        self.assertEqual(self.matching("a != '1'"), ['item1', 'item2'])
+        self.assertEqual(self.matching("a > '1'"), ['item1', 'item2'])
+        self.assertEqual(self.matching("a >= '3'"), ['item2'])
+        self.assertEqual(self.matching("a < '2'"), ['item1'])
+        self.assertEqual(self.matching("a <= '3'"), ['item1', 'item2'])
+        self.assertEqual(self.matching("b like 'x%'"), ['item1', 'item3'])
+        self.assertEqual(self.matching("b not like 'x%'"), ['item2'])
+        self.assertEqual(self.matching("b like '%2'"), ['item2'])
+        self.assertEqual(self.matching("a between '2' and '3'"), ['item1', 'item2'])
+        self.assertEqual(self.matching("a in ('2', '4')"), ['item1'])
+        self.assertEqual(self.matching("a is null"), ['item3'])
+        self.assertEqual(self.matching("a is not null"), ['item1', 'item2'])
+        self.assertEqual(self.matching("itemName() = 'item2'"), ['item2'])
+        self.assertEqual(self.matching(None), ['item1', 'item2', 'item3'])
+
+    def test_01_multi_valued_attributes(self):
+        # Comparisons of the same attribute are evaluated value by value
+        self.assertEqual(self.matching("a = '1' and a = '2'"), [])
+        self.assertEqual(self.matching("a = '1' intersection a = '2'"), ['item1'])
+        self.assertEqual(self.matching("every(a) > '1'"), ['item2'])
+        self.assertEqual(self.matching("not a = '1'"), ['item1', 'item2'])
+
+    def test_02_logical_operators(self):
+        self.assertEqual(
+                         self.matching("a = '3' or b like 'x%'"),
+                         ['item1', 'item2', 'item3']
+                        )
+        self.assertEqual(self.matching("a = '1' and b = 'x1'"), ['item1'])
+        self.assertEqual(self.matching("a = '1' and not b = 'x1'"), [])
+        self.assertEqual(
+                         self.matching("(a = '3' or a = '1') AND `b` LIKE 'y%'"),
+                         ['item2']
+                        )
+
+    def test_03_quoting(self):
+        self.items['item4'] = {"it's": set(['"quoted"'])}
+
+        self.assertEqual(self.matching("`it's` = '\"quoted\"'"), ['item4'])
+        self.assertEqual(self.matching("`it's` = \"\"\"quoted\"\"\""), ['item4'])
+
+    def test_04_parse_query(self):
+        query = expression.parse_query(
+            "select * from `test domain` where a > '0' order by a desc limit 5"
+        )
+
+        self.assertEqual(query.output_list, '*')
+        self.assertEqual(query.domain, 'test domain')
+        self.assertEqual(query.limit, 5)
+        self.assertTrue(query.matches('item1', self.items['item1']))
+        self.assertFalse(query.matches('item3', self.items['item3']))
+        self.assertEqual(
+                         [item_name for item_name, attributes in
+                          query.sort(self.items.items())],
+                         ['item2', 'item1', 'item3']
+                        )
+
+        query = expression.parse_query('select itemName(), `b` from d')
+        self.assertEqual(query.output_list, [expression.ITEM_NAME, 'b'])
+
+        self.assertEqual(
+                         expression.parse_query('select count(*) from d').output_list,
+                         'count(*)'
+                        )
+
+    def test_05_syntax_errors(self):
+        for where in [
+                      "a = 1",
+                      "a = '1' and",
+                      "(a = '1'",
+                      "a ~ '1'",
+                      "a = '1' b = '2'"
+                     ]:
+            self.assertRaises(
+                              expression.ExpressionSyntaxError,
+                              expression.compile_expression,
+                              where
+                             )
+
+        self.assertRaises(
+                          expression.ExpressionSyntaxError,
+                          expression.parse_query,
+                          "select * from d limit x"
+                         )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+import unittest
+
+import startup
+
+import time
+import threading
+
+from aws_simpledb import deadlines
+from aws_simpledb.hedging import HedgingPolicy, AttemptPool, run_hedged
+
+class TestHedging(unittest.TestCase):
+    """Tests the hedging policy and hedged calls (no simpledb connection
+    required).
+    """
+
+    def setUp(self):
+        self.pool = AttemptPool(4)
+
+    def policy(self, latency, budget_ratio=1.0):
+        policy = HedgingPolicy(50, budget_ratio, 10, 1)
+        policy.record_latency(latency)
+
+        return policy
+
+    def test_00_delay(self):
+        policy = HedgingPolicy(50, 0.1, 4, 3)
+
+        policy.record_latency(0.3)
+        policy.record_latency(0.1)
+        self.assertEqual(policy.delay(), None)
+
+        policy.record_latency(0.2)
+        self.assertEqual(policy.delay(), 0.2)
+
+        # Only the window's latest latencies count
+        for latency in [1, 2, 3, 4]:
+            policy.record_latency(latency)
+
+        self.assertEqual(policy.delay(), 2)
+
+    def test_01_budget(self):
+        policy = HedgingPolicy(50, 0.25, 8, 1)
+
+        hedged = [policy.count_request(True) for index in range(8)]
+
+        self.assertEqual(hedged.count(True), 2)
+        self.assertFalse(policy.count_request(False))
+
+    def test_02_fast_attempt_not_hedged(self):
+        hedges = []
+
+        result, hedged = run_hedged(
+                                    self.policy(1),
+                                    self.pool,
+                                    lambda: 'attempt',
+                                    lambda: hedges.append(1)
+                                   )
+
+        self.assertEqual((result, hedged), ('attempt', False))
+        self.assertEqual(hedges, [])
+
+    def test_03_slow_attempt_hedged(self):
+        release = threading.Event()
+
+        start = time.time()
+        result, hedged = run_hedged(
+                                    self.policy(0.01),
+                                    self.pool,
+                                    lambda: release.wait(1) and 'attempt',
+                                    lambda: 'hedge'
+                                   )
+
+        release.set()
+
+        self.assertEqual((result, hedged), ('hedge', True))
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_04_budget_exhausted(self):
+        result, hedged = run_hedged(
+                                    self.policy(0.01, budget_ratio=0),
+                                    self.pool,
+                                    lambda: time.sleep(0.05) or 'attempt',
+                                    lambda: 'hedge'
+                                   )
+
+        self.assertEqual((result, hedged), ('attempt', False))
+
+    def test_05_failed_attempt(self):
+        def fail():
+            time.sleep(0.05)
+
+            raise ValueError('failed')
+
+        self.assertEqual(
+                         run_hedged(self.policy(0.01), self.pool, fail, lambda: 'hedge'),
+                         ('hedge', True)
+                        )
+        self.assertRaises(ValueError, run_hedged, self.policy(0.01), self.pool, fail, fail)
+        # Without enough latencies recorded there's no hedge
+        self.assertRaises(ValueError, run_hedged, HedgingPolicy(50, 1, 10, 1), self.pool, fail, lambda: 'hedge')
+
+    def test_06_attempts_inherit_deadline(self):
+        with deadlines.deadline(10) as deadline_in_effect:
+            result, hedged = run_hedged(
+                                        self.policy(1),
+                                        self.pool,
+                                        deadlines.current,
+                                        deadlines.current
+                                       )
+
+        self.assertTrue(result is deadline_in_effect)
+
+    def test_07_pool_bounds_threads(self):
+        pool = AttemptPool(2)
+        done = threading.Semaphore(0)
+
+        for index in range(10):
+            pool.submit(lambda: time.sleep(0.01) or done.release())
+
+        for index in range(10):
+            done.acquire()
+
+        self.assertTrue(pool._workers <= 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,269 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Caches used by the consistent_sdb module
+
+"""
+
+import copy
+import datetime
+import pickle
+import threading
+
+import journal
+from timestamps import parse_timestamp
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    """Thread safe dictionary-like cache, bounded by size and entry age.
+
+    When the cache holds max_size entries, setting a new one evicts the least
+    recently used entry. Entries older than ttl seconds (counted from the last
+    time they were set) are treated as missing.
+
+    on_evict, if given, is called with the key of each entry evicted because
+    of the size bound (not of entries that expired).
+
+    """
+
+    def __init__(self, max_size, ttl, on_evict=None):
+        self.max_size = max_size
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.on_evict = on_evict
+
+        self._entries = OrderedDict() # key -> (set time, value)
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+
+            set_time, value = self._entries.pop(key)
+
+            if datetime.datetime.utcnow() - set_time >= self.ttl:
+                return default
+
+            # Move the key to the end (most recently used)
+            self._entries[key] = (set_time, value)
+
+            return value
+
+    def set(self, key, value):
+        evicted = []
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (datetime.datetime.utcnow(), value)
+
+            while len(self._entries) > self.max_size:
+                evicted_key, (set_time, evicted_value) = \
+                    self._entries.popitem(last=False)
+
+                if datetime.datetime.utcnow() - set_time < self.ttl:
+                    evicted.append(evicted_key)
+
+        if self.on_evict is not None:
+            for evicted_key in evicted:
+                self.on_evict(evicted_key)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+
+            return self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._entries)
+
+class JournalMirror(object):
+    """Process local mirror of the journal entries written by this process.
+
+    The mirror keeps, for each journal key, the (timestamp, action_log) tuples
+    this process logged, in the order they were logged, so the action logs
+    can be served without reading them back from redis.
+
+    If no other process logs actions with this process's server_id
+    (`exclusive`), then once the mirror was complete (no live entry was
+    evicted) for a full ttl, it holds every live journal entry of the server
+    and is authoritative, i.e. journals can be served from it alone.
+
+    The mirror also keeps the latest timestamp logged for each journal key (its
+    head), a compact index that lets authoritative mirrors tell which journals
+    don't need to be read at all (see consistent_sdb.fetch_journal_heads()).
+
+    Expired entries are dropped as entries are appended, and the entries of a
+    journal key are compacted into a single entry once there are more than
+    max_entries of them (see journal.compact_entries()), so frequently
+    changed items keep short journals in the mirror whatever the journal
+    backend does.
+
+    """
+
+    default_max_entries = 32
+
+    def __init__(self, max_size, ttl, exclusive=False, max_entries=default_max_entries):
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.exclusive = exclusive
+        self.max_entries = max_entries
+
+        self._journals = LRUCache(max_size, ttl, on_evict=self._on_evict)
+        self._heads = LRUCache(max_size, ttl, on_evict=self._on_evict)
+        self._lock = threading.Lock()
+
+        # The time since which the mirror holds all the entries logged by
+        # this process
+        self._complete_since = datetime.datetime.utcnow()
+
+    def _on_evict(self, journal_key):
+        # We lost live entries, the mirror is complete only from now on
+        self._complete_since = datetime.datetime.utcnow()
+
+    def is_authoritative(self):
+        if not self.exclusive or not self._journals.max_size:
+            return False
+
+        return datetime.datetime.utcnow() - self._complete_since >= self.ttl
+
+    def append(self, journal_key, timestamp, action_log):
+        if not self._journals.max_size:
+            return
+
+        now = datetime.datetime.utcnow()
+
+        # The entries lists are changed in place, readers copy them under the
+        # lock
+        with self._lock:
+            entries = self._journals.get(journal_key, [])
+
+            while entries and now - parse_timestamp(entries[0][0]) >= self.ttl:
+                del entries[0]
+
+            entries.append((timestamp, action_log))
+
+            if len(entries) > self.max_entries:
+                entries[:] = journal.compact_entries(entries)
+
+            self._journals.set(journal_key, entries)
+
+            head = self._heads.get(journal_key)
+            if head is None or parse_timestamp(head) < parse_timestamp(timestamp):
+                self._heads.set(journal_key, timestamp)
+
+    def head(self, journal_key):
+        """Returns the latest timestamp logged by this process for
+        journal_key, None if there's none or its ttl passed.
+
+        """
+
+        head = self._heads.get(journal_key)
+
+        if head is None or \
+           datetime.datetime.utcnow() - parse_timestamp(head) >= self.ttl:
+            return None
+
+        return head
+
+    def entries(self, journal_key, newer_than=None):
+        """Returns list of the (timestamp, action_log) tuples logged by this
+        process for journal_key, excluding those whose ttl passed, and if
+        newer_than (a timestamp) is given, those that aren't newer than it.
+
+        The entries are compacted like the journal backends' (see
+        journal.Journal.read()).
+
+        """
+
+        now = datetime.datetime.utcnow()
+
+        if newer_than is not None:
+            newer_than = parse_timestamp(newer_than)
+
+        with self._lock:
+            entries = list(self._journals.get(journal_key, []))
+
+        return [
+                (timestamp, action_log) for
+                (timestamp, action_log) in entries if
+                now - parse_timestamp(timestamp) < self.ttl and
+                (newer_than is None or newer_than < parse_timestamp(timestamp))
+               ]
+
+    def action_logs(self, journal_key):
+        """Returns dictionary of the action logs logged by this process for
+        journal_key, in which the keys are the actions' timestamps.
+
+        Entries the mirror compacted are left out, their action logs reflect
+        more than the action logged at their timestamp.
+
+        """
+
+        with self._lock:
+            return dict([
+                         (timestamp, action_log) for
+                         (timestamp, action_log) in self._journals.get(journal_key, []) if
+                         action_log['action'] != 'delta'
+                        ])
+
+    def clear(self):
+        self._journals.clear()
+        self._heads.clear()
+        self._complete_since = datetime.datetime.utcnow()
+
+class MemorySnapshotCache(object):
+    """Process local cache of items snapshots (see
+    consistent_sdb.snapshot_item_if_valid()), bounded by size and ttl.
+
+    Snapshots are copied when they're set and when they're read (as the
+    redis cache's pickles are), so the items the callers hold and change are
+    never the cached ones.
+
+    """
+
+    def __init__(self, max_size, ttl):
+        self._snapshots = LRUCache(max_size, ttl)
+
+    def get_many(self, keys):
+        return [copy.deepcopy(self._snapshots.get(key)) for key in keys]
+
+    def set_many(self, snapshots):
+        for key, snapshot in snapshots.items():
+            self._snapshots.set(key, copy.deepcopy(snapshot))
+
+class RedisSnapshotCache(object):
+    """Items snapshots cache kept (pickled) on a redis db of its own, shared by
+    all the processes, each snapshot expires ttl seconds after it was set.
+
+    """
+
+    def __init__(self, redis_db, ttl):
+        self.redis_db = redis_db
+        self.ttl = ttl
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+
+        return [
+                pickle.loads(str(snapshot)) if snapshot is not None else None for
+                snapshot in self.redis_db.mget(keys)
+               ]
+
+    def set_many(self, snapshots):
+        if not snapshots:
+            return
+
+        pipeline = self.redis_db.pipeline()
+        for key, snapshot in snapshots.items():
+            pipeline.set(key, pickle.dumps(snapshot))
+            pipeline.expire(key, self.ttl)
+        pipeline.execute()
@@ -0,0 +1,315 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Lazily created connections used by the consistent_sdb module
+
+Importing consistent_sdb doesn't connect to anything: the simpledb connection
+and the journal backend are created on first use, by a Client.
+
+A Client created in one process and used in a forked child re-creates its
+connections in the child, so pre-fork servers can import (and configure) the
+module once in the master and connect in each worker.
+
+"""
+
+import os
+import threading
+
+import redis
+
+import settings
+import cache
+import paths
+import concurrency
+import journal as journal_backends
+
+import aws_simpledb
+
+# Serializes the clients resets in a new process (see Client._check_process()),
+# it's taken only by the first calls made in each process
+_process_lock = threading.Lock()
+
+class Client(object):
+    """Holds the simpledb connection, the journal backend, the journal
+    mirror, the snapshot and select caches and the executor running the
+    module's asynchronous calls.
+
+    Every keyword argument overrides the settings module attribute of the
+    same name, e.g.:
+    Client(amazon_access_key_id='...', journal_backend='memory')
+    The consistent_sdb module reads all its settings through setting().
+
+    journal_mirror is the cache.JournalMirror used by the redis journal, a
+    new one is created if it isn't given.
+
+    """
+
+    def __init__(self, journal_mirror=None, **config):
+        for name in config:
+            if not hasattr(settings, name):
+                raise TypeError('Unknown setting: %s' % name)
+
+        self.config = config
+
+        # The mirror and the caches are process local and make no
+        # connections, so they're created right away
+        if journal_mirror is None:
+            # The mirror compacts journals no later than the journal backend
+            # (or than journal_max_entries), so the journals it serves never
+            # fail consistent_sdb.replay_is_safe() for their length
+            mirror_max_entries = min([
+                limit for limit in [
+                                    self.setting('journal_compaction_threshold'),
+                                    self.setting('journal_max_entries'),
+                                    cache.JournalMirror.default_max_entries
+                                   ] if
+                limit
+            ])
+
+            journal_mirror = cache.JournalMirror(
+                                                 self.setting('journal_mirror_size'),
+                                                 self.setting('journal_ttl'),
+                                                 self.setting('journal_mirror_exclusive'),
+                                                 mirror_max_entries
+                                                )
+
+        self.journal_mirror = journal_mirror
+        self.select_cache = cache.LRUCache(
+                                           self.setting('select_cache_size'),
+                                           self.setting('select_cache_ttl')
+                                          )
+
+        self._pid = None
+        # The client is shared by threads, the lock lets only one of them
+        # create each of its objects
+        self._lock = threading.Lock()
+
+    def setting(self, name):
+        if name in self.config:
+            return self.config[name]
+
+        return getattr(settings, name)
+
+    def _check_process(self):
+        # Connections created by a parent process can't be shared with it, we
+        # drop them (without closing, the parent still uses them)
+        if self._pid == os.getpid():
+            return
+
+        with _process_lock:
+            if self._pid == os.getpid(): # another thread reset the client
+                return
+
+            # The parent's threads might have held the lock while it forked
+            self._lock = threading.Lock()
+            self._connection = None
+            self._journal = None
+            self._snapshots = None
+            self._executor = None
+            self._journal_executor = None
+            self._requests_executor = None
+
+            # Set last, so the other threads wait for the reset to finish
+            self._pid = os.getpid()
+
+    @property
+    def connection(self):
+        self._check_process()
+
+        if self._connection is None:
+            with self._lock:
+                if self._connection is None:
+                    self._connection = aws_simpledb.SimpleDB(
+                                         self.setting('amazon_access_key_id'),
+                                         self.setting('amazon_secret_access_key'),
+                                         self.setting('amazon_db')
+                                        )
+
+        return self._connection
+
+    @property
+    def journal(self):
+        self._check_process()
+
+        if self._journal is None:
+            with self._lock:
+                if self._journal is None:
+                    self._journal = self._create_journal()
+
+        return self._journal
+
+    @property
+    def snapshots(self):
+        """The snapshot cache, None if it's disabled"""
+
+        self._check_process()
+
+        if self._snapshots is None:
+            with self._lock:
+                if self._snapshots is None:
+                    self._snapshots = self._create_snapshot_cache()
+
+        return self._snapshots
+
+    @property
+    def executor(self):
+        """The concurrency.Executor running the asynchronous calls (see
+        consistent_sdb.get_async()), its threads are started on first use.
+
+        """
+
+        self._check_process()
+
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = concurrency.Executor(self.setting('async_workers'))
+
+        return self._executor
+
+    @property
+    def journal_executor(self):
+        """The concurrency.Executor reading items journals in the background
+        (see consistent_sdb.get_item()), and, with the snapshot cache, the
+        items snapshots and simpledb states alongside them.
+
+        It's separate from executor: get() runs on executor's threads, and
+        would wait forever for journal reads queued behind calls like it.
+
+        """
+
+        self._check_process()
+
+        if self._journal_executor is None:
+            with self._lock:
+                if self._journal_executor is None:
+                    self._journal_executor = \
+                        concurrency.Executor(self.setting('journal_read_workers'))
+
+        return self._journal_executor
+
+    @property
+    def requests_executor(self):
+        """The concurrency.Executor sending the simpledb requests of a single
+        call concurrently (see consistent_sdb.put()), shared by all the calls
+        so they run up to max_concurrent_requests requests in total.
+
+        It's separate from executor for the same reason journal_executor is.
+
+        """
+
+        self._check_process()
+
+        if self._requests_executor is None:
+            with self._lock:
+                if self._requests_executor is None:
+                    self._requests_executor = \
+                        concurrency.Executor(self.setting('max_concurrent_requests'))
+
+        return self._requests_executor
+
+    def _create_snapshot_cache(self):
+        snapshot_cache = self.setting('snapshot_cache')
+
+        if snapshot_cache is None:
+            return None
+
+        if snapshot_cache == 'memory':
+            return cache.MemorySnapshotCache(
+                                             self.setting('snapshot_cache_size'),
+                                             self.setting('journal_ttl')
+                                            )
+
+        if snapshot_cache == 'redis':
+            return cache.RedisSnapshotCache(
+                       redis.Redis(connection_pool=self._redis_connection_pool(
+                           self.setting('snapshot_cache_redis_db')
+                       )),
+                       self.setting('journal_ttl')
+                   )
+
+        raise ValueError('Unknown snapshot cache: %s' % snapshot_cache)
+
+    def _create_journal(self):
+        journal_backend = self.setting('journal_backend')
+        journal_ttl = self.setting('journal_ttl')
+        compaction_threshold = self.setting('journal_compaction_threshold')
+        max_entries = self.setting('journal_max_entries')
+
+        if journal_backend == 'redis':
+            # Note: The need for db seperation is documented on
+            # consistent_sdb.random_journal_cleaning() docstring
+            return journal_backends.RedisJournal(
+                       redis.Redis(connection_pool=self._redis_connection_pool(
+                           self.setting('actions_journals_redis_db')
+                       )),
+                       redis.Redis(connection_pool=self._redis_connection_pool(
+                           self.setting('action_logs_redis_db')
+                       )),
+                       journal_ttl,
+                       self.journal_mirror,
+                       compaction_threshold,
+                       max_entries
+                   )
+
+        if journal_backend == 'memory':
+            return journal_backends.MemoryJournal(
+                                                 journal_ttl,
+                                                 compaction_threshold,
+                                                 max_entries
+                                                )
+
+        if journal_backend == 'file':
+            journal_file_path = self.setting('journal_file_path')
+            if journal_file_path is None:
+                journal_file_path = paths.private_path('journal')
+
+            return journal_backends.FileJournal(
+                                                journal_file_path,
+                                                journal_ttl,
+                                                compaction_threshold,
+                                                max_entries
+                                               )
+
+        raise ValueError('Unknown journal backend: %s' % journal_backend)
+
+    def _redis_connection_pool(self, db):
+        # All the redis dbs get pools with the same configuration (a redis
+        # connection is bound to a single db, so they can't share one pool).
+        # The pools are thread safe, and the client creates new ones after a
+        # fork.
+        pool_arguments = {
+                          'db': db,
+                          'max_connections': self.setting('redis_max_connections'),
+                          'timeout': self.setting('redis_pool_timeout'),
+                          'socket_timeout': self.setting('redis_socket_timeout')
+                         }
+
+        if self.setting('redis_unix_socket_path'):
+            pool_arguments['connection_class'] = redis.UnixDomainSocketConnection
+            pool_arguments['path'] = self.setting('redis_unix_socket_path')
+        else:
+            pool_arguments['host'] = self.setting('redis_host')
+            pool_arguments['port'] = self.setting('redis_port')
+            pool_arguments['socket_connect_timeout'] = \
+                self.setting('redis_socket_connect_timeout')
+
+        return redis.BlockingConnectionPool(**pool_arguments)
+
+class LazyProxy(object):
+    """Forwards attributes access to the object returned by calling factory,
+    which is called on each access (so it's up to factory to cache it).
+
+    """
+
+    def __init__(self, factory):
+        self.__dict__['_factory'] = factory
+
+    def __getattr__(self, name):
+        return getattr(self._factory(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._factory(), name, value)
+
+    def __repr__(self):
+        return '<LazyProxy of %r>' % self._factory()
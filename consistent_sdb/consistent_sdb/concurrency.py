@@ -0,0 +1,263 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Minimal threading helpers used to overlap simpledb and journal I/O
+
+"""
+
+import sys
+import time
+import Queue
+import atexit
+import weakref
+import threading
+
+from aws_simpledb import deadlines
+
+class Future(object):
+    """Holds the result of a call running in a background thread.
+
+    result() blocks until the call finishes, and returns its return value or
+    re-raises the exception it raised (with the original traceback).
+
+    Callbacks added with add_done_callback() are called with the future once
+    the call finishes, in the thread that ran it.
+
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._callbacks_lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            # A failing callback must not break the thread that finished the
+            # call, nor stop the other callbacks
+            pass
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) once the call finishes (right away if it
+        already did).
+
+        """
+
+        with self._callbacks_lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+
+        self._call(callback)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Blocks until the call finishes, without raising its exception"""
+
+        self._done.wait(timeout)
+
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        """Returns the exception raised by the call, or None if it succeeded"""
+
+        if not self.wait(timeout):
+            raise RuntimeError('Future result not available yet')
+
+        if self._exc_info is not None:
+            return self._exc_info[1]
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise RuntimeError('Future result not available yet')
+
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+def _run(future, function, args, kwargs):
+    try:
+        future.set_result(function(*args, **kwargs))
+    except BaseException:
+        future.set_exception(sys.exc_info())
+
+def _run_inherited(deadline_in_effect, future, function, args, kwargs):
+    # Calls run on other threads are bound by the caller's deadline (see
+    # aws_simpledb.deadlines)
+    with deadlines.inherited(deadline_in_effect):
+        _run(future, function, args, kwargs)
+
+def run_in_background(function, *args, **kwargs):
+    """Calls function(*args, **kwargs) in a daemon thread and returns a Future
+    for its result.
+
+    """
+
+    future = Future()
+
+    thread = threading.Thread(
+                              target=_run_inherited,
+                              args=(deadlines.current(), future, function, args, kwargs)
+                             )
+    thread.daemon = True
+    thread.start()
+
+    return future
+
+class Executor(object):
+    """Runs calls on a pool of up to max_workers daemon threads, which are
+    started on demand and kept for following calls. Calls submitted while all
+    the threads are busy wait for a free one.
+
+    The executors are shut down when the interpreter exits (see shutdown()),
+    so their threads don't run while the interpreter is torn down.
+
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+
+        self._calls = Queue.Queue()
+        self._workers = []
+        self._idle_workers = 0
+        self._shutdown = False
+        self._lock = threading.Lock()
+
+        _executors.add(self)
+
+    def submit(self, function, *args, **kwargs):
+        """Calls function(*args, **kwargs) on the pool and returns a Future
+        for its result.
+
+        """
+
+        future = Future()
+
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('Executor was shut down')
+
+            if self._idle_workers:
+                self._idle_workers -= 1
+            elif len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+
+                self._workers.append(worker)
+
+            self._calls.put((deadlines.current(), future, function, args, kwargs))
+
+        return future
+
+    def shutdown(self, timeout=None):
+        """Stops the threads once they ran the calls already submitted, and
+        waits up to timeout seconds (None for no limit) for them to stop.
+        Calls can't be submitted afterwards.
+
+        """
+
+        with self._lock:
+            self._shutdown = True
+            workers = self._workers
+
+            for worker in workers:
+                self._calls.put(None)
+
+        if timeout is not None:
+            expires = time.time() + timeout
+
+        for worker in workers:
+            if timeout is None:
+                worker.join()
+            else:
+                worker.join(max(expires - time.time(), 0))
+
+    def _work(self):
+        while True:
+            call = self._calls.get()
+            if call is None:
+                return
+
+            deadline_in_effect, future, function, args, kwargs = call
+
+            _run_inherited(deadline_in_effect, future, function, args, kwargs)
+
+            with self._lock:
+                self._idle_workers += 1
+
+# The executors created by the process, see _shutdown_executors()
+_executors = weakref.WeakSet()
+
+# Seconds the interpreter's exit waits for the executors' running calls
+shutdown_timeout = 1
+
+@atexit.register
+def _shutdown_executors():
+    # Daemon threads that still run while the interpreter is torn down print
+    # spurious tracebacks, the executors' idle threads are stopped before
+    for executor in list(_executors):
+        executor.shutdown(shutdown_timeout)
+
+def run_limited(executor, calls, max_concurrent):
+    """Runs calls, a list of (function, args) tuples, on executor (an
+    Executor), with at most max_concurrent of them running at a time, and
+    waits for all of them to finish.
+
+    Returns list of Futures, in calls order. A failed call doesn't stop the
+    others, check each future for its outcome.
+
+    """
+
+    slots = threading.Semaphore(max_concurrent)
+
+    futures = []
+    for function, args in calls:
+        slots.acquire()
+
+        future = executor.submit(function, *args)
+        future.add_done_callback(lambda future: slots.release())
+
+        futures.append(future)
+
+    for future in futures:
+        future.wait()
+
+    return futures
+
+def run_concurrently(executor, calls, max_concurrent):
+    """Same as run_limited(), but a single call runs in the calling thread.
+
+    """
+
+    if len(calls) == 1:
+        future = Future()
+
+        function, args = calls[0]
+        _run(future, function, args, {})
+
+        return [future]
+
+    return run_limited(executor, calls, max_concurrent)
@@ -7,28 +7,79 @@ Implements session consistency layer.
 
 """
 
-import datetime
-import redis
-import pickle
+import copy
+import itertools
+import threading
 
 import settings
 import status
+import concurrency
+import cache
+import janitor
+from client import Client, LazyProxy
+from timestamps import current_timestamp, parse_timestamp
+from journal import action_log_key, actions_journal_key
+from deltas import compose_actions, apply_delta
 from orderedset import OrderedSet
 
-import aws_simpledb
+from aws_simpledb import expression as select_expression
+from aws_simpledb import deadlines
+from aws_simpledb.deadlines import deadline, DeadlineExceeded
+from aws_simpledb.breaker import CircuitOpen
+from aws_simpledb.coalescing import SingleFlight
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
-connection = aws_simpledb.SimpleDB(
-                                   settings.amazon_access_key_id,
-                                   settings.amazon_secret_access_key,
-                                   settings.amazon_db
-                                  )
+# The items reads in flight, see get()
+get_flights = SingleFlight(lambda: status.increment('coalesced_gets'))
 
-journals_db = redis.Redis(db=settings.actions_journals_redis_db)
-logs_db = redis.Redis(db=settings.action_logs_redis_db)
-# Note: The need for db seperation is documented on random_journal_cleaning()
-# docstring
+# Items changes counters, see write_generation(). Incrementing isn't atomic,
+# a concurrent increment could otherwise be lost.
+write_generations = [0] * 1024
+write_generations_lock = threading.Lock()
+
+# The client holding the simpledb connection and the journal backend (see the
+# journal module), both are created on first use, see configure()
+_client = Client()
+
+def get_client():
+    """Returns the module's current client.Client (see configure())"""
+
+    return _client
+
+# The module's current client. It's a proxy rather than the Client itself, so
+# it stays current after configure() wherever it was imported to (e.g. the
+# consistent_sdb package).
+client = LazyProxy(get_client)
+
+def configure(**config):
+    """Replaces the module's client with one configured by config, which
+    overrides the settings module attributes of the same names, e.g.:
+    configure(amazon_access_key_id='...', journal_backend='file')
+
+    The module reads all its settings through the client (see
+    client.Client.setting()). The new client starts with an empty journal
+    mirror and select cache, no connection is made until the module is used.
+
+    """
+
+    global _client
+
+    _client = Client(**config)
+
+connection = LazyProxy(lambda: client.connection)
+journal = LazyProxy(lambda: client.journal)
+
+# The journal entries logged by this process, see log_actions() and
+# fetch_latest_actions_batch()
+journal_mirror = LazyProxy(lambda: client.journal_mirror)
+
+# Recent select() results, see select()
+select_cache = LazyProxy(lambda: client.select_cache)
+
+# The redis journal's dbs
+journals_db = LazyProxy(lambda: client.journal.journals_db)
+logs_db = LazyProxy(lambda: client.journal.logs_db)
 
 # DB ACTIONS:
 def delete(records):
@@ -63,34 +114,63 @@ def delete(records):
      'domain_B': {}
     }
 
+    Implementation Note: Items are deleted per domain with the sdb api
+    BatchDeleteAttributes command, in chunks of up to
+    connection.max_batch_items items, each chunk followed by a single
+    BatchPutAttributes of the items' last changed attribute.
+
+    If the deadline in effect (see aws_simpledb.deadlines) passes, the raised
+    DeadlineExceeded's partial lists the items that were deleted ('changed').
+
     """
 
-    for domain, items in records.items():
-        for item, attributes in items.items():
-            if not attributes:
-                connection.delete_attributes(domain, item)
-            else:
-                connection.delete_attributes(domain, item, attributes)
-
-            # log action
-            timestamp = current_timestamp()
-
-            # Write timestamp to the server's last changed attribute in
-            # simpledb
-            # and log the action on redis
-            connection.put_attributes(
-                                      domain,
-                                      item,
-                                      {
-                                       last_changed_attribute_key():
-                                       {
-                                        'values': [timestamp],
-                                        'replace': True
-                                       }
-                                      }
-                                     )
+    timestamp = current_timestamp()
 
-            log_action(domain, item, timestamp, 'delete', attributes)
+    # Each deleted item gets the server's last changed attribute, we write it
+    # with a batch put right after the item's batch delete
+    last_changed_attribute = {
+                              last_changed_attribute_key():
+                              {
+                               'values': [timestamp],
+                               'replace': True
+                              }
+                             }
+
+    # journal entries of the items simpledb already deleted, we log them all
+    # in a single pipeline
+    journal_entries = []
+
+    try:
+        for domain, items in records.items():
+            for chunk in split_to_chunks(items.keys(), connection.max_batch_items):
+                deadlines.check()
+
+                connection.batch_delete_attributes(
+                                                   domain,
+                                                   dict([
+                                                         (item, items[item]) for
+                                                         item in chunk
+                                                        ])
+                                                  )
+
+                connection.batch_put_attributes(
+                                                domain,
+                                                dict([
+                                                      (item, last_changed_attribute) for
+                                                      item in chunk
+                                                     ])
+                                               )
+
+                journal_entries.extend([
+                                        (domain, item, timestamp, 'delete', items[item]) for
+                                        item in chunk
+                                       ])
+    except DeadlineExceeded as error:
+        error.add_partial(changed=changed_items(journal_entries))
+        raise
+    finally:
+        # Log the changes simpledb performed even if a later chunk failed
+        log_actions(journal_entries)
 
 def put(records):
     """Add's items, attributes and values to simpledb.
@@ -148,37 +228,81 @@ def put(records):
                  }
     }
 
-    Implementation Note: If we change more than one item for domain, we use the
-    sdb api batch_put_attributes command otherwise we use PutAttributes
+    Implementation Note: Each domain's items are sent in chunks of up to
+    connection.max_batch_items items, using the sdb api BatchPutAttributes
+    command for chunks of more than one item and PutAttributes otherwise.
+    The chunks of all the domains are sent concurrently (up to
+    settings.max_concurrent_requests at a time).
+
+    If the deadline in effect (see aws_simpledb.deadlines) passes, the raised
+    DeadlineExceeded's partial lists the items that were put ('changed').
+
+    records isn't changed.
 
     """
 
     timestamp = current_timestamp()
 
-    # Add timestamp to the server's last changed attribute for each item we
-    # change (used later for journaling)
+    calls = []
+    # the journal entries of each call's chunk
+    calls_journal_entries = []
+
     for domain, items in records.items():
-        for item in items:
-            records[domain][item][last_changed_attribute_key()] = \
+        # Add timestamp to the server's last changed attribute for each item
+        # we change (used later for journaling), we add it to copies of the
+        # items' attributes to leave records as is.
+        marked_items = {}
+        for item, attributes in items.items():
+            marked_items[item] = dict(attributes)
+            marked_items[item][last_changed_attribute_key()] = \
                 {
                  'values': [timestamp],
                  'replace': True
                 }
 
-    for domain, items in records.items():
-        if len(items) > 1:
-            connection.batch_put_attributes(domain, items)
-        else:
-            # if there is single item, put its attributes using
-            # simpledb.put_attributes
-
-            item, attributes = items.items()[0]
-            connection.put_attributes(domain, item, attributes)
-
-        # delete the last changed attribute for all the items
-        for item, attributes in items.items():
-            del records[domain][item][last_changed_attribute_key()]
-            log_action(domain, item, timestamp, 'put', attributes)
+        for chunk in split_to_chunks(marked_items.keys(), connection.max_batch_items):
+            if len(chunk) > 1:
+                calls.append((
+                              connection.batch_put_attributes,
+                              (
+                               domain,
+                               dict([(item, marked_items[item]) for item in chunk])
+                              )
+                            ))
+            else:
+                # if there is single item, put its attributes using
+                # simpledb.put_attributes
+                calls.append((
+                              connection.put_attributes,
+                              (domain, chunk[0], marked_items[chunk[0]])
+                            ))
+
+            calls_journal_entries.append([
+                                          (domain, item, timestamp, 'put', items[item]) for
+                                          item in chunk
+                                         ])
+
+    futures = concurrency.run_concurrently(
+                                           client.requests_executor,
+                                           calls,
+                                           client.setting('max_concurrent_requests')
+                                          )
+
+    # Log only the chunks simpledb accepted
+    journal_entries = []
+    for future, chunk_journal_entries in zip(futures, calls_journal_entries):
+        if future.exception() is None:
+            journal_entries.extend(chunk_journal_entries)
+
+    log_actions(journal_entries)
+
+    # Raise the first failure, if any
+    for future in futures:
+        try:
+            future.result()
+        except DeadlineExceeded as error:
+            error.add_partial(changed=changed_items(journal_entries))
+            raise
 
 def get(records):
     """Get items, or specific attributes from records
@@ -188,6 +312,14 @@ def get(records):
     The function doesn't return the last changed attribute, to keep the
     journaling layer transperent for the user.
 
+    If settings.coalesce_gets is set, concurrent get()s of the same item (and
+    attributes) share a single read, each gets its own copy of the item. A
+    get() never shares the read of one that started before this process
+    changed the item (see write_generation()).
+
+    If the deadline in effect (see aws_simpledb.deadlines) passes, the raised
+    DeadlineExceeded's partial holds the items read so far ('result').
+
     Input:
     records structure:
     {
@@ -203,40 +335,269 @@ def get(records):
 
     result = {}
 
+    try:
+        get_items(records, result)
+    except DeadlineExceeded as error:
+        error.add_partial(result=result)
+        raise
+
+    return result
+
+def get_items(records, result):
+    # get()s the items of records into result
     for domain, items in records.items():
         result[domain] = {}
-        for item, attributes in items.items():
-            if attributes: # if attributes isn't empty add also the server's
-                           # last changed attribute (otherwise we'll get it
-                           # anyway)
-                attributes.append(last_changed_attribute_key())
+        for item, requested_attributes in items.items():
+            deadlines.check()
+
+            if client.setting('coalesce_gets'):
+                result[domain][item] = get_flights.do(
+                    (
+                     domain,
+                     item,
+                     tuple(requested_attributes or ()),
+                     write_generation(domain, item)
+                    ),
+                    get_item,
+                    domain,
+                    item,
+                    requested_attributes
+                )
+            else:
+                result[domain][item] = \
+                    get_item(domain, item, requested_attributes)
 
-            result[domain][item] = \
+def get_item(domain, item, requested_attributes):
+    """Returns the item's dictionary, or only its requested_attributes (all
+    of them if it's empty), see get().
+
+    """
+
+    attributes = requested_attributes
+    if attributes: # if attributes isn't empty add also the server's
+                   # last changed attribute (otherwise we'll get it
+                   # anyway)
+        attributes = list(attributes) + [last_changed_attribute_key()]
+
+    # The item's journal key doesn't depend on simpledb's response, so
+    # we read the journal while simpledb serves the item itself. Unless
+    # a snapshot might save the simpledb read (which depends on the
+    # entire journal), the journal's head is read first, and the journal
+    # itself only if the item has live entries (see fetch_live_actions()).
+    if client.snapshots is None:
+        simpledb_read = None
+
+        if client.setting('journal_head_check'):
+            latest_actions = client.journal_executor.submit(
+                                                            fetch_live_actions,
+                                                            domain,
+                                                            item
+                                                           )
+        else:
+            latest_actions = client.journal_executor.submit(
+                                                            fetch_latest_actions,
+                                                            domain,
+                                                            item
+                                                           )
+    else:
+        # The snapshot, the journal and simpledb's item are all read
+        # concurrently, a valid snapshot only drops the simpledb read (which
+        # is skipped if it didn't start yet), so a miss costs no more than
+        # reading without snapshots
+        latest_actions = client.journal_executor.submit(
+                                                        fetch_latest_actions,
+                                                        domain,
+                                                        item
+                                                       )
+        snapshot = client.journal_executor.submit(
+                                                  client.snapshots.get_many,
+                                                  [actions_journal_key(domain, item)]
+                                                 )
+        snapshot_hit = threading.Event()
+
+        def read_item():
+            if snapshot_hit.is_set():
+                return None
+
+            return connection.get_attributes(domain, item, attributes)
+
+        simpledb_read = client.journal_executor.submit(read_item)
+
+        snapshot_item = \
+            snapshot_item_if_valid(snapshot.result()[0], latest_actions.result())
+        if snapshot_item is not None:
+            snapshot_hit.set()
+
+            return select_attributes(snapshot_item, requested_attributes)
+
+    try:
+        if simpledb_read is None:
+            item_dictionary = \
                 connection.get_attributes(domain, item, attributes)
+        else:
+            item_dictionary = simpledb_read.result()
+    except CircuitOpen as error:
+        if not client.setting('serve_stale_when_circuit_open'):
+            raise
+
+        item_dictionary = local_item(domain, item)
+        if item_dictionary is None:
+            raise error
+
+        status.increment('stale_reads')
+
+        return select_attributes(item_dictionary, requested_attributes)
+    finally:
+        # Never leave the journal read running on the redis clients
+        # after we return
+        latest_actions.wait()
+
+    last_changed_attribute = \
+        item_dictionary.pop(last_changed_attribute_key(), None)
+
+    # Apply changes done on that item after its timestamp.
+    # Note: The following steps are taken only if changes to that item
+    # had been done by this layer, we indicate that by checking whether
+    # `last_changed_attribute` item has value, otherwise the journal
+    # we've read is dropped.
+    if last_changed_attribute:
+        timestamp = last_changed_attribute[0]
+        actions = latest_actions.result()
+
+        if replay_is_safe(timestamp, actions):
+            item_dictionary = \
+                apply_actions(
+                              item_dictionary,
+                              timestamp,
+                              actions
+                             )
+        else:
+            item_dictionary = consistent_get(domain, item, attributes)
+
+        # The entire item, after its journaled actions, is a known
+        # state the snapshots of following writes can be based on
+        if not requested_attributes and actions:
+            store_snapshots({
+                actions_journal_key(domain, item): {
+                    'timestamp': actions[-1][0],
+                    'previous': None,
+                    'item': dict(item_dictionary)
+                }
+            })
 
-            last_changed_attribute = \
-                result[domain][item][last_changed_attribute_key()]
+    return item_dictionary
 
-            # Apply changes done on that item after its timestamp.
-            # Note: The following steps are taken only if changes to that item
-            # had been done by this layer, we indicate that by checking whether
-            # `last_changed_attribute` item has value
-            if last_changed_attribute:
-                timestamp = last_changed_attribute[0]
+def select(output_list, domain_name, expression=None, sort_instructions=None, limit=None, correct_membership=None):
+    """Runs select query on simpledb and applies the latest actions on the
+    resulted items.
 
-                del result[domain][item][last_changed_attribute_key()]
+    Returns dictionary of the resulted items, in which the keys are the items
+    names. For the 'itemName()' and 'count(*)' output lists simpledb's results
+    are returned as is.
 
-                result[domain][item] = \
-                    apply_latest_actions(
-                                         domain,
-                                         item,
-                                         result[domain][item],
-                                         timestamp
-                                        )
-    
-    return result
+    If correct_membership is True (by default settings.select_membership_correction)
+    the items changed by this server are also matched locally, see
+    iter_corrected_select(). The 'count(*)' output list isn't corrected.
+
+    See iter_select() for a streaming version.
+
+    If the deadline in effect (see aws_simpledb.deadlines) passes during the
+    scan, the raised DeadlineExceeded's partial holds the items read so far
+    ('items') and the NextToken of the next simpledb page ('next_token').
+
+    If the select cache is enabled (settings.select_cache_size) results are
+    cached per query, along with the domain's journal version at the time
+    (see journal.Journal.domain_versions()). A cached result is used only
+    while the domain's version is unchanged, i.e. no changes were made to the
+    domain through this module since.
+
+    """
+
+    if correct_membership is None:
+        correct_membership = client.setting('select_membership_correction')
+
+    if not client.setting('select_cache_size'):
+        return _select(output_list, domain_name, expression, sort_instructions, limit, correct_membership)
+
+    cache_key = select_cache_key(output_list, domain_name, expression, sort_instructions, limit, correct_membership)
+
+    # We read the version before selecting, so a change made during the select
+    # invalidates its result
+    domain_version = journal.domain_versions([domain_name])[0]
+
+    cached_result = select_cache.get(cache_key)
+
+    if cached_result is not None and cached_result[0] == domain_version:
+        status.increment('select_cache_hits')
 
-def select(output_list, domain_name, expression=None, sort_instructions=None, limit=None):
+        return copy.deepcopy(cached_result[1])
+
+    results = _select(output_list, domain_name, expression, sort_instructions, limit, correct_membership)
+
+    select_cache.set(cache_key, (domain_version, copy.deepcopy(results)))
+
+    return results
+
+def _select(output_list, domain_name, expression, sort_instructions, limit, correct_membership=False):
+    if correct_membership and output_list == 'itemName()':
+        return [
+                {item_name: item_values} for
+                (item_name, item_values) in
+                iter_corrected_select(output_list, domain_name, expression, sort_instructions, limit)
+               ]
+
+    if output_list in ['itemName()', 'count(*)']:
+        return connection.select(output_list, domain_name, expression, sort_instructions, limit)
+
+    items = {}
+    try:
+        for item_name, item_values in iter_select(output_list, domain_name, expression, sort_instructions, limit, correct_membership):
+            items[item_name] = item_values
+    except DeadlineExceeded as error:
+        error.add_partial(items=items)
+        raise
+
+    return items
+
+def select_cache_key(output_list, domain_name, expression, sort_instructions, limit, correct_membership=False):
+    """Returns the select cache key of the query, queries that differ only in
+    the order of the output list attributes share a key.
+
+    """
+
+    if hasattr(output_list, '__iter__') and not isinstance(output_list, basestring):
+        output_list = tuple(sorted(set(output_list)))
+
+    if expression is not None:
+        expression = expression.strip()
+
+    if sort_instructions is not None:
+        sort_instructions = sort_instructions.strip()
+
+    return (output_list, domain_name, expression, sort_instructions, limit, correct_membership)
+
+def iter_select(output_list, domain_name, expression=None, sort_instructions=None, limit=None, correct_membership=None):
+    """Returns generator that yields (item_name, item_values) for each of the
+    select query results, after applying the latest actions on it.
+
+    Results are fetched from simpledb page by page, and the journals of all
+    the items of a page are read together, so memory use is bounded by the
+    page size.
+
+    If correct_membership is True (by default settings.select_membership_correction)
+    iter_corrected_select() is used instead.
+
+    """
+
+    if correct_membership is None:
+        correct_membership = client.setting('select_membership_correction')
+
+    if correct_membership and output_list not in ['itemName()', 'count(*)']:
+        return iter_corrected_select(output_list, domain_name, expression, sort_instructions, limit)
+
+    return _iter_select(output_list, domain_name, expression, sort_instructions, limit)
+
+def _iter_select(output_list, domain_name, expression, sort_instructions, limit):
     # If output_list holds attribute name but isn't compound type, we enclose
     # it in a list
     if not hasattr(output_list, '__iter__') or isinstance(output_list, basestring):
@@ -244,47 +605,362 @@ def select(output_list, domain_name, expression=None, sort_instructions=None, li
             output_list = [output_list]
 
     # If output_list is list it means it holds explicit list of attributes,
-    # we add to the list last_changed_attribute_key() in order to be to apply
+    # we add to it last_changed_attribute_key() in order to be to apply
     # the journaling later
     if hasattr(output_list, '__iter__'):
-        output_list.append(last_changed_attribute_key())
+        output_list = list(output_list) + [last_changed_attribute_key()]
 
-    results = connection.select(output_list, domain_name, expression, sort_instructions, limit)
+    pages = connection.select_pages(output_list, domain_name, expression, sort_instructions, limit)
 
-    if not output_list in ['itemName()', 'count(*)']:
+    for page in pages:
         # restructure the results to be more intuitive
-        _results = {}
+        page = [result.items()[0] for result in page]
 
-        for result in results:
-            item_name, item_values = result.items()[0]
-            _results[item_name] = item_values
+        if output_list in ['itemName()', 'count(*)']:
+            for item_name, item_values in page:
+                yield item_name, item_values
 
-        results = _results
+            continue
 
-        # if output_list isn't 'itemName()', 'count(*)' we apply the latest
-        # actions to the results.
-        for item_name, item_values in results.items():
-            last_changed_attribute = item_values[last_changed_attribute_key()]
+        # Items that were changed by this layer, i.e. have the last changed
+        # attribute
+        items_timestamps = {}
+        for item_name, item_values in page:
+            last_changed_attribute = \
+                item_values.pop(last_changed_attribute_key(), None)
 
-            # Apply changes done on that item after its timestamp.
-            # Note: The following steps are taken only if changes to that item
-            # had been done by this layer, we indicate that by checking whether
-            # `last_changed_attribute` item has value
             if last_changed_attribute:
-                timestamp = last_changed_attribute[0]
+                items_timestamps[item_name] = last_changed_attribute[0]
+
+        items_actions = \
+            fetch_latest_actions_batch(
+                                       domain_name,
+                                       items_timestamps.keys(),
+                                       items_timestamps
+                                      )
+
+        for item_name, item_values in page:
+            # Apply changes done on that item after its timestamp.
+            if item_name in items_timestamps:
+                if replay_is_safe(items_timestamps[item_name], items_actions[item_name]):
+                    item_values = \
+                        apply_actions(
+                                      item_values,
+                                      items_timestamps[item_name],
+                                      items_actions[item_name]
+                                     )
+                else:
+                    item_values = consistent_get(
+                        domain_name,
+                        item_name,
+                        output_list if output_list != '*' else None
+                    )
+
+            yield item_name, item_values
+
+def iter_corrected_select(output_list, domain_name, expression=None, sort_instructions=None, limit=None):
+    """Same as iter_select(), but items changed by this server are matched
+    against the query locally, after their latest actions, instead of relying
+    on simpledb's (possibly stale) view of them. i.e. items that match the
+    query only due to journaled actions are added to the results, and items
+    that no longer match it are dropped.
+
+    The items with live journal entries in the domain (see
+    journal.Journal.journaled_items()) are read with get() (which applies
+    their journals) and matched with aws_simpledb.expression. They are
+    yielded in their sort position (simpledb's results are already sorted),
+    or, without sort_instructions, where simpledb returned them (new matches
+    are yielded last).
+
+    All the items are yielded as defaultdict(OrderedSet), with only the output
+    list's attributes the item has (as simpledb's results).
+
+    limit is passed on to simpledb, which limits the size of each results
+    page, and is applied again on the corrected results: at most limit items
+    are yielded (the journaled matches might have made more of them).
+
+    """
 
-                del results[item_name][last_changed_attribute_key()]
+    results = _iter_corrected_select(output_list, domain_name, expression, sort_instructions, limit)
 
-                results[item_name] = \
-                    apply_latest_actions(
-                                         domain_name,
-                                         item_name,
-                                         results[item_name],
-                                         timestamp
-                                        )
+    if limit is not None:
+        results = itertools.islice(results, limit)
 
     return results
 
+def _iter_corrected_select(output_list, domain_name, expression, sort_instructions, limit):
+    matches = select_expression.compile_expression(expression)
+
+    sort = None
+    if sort_instructions is not None:
+        sort = select_expression.compile_sort(sort_instructions)
+
+    # The attributes to yield for each item, None for all of them
+    if output_list == '*':
+        attributes = None
+    elif output_list == 'itemName()':
+        attributes = []
+    elif not hasattr(output_list, '__iter__') or isinstance(output_list, basestring):
+        attributes = [output_list]
+    else:
+        attributes = list(output_list)
+
+    # The items simpledb returns are merged by their sort attribute, so we
+    # select it as well
+    selected_output_list = output_list
+    if attributes is not None:
+        selected_output_list = list(attributes)
+
+        if sort is not None and sort.attribute is not select_expression.ITEM_NAME and \
+           sort.attribute not in selected_output_list:
+            selected_output_list.append(sort.attribute)
+
+        if not selected_output_list:
+            selected_output_list = 'itemName()'
+
+    def output(item_name, item_values):
+        # Journaled items are read with get() and simpledb's items with
+        # select, both are yielded as the latter
+        if attributes is not None and not attributes:
+            return item_name, defaultdict(OrderedSet)
+
+        return item_name, select_attributes(item_values, attributes, include_missing=False)
+
+    journaled_items = journal.journaled_items(domain_name)
+
+    latest_items = {}
+    if journaled_items:
+        latest_items = get({
+                            domain_name: dict([
+                                               (item_name, []) for
+                                               item_name in journaled_items
+                                              ])
+                           })[domain_name]
+
+    # Items simpledb doesn't show yet (created by this server) are read without
+    # the last changed attribute, so get() doesn't apply their journals, we
+    # replay their entire journals instead. Deleted items are read as empty
+    # dictionaries either way.
+    empty_items = [
+                   item_name for (item_name, item_values) in latest_items.items() if
+                   not item_values
+                  ]
+
+    empty_items_actions = fetch_latest_actions_batch(domain_name, empty_items)
+    for item_name in empty_items:
+        if replay_is_safe(None, empty_items_actions[item_name]):
+            latest_items[item_name] = apply_actions(
+                                                    defaultdict(OrderedSet),
+                                                    None,
+                                                    empty_items_actions[item_name]
+                                                   )
+        else:
+            latest_items[item_name] = consistent_get(domain_name, item_name)
+
+    journaled_matches = [
+                         (item_name, item_values) for
+                         (item_name, item_values) in latest_items.items() if
+                         item_values and matches(item_name, item_values)
+                        ]
+
+    if sort is not None:
+        journaled_matches = sort(journaled_matches)
+
+    journaled_matches = OrderedDict(journaled_matches)
+
+    for item_name, item_values in _iter_select(
+                                               selected_output_list,
+                                               domain_name,
+                                               expression,
+                                               sort_instructions,
+                                               limit
+                                              ):
+        if sort is None:
+            # Journaled items are yielded in place if they still match
+            if item_name in journaled_items:
+                if item_name in journaled_matches:
+                    yield output(item_name, journaled_matches.pop(item_name))
+
+                continue
+
+            yield output(item_name, item_values)
+
+            continue
+
+        if item_name in journaled_items:
+            continue
+
+        # Journaled matches that are sorted before the item
+        key = sort.key(item_name, item_values)
+        while journaled_matches:
+            journaled_name, journaled_values = next(journaled_matches.iteritems())
+
+            if not sort.before(sort.key(journaled_name, journaled_values), key):
+                break
+
+            del journaled_matches[journaled_name]
+            yield output(journaled_name, journaled_values)
+
+        yield output(item_name, item_values)
+
+    for item_name, item_values in journaled_matches.items():
+        yield output(item_name, item_values)
+
+# ASYNC DB ACTIONS:
+# The following functions run the db actions on the client's executor (up to
+# settings.async_workers threads shared by the process) and return a
+# concurrency.Future of the action's result, so a single thread can keep many
+# actions in flight. The records structures and the journal overlay are the
+# same as the synchronous actions'.
+#
+# Event loops can wait for the actions through Future.add_done_callback(),
+# the callback runs in the executor's thread, so it should only hand the
+# future over to the loop.
+def get_async(records):
+    """Same as get(), returns a concurrency.Future of its result"""
+
+    return client.executor.submit(get, records)
+
+def put_async(records):
+    """Same as put(), returns a concurrency.Future of its result"""
+
+    return client.executor.submit(put, records)
+
+def delete_async(records):
+    """Same as delete(), returns a concurrency.Future of its result"""
+
+    return client.executor.submit(delete, records)
+
+def select_async(output_list, domain_name, expression=None, sort_instructions=None, limit=None, correct_membership=None):
+    """Same as select(), returns a concurrency.Future of its result"""
+
+    return client.executor.submit(
+                                  select,
+                                  output_list,
+                                  domain_name,
+                                  expression,
+                                  sort_instructions,
+                                  limit,
+                                  correct_membership
+                                 )
+
+# BULK DB ACTIONS:
+# The following functions split their records to parts, run the synchronous
+# action of each part on the client's executor (up to max_concurrency parts of
+# the call at a time, settings.bulk_max_concurrency by default) and wait for
+# all of them. A failed part doesn't stop the others, once all finished the
+# failures are raised together, see BulkActionError.
+class BulkActionError(Exception):
+    """Raised by the bulk actions if some of their parts failed.
+
+    failures is list of (records, exception) tuples, records are the failed
+    part's records. result is the result of the parts that succeeded (for
+    bulk_get(), None for the others).
+
+    """
+
+    def __init__(self, failures, result=None):
+        Exception.__init__(
+                           self,
+                           '%d bulk action parts failed, first failure: %r' %
+                           (len(failures), failures[0][1])
+                          )
+
+        self.failures = failures
+        self.result = result
+
+    def __reduce__(self):
+        # Exceptions are unpickled by calling their class with their args,
+        # which hold only the message (the sidecar pickles bulk actions'
+        # errors)
+        return (self.__class__, (self.failures, self.result))
+
+def bulk_get(records, max_concurrency=None):
+    """Same as get(), each item is read by a separate part.
+
+    If some items couldn't be read, the raised BulkActionError's result holds
+    the items that were.
+
+    """
+
+    parts = [
+             {domain: {item: attributes}} for
+             domain, items in records.items() for
+             item, attributes in items.items()
+            ]
+
+    results, failures = run_bulk(get, parts, max_concurrency)
+
+    result = dict([(domain, {}) for domain in records])
+    for part_result in results:
+        for domain, items in part_result.items():
+            result[domain].update(items)
+
+    if failures:
+        raise BulkActionError(failures, result)
+
+    return result
+
+def bulk_put(records, max_concurrency=None):
+    """Same as put(), each part puts a single chunk of up to
+    connection.max_batch_items items of a domain (a single simpledb request).
+
+    """
+
+    results, failures = run_bulk(put, batch_parts(records), max_concurrency)
+
+    if failures:
+        raise BulkActionError(failures)
+
+def bulk_delete(records, max_concurrency=None):
+    """Same as delete(), each part deletes a single chunk of up to
+    connection.max_batch_items items of a domain.
+
+    """
+
+    results, failures = run_bulk(delete, batch_parts(records), max_concurrency)
+
+    if failures:
+        raise BulkActionError(failures)
+
+def batch_parts(records):
+    # Splits records to parts of up to connection.max_batch_items items of a
+    # single domain
+    return [
+            {domain: dict([(item, items[item]) for item in chunk])} for
+            domain, items in records.items() for
+            chunk in split_to_chunks(items.keys(), connection.max_batch_items)
+           ]
+
+def run_bulk(action, parts, max_concurrency=None):
+    """Runs action(part) for each of parts on the client's executor, see the
+    bulk actions above.
+
+    Returns (results, failures) tuple: results is list of the results of the
+    parts that succeeded, failures is list of (part, exception) tuples of the
+    parts that failed.
+
+    """
+
+    if max_concurrency is None:
+        max_concurrency = client.setting('bulk_max_concurrency')
+
+    futures = concurrency.run_limited(
+                                      client.executor,
+                                      [(action, (part,)) for part in parts],
+                                      max_concurrency
+                                     )
+
+    results = []
+    failures = []
+    for part, future in zip(parts, futures):
+        if future.exception() is None:
+            results.append(future.result())
+        else:
+            failures.append((part, future.exception()))
+
+    return results, failures
+
 # LOCAL ACTIONS:
 # The following functions implements the delete and put actions on a
 # dictionary of sets. i.e. simulate the result of sdb actions performed on
@@ -383,7 +1059,9 @@ def dict_put(dictionary, records):
         else:
             strict_dictionary[attribute] = \
                 OrderedSet(strict_dictionary[attribute])
-            strict_dictionary[attribute].union(values)
+            # OrderedSet.union() returns a new set, we add the values in place
+            for value in values:
+                strict_dictionary[attribute].add(value)
 
     return strict_dictionary
 
@@ -397,39 +1075,75 @@ def dict_put(dictionary, records):
 #
 # The way journaling works:
 # After each change done on simpledb a call to log_action has to be performed.
-# log_action adds the change timestamp to a list on redis unique for that item
-# and also creates record unique to the item and the timestamp with the action
-# performed.
+# log_action logs the change on the journal backend (see the journal module),
+# which keeps for each item the actions performed on it with their
+# timestamps, for settings.journal_ttl seconds.
 # TODO documentation needs work
 def log_action(domain, item, timestamp, action, attributes=None):
     """This function should be called after each change on simpledb.
 
-    It logs the change on redis.
+    It logs the change on the journal.
 
     """
 
-    action_log = pickle.dumps({
-                  'action': action,
-                  'attributes': attributes
-                 })
+    log_actions([(domain, item, timestamp, action, attributes)])
 
-    logs_db.set(action_log_key(domain, item, timestamp), action_log)
+def log_actions(entries):
+    """Logs on the journal a list of changes performed on simpledb, each entry
+    is a tuple with log_action()'s arguments:
+    (domain, item, timestamp, action, attributes)
 
-    # expire after it safe to assume that simpledb will be consistent for that
-    # action
-    logs_db.expire(
-                   action_log_key(domain, item, timestamp),
-                   settings.journal_ttl
-                  )
+    All the entries are written together (with the redis journal, a single
+    pipeline for each redis db).
 
-    # Add the timestamp to the list represents the item's actions journal.
-    #
-    # we use the item's journal list to store only the timestamps, and not the
-    # entire action logs, to avoid the need to pickle each action item to find
-    # it's timestamp (reduce cpu) and to be able to apply the redis command
-    # `expire` on the action log key, something we can't do on list items
-    # (reduce memory usage)
-    journals_db.push(actions_journal_key(domain, item), timestamp)
+    """
+
+    if not entries:
+        return
+
+    journal_entries = [
+                       (
+                        domain,
+                        item,
+                        timestamp,
+                        {
+                         'action': action,
+                         'attributes': attributes
+                        }
+                       ) for
+                       (domain, item, timestamp, action, attributes) in entries
+                      ]
+
+    journal.append(journal_entries)
+
+    update_snapshots(entries)
+
+    # The mirror keeps copies, independent of the caller's attributes, just
+    # as if they were read back from the journal
+    for domain, item, timestamp, action_log in journal_entries:
+        journal_mirror.append(
+                              actions_journal_key(domain, item),
+                              timestamp,
+                              copy.deepcopy(action_log)
+                             )
+
+    # Reads that start from now on reflect the changes, they must not share
+    # reads that started before
+    with write_generations_lock:
+        for domain, item, timestamp, action_log in journal_entries:
+            write_generations[write_generation_index(domain, item)] += 1
+
+def write_generation(domain, item):
+    """Returns a counter that changes whenever this process logs a change of
+    the item (items share counters, so it might change on changes of other
+    items as well).
+
+    """
+
+    return write_generations[write_generation_index(domain, item)]
+
+def write_generation_index(domain, item):
+    return hash((domain, item)) % len(write_generations)
 
 def apply_latest_actions(domain, item_name, item_dictionary, item_timestamp):
     """Go over the actions log and look for actions performed on item after
@@ -440,55 +1154,239 @@ def apply_latest_actions(domain, item_name, item_dictionary, item_timestamp):
 
     """
 
-    item_datetime = parse_timestamp(item_timestamp)
+    return apply_actions(
+                         item_dictionary,
+                         item_timestamp,
+                         fetch_latest_actions(domain, item_name)
+                        )
 
-    item_journal =\
-        journals_db.lrange(actions_journal_key(domain, item_name), 0, -1)
+def fetch_latest_actions(domain, item_name):
+    """Returns the item's journal as a list of (timestamp, action_log) tuples,
+    in the order the actions were performed.
 
-    action_log_ttl = datetime.timedelta(seconds=settings.journal_ttl)
+    Expired journal entries are deleted from the journal and left out of the
+    result.
 
-    # Go over the item's journal delete entries we find expired, apply on
-    # item_dictionary those that made after its timestamp
-    for timestamp in item_journal:
-        log_entry_datetime = parse_timestamp(timestamp)
+    The journal doesn't depend on the item's timestamp, so this function can
+    be called before (or while) the item is read from simpledb.
 
-        # If the entry ttl passed delete it
-        if datetime.datetime.utcnow() - log_entry_datetime >= action_log_ttl:
-            journals_db.lrem(actions_journal_key(domain, item_name), timestamp, 1)
-            continue
+    """
 
-        if item_datetime < log_entry_datetime:
-            action_log = pickle.loads(
-                str(logs_db.get(action_log_key(domain, item_name, timestamp)))
-            )
+    return fetch_latest_actions_batch(domain, [item_name])[item_name]
 
-            if action_log['action'] == 'delete':
-                item_dictionary =\
-                    dict_delete(item_dictionary, action_log['attributes'])
+def fetch_live_actions(domain, item_name):
+    """Same as fetch_latest_actions(), but reads the item's journal head (see
+    fetch_journal_heads()) first, and returns an empty list without reading
+    the journal if the item has no live journal entries.
 
-            if action_log['action'] == 'put':
-                item_dictionary =\
-                    dict_put(item_dictionary, action_log['attributes'])
+    Like fetch_latest_actions() it doesn't depend on the item's timestamp, so
+    both the head and the journal are read while simpledb serves the item.
 
-            status.latest_changes_applied += 1
+    """
 
-    return item_dictionary
+    if fetch_journal_heads(domain, [item_name])[item_name] is None:
+        status.increment('journal_reads_skipped')
+        return []
+
+    return fetch_latest_actions(domain, item_name)
+
+def fetch_latest_actions_batch(domain, item_names, newer_than=None, heads=None):
+    """Same as fetch_latest_actions() for a list of items of a single domain.
+    Returns dictionary in which the keys are the items names.
+
+    newer_than, if given, is a dictionary of items names and timestamps, for
+    the items in it, only actions newer than the timestamp are returned. If
+    settings.journal_head_check is set, the journals of items whose journal
+    head (see fetch_journal_heads(), heads can be given if they were already
+    fetched) isn't newer than their timestamp aren't read at all.
+
+    The journals of all the items are read together (with the redis journal,
+    a single pipeline for the journals, and a single MGET for their action
+    logs).
 
-def action_log_key(domain, item, timestamp):
-    """Returns the redis key for the action log for the action performed on
-    item in timestamp
-    
     """
 
-    return domain + ':' + item + ':' + timestamp
+    if not item_names:
+        return {}
+
+    if newer_than and client.setting('journal_head_check'):
+        if heads is None:
+            heads = fetch_journal_heads(domain, [
+                                                 item_name for item_name in item_names if
+                                                 item_name in newer_than
+                                                ])
+
+        current_items = set([
+                             item_name for item_name in item_names if
+                             item_name in newer_than and
+                             item_name in heads and
+                             journal_is_current(newer_than[item_name], heads[item_name])
+                            ])
+
+        if current_items:
+            status.increment('journal_reads_skipped', len(current_items))
+
+            result = dict([(item_name, []) for item_name in current_items])
+            result.update(fetch_latest_actions_batch(
+                                                     domain,
+                                                     [
+                                                      item_name for item_name in item_names if
+                                                      item_name not in current_items
+                                                     ],
+                                                     newer_than,
+                                                     heads=heads
+                                                    ))
+            return result
+
+    # If the journal mirror holds all the live journal entries of this server
+    # we don't need to read the journal at all
+    if journal_mirror.is_authoritative():
+        return dict([
+                     (
+                      item_name,
+                      journal_mirror.entries(
+                                             actions_journal_key(domain, item_name),
+                                             (newer_than or {}).get(item_name)
+                                            )
+                     ) for
+                     item_name in item_names
+                    ])
+
+    return journal.read(domain, item_names, newer_than)
+
+def fetch_journal_heads(domain, item_names):
+    """Returns dictionary in which the keys are item_names and the values are
+    the latest timestamps journaled for the items (None for items without
+    live journal entries), see journal.Journal.heads().
+
+    If the journal mirror is authoritative, the heads are taken from it
+    without reading the journal.
+
+    """
+
+    if journal_mirror.is_authoritative():
+        return dict([
+                     (item_name, journal_mirror.head(actions_journal_key(domain, item_name))) for
+                     item_name in item_names
+                    ])
+
+    return journal.heads(domain, item_names)
+
+def journal_is_current(item_timestamp, head):
+    """Returns whether an item of item_timestamp already reflects all the
+    actions journaled for it, given its journal head.
+
+    """
+
+    return head is None or parse_timestamp(head) <= parse_timestamp(item_timestamp)
+
+def apply_actions(item_dictionary, item_timestamp, actions):
+    """Performs on item_dictionary the actions (as returned by
+    fetch_latest_actions()) that were made after item_timestamp (all of them
+    if item_timestamp is None), as if they were performed in order, and
+    returns it.
+
+    The actions are composed into a single delta (see the deltas module),
+    which is applied on item_dictionary in place, so each changed attribute is
+    rebuilt once, however many actions changed it.
+
+    """
+
+    item_datetime = None
+    if item_timestamp is not None:
+        item_datetime = parse_timestamp(item_timestamp)
+
+    action_logs = [
+                   action_log for (timestamp, action_log) in actions if
+                   item_datetime is None or item_datetime < parse_timestamp(timestamp)
+                  ]
+
+    if not action_logs:
+        return item_dictionary
+
+    status.increment('latest_changes_applied', len(action_logs))
+
+    return apply_delta(item_dictionary, compose_actions(action_logs))
+
+def replay_is_safe(item_timestamp, actions):
+    """Returns whether applying actions (as returned by fetch_latest_actions())
+    on an item of item_timestamp (None for an item whose state precedes all
+    the actions) brings it up to date, within the replay bound.
+
+    It isn't if the item's journal was truncated after item_timestamp (some of
+    the actions the item doesn't reflect were dropped), or if more than
+    settings.journal_max_entries actions are newer than item_timestamp.
+
+    """
+
+    if item_timestamp is not None:
+        item_datetime = parse_timestamp(item_timestamp)
+        actions = [
+                   (timestamp, action_log) for (timestamp, action_log) in actions if
+                   item_datetime < parse_timestamp(timestamp)
+                  ]
+
+    max_entries = client.setting('journal_max_entries')
+    if max_entries and len(actions) > max_entries:
+        return False
+
+    for timestamp, action_log in actions:
+        if action_log['action'] == 'truncated':
+            return False
+
+    return True
+
+def consistent_get(domain, item_name, attributes=None):
+    """Reads the item (or only the given attributes) with a ConsistentRead
+    GetAttributes, for items that replay_is_safe() rejected, and returns it
+    without the last changed attribute.
 
-def actions_journal_key(domain, item):
-    """Returns the redis key that holds the timestamps list for the actions log
-    available for item in redis. (the item's action journal)
-    
     """
 
-    return domain + ':' + item
+    status.increment('consistent_read_fallbacks')
+
+    item_dictionary = \
+        connection.get_attributes(domain, item_name, attributes, consistent_read=True)
+
+    item_dictionary.pop(last_changed_attribute_key(), None)
+
+    return item_dictionary
+
+def local_item(domain, item):
+    """Returns the item's latest state known without simpledb, None if
+    there's none: its snapshot with the following journaled actions applied
+    (see SNAPSHOTS), or its journal alone if the journal begins with the
+    deletion of the entire item.
+
+    Used to serve items while simpledb is unavailable (see
+    settings.serve_stale_when_circuit_open), the result might miss changes
+    that weren't made by this server.
+
+    """
+
+    actions = fetch_latest_actions(domain, item)
+
+    snapshot = None
+    if client.snapshots is not None:
+        snapshot = client.snapshots.get_many([actions_journal_key(domain, item)])[0]
+
+    if snapshot is not None:
+        if not replay_is_safe(snapshot['timestamp'], actions):
+            return None
+
+        return apply_actions(
+                             snapshot['item'],
+                             snapshot['timestamp'],
+                             actions
+                            )
+
+    cleared, attributes_deltas = \
+        compose_actions([action_log for (timestamp, action_log) in actions])
+
+    if not cleared:
+        return None
+
+    return apply_delta({}, (cleared, attributes_deltas))
 
 def last_changed_attribute_key():
     """For each change we do on an item using this module we save the change
@@ -501,68 +1399,232 @@ def last_changed_attribute_key():
 
     """
 
-    return 'last_changed::' + settings.server_id
+    return 'last_changed::' + client.setting('server_id')
 
 def random_journal_cleaning():
     """Picks random action journal and deletes records from it.
     Records expiry time is determined by settings.journal_ttl. 
 
-    It is impossible to set ttl for specific redis list item (redis 1.2), so
-    inorder to keep the redis size as small as needed, for efficiancy and
-    disksize saving we use this function from time to time to delete unneeded
-    records.
+    It is impossible to set ttl for specific redis list item (redis 1.2), and
+    the local journals have no expiry mechanism of their own, so inorder to
+    keep the journal size as small as needed, for efficiancy and disksize
+    saving we use this function from time to time to delete unneeded records.
 
-    Note 1: apply_latest_actions() deletes expired records in the item's
-    journal it was called for.
+    Note 1: with the redis journal, apply_latest_actions() deletes expired
+    records in the item's journal it was called for.
     Note 2: setting ttl for general redis item is possible, so we didn't had to
     write function that does the same for action logs.
     Note 3: to be able to use redis random command and know for sure we
     received actions journal we seperate the action journals db from the
     actions journals db
+    Note 4: this function isn't called automatically, the janitor module
+    sweeps all the journals in the background (see start_janitor()).
 
     """
 
-    randomkey = journals_db.randomkey()
+    journal_key = journal.random_journal_key()
 
-    # if empty key name returned (most probably means there are no keys) we
-    # don't do anything
-    if not randomkey:
+    # if no key returned (most probably means there are no journals) we don't
+    # do anything
+    if not journal_key:
         return
 
-    item_journal = journals_db.lrange(randomkey, 0, -1)
-    action_log_ttl = datetime.timedelta(seconds=settings.journal_ttl)
+    status.increment('random_expired_items_deletes', journal.expire([journal_key]))
+
+def warmup(connections=None):
+    """Opens simpledb connections ahead of the first requests, see
+    aws_simpledb.SimpleDB.warmup(). Returns the amount of connections opened.
+
+    """
+
+    return connection.warmup(connections)
+
+def start_janitor(journals_per_tick=None, tick_interval=None):
+    """Starts a background thread that sweeps the journals and deletes their
+    expired entries (see the janitor module), returns the janitor.Janitor
+    thread (call its stop() to stop it).
+
+    """
+
+    if journals_per_tick is None:
+        journals_per_tick = client.setting('janitor_journals_per_tick')
+
+    if tick_interval is None:
+        tick_interval = client.setting('janitor_tick_interval')
+
+    journal_janitor = janitor.Janitor(journal, journals_per_tick, tick_interval)
+    journal_janitor.start()
+
+    return journal_janitor
+
+# SNAPSHOTS:
+# When the snapshot cache is enabled (settings.snapshot_cache) we keep for
+# items changed by this server their full state after the change, whenever
+# the state before the change is known: after deleting an entire item, after
+# changing an item we have a snapshot of, or after reading an entire item
+# that has journaled actions.
+#
+# get() answers from a snapshot without reading simpledb, as long as the
+# snapshot reflects all the item's journaled actions.
+#
+# Note: Snapshots don't reflect changes made by other servers, those become
+# visible once the snapshot expires (after settings.journal_ttl) or the item is
+# changed through a get() that reads simpledb.
+#
+# Snapshot structure:
+# {
+#  'timestamp': # the timestamp of the journal entry the snapshot reflects
+#  'previous': # the timestamp of the snapshot it was computed from, or None
+#  'item': # the item's dictionary
+# }
+def snapshot_item_if_valid(snapshot, actions):
+    """Returns the item's dictionary from its snapshot (None if it has none)
+    if the snapshot reflects all the actions journaled for the item, actions
+    as returned by fetch_latest_actions(), otherwise None.
+
+    The snapshot reflects all the journaled actions if its entry is the
+    item's newest journal entry, and, if it was computed from an older
+    snapshot, the older snapshot's entry is the one right before it (otherwise
+    an action the snapshot doesn't reflect was journaled between them).
+
+    Once the journal compacts the snapshot's entry (see
+    journal.compact_entries()) the entries before it are merged into it, so
+    the snapshot is brought up to date by applying the merged delta instead:
+    it has the same result on an item that already reflects some of the
+    merged actions (see the deltas module), unless the journal was truncated.
+
+    """
+
+    if snapshot is None or not actions:
+        return None
+
+    timestamps = [timestamp for (timestamp, action_log) in actions]
+    newest_action_log = actions[-1][1]
 
-    # delete entries we find expired
-    for timestamp in item_journal:
-        log_entry_datetime = parse_timestamp(timestamp)
+    if timestamps[-1] != snapshot['timestamp']:
+        return None
 
-        # If the entry ttl passed delete it
-        if datetime.datetime.utcnow() - log_entry_datetime >= action_log_ttl:
-            journals_db.lrem(randomkey, timestamp, 1)
-            status.random_expired_items_deletes += 1
+    if newest_action_log['action'] == 'delta':
+        if not replay_is_safe(None, actions):
+            return None
+
+        status.increment('snapshot_cache_hits')
+
+        return apply_delta(
+                           dict(snapshot['item']),
+                           compose_actions([newest_action_log])
+                          )
+
+    if snapshot['previous'] is not None:
+        if len(timestamps) > 1:
+            if timestamps[-2] != snapshot['previous']:
+                return None
+        # The previous entry isn't in the journal, that's fine only if it
+        # expired
+        elif not journal.is_expired(snapshot['previous']):
+            return None
+
+    status.increment('snapshot_cache_hits')
+
+    return snapshot['item']
+
+def update_snapshots(entries):
+    """Updates the snapshots of the items changed by entries (see
+    log_actions()) whose state before the change is known.
+
+    """
+
+    snapshots = client.snapshots
+
+    if snapshots is None:
+        return
+
+    journal_keys = [
+                    actions_journal_key(domain, item) for
+                    (domain, item, timestamp, action, attributes) in entries
+                   ]
+
+    previous_snapshots = dict(zip(journal_keys, snapshots.get_many(journal_keys)))
+
+    new_snapshots = {}
+    for journal_key, (domain, item, timestamp, action, attributes) in zip(journal_keys, entries):
+        # Deleting an entire item doesn't depend on its previous state
+        if action == 'delete' and not attributes:
+            new_snapshots[journal_key] = {
+                                          'timestamp': timestamp,
+                                          'previous': None,
+                                          'item': {}
+                                         }
+            continue
+
+        previous_snapshot = \
+            new_snapshots.get(journal_key, previous_snapshots[journal_key])
+
+        if previous_snapshot is None:
+            continue
+
+        if action == 'delete':
+            item_dictionary = dict_delete(previous_snapshot['item'], attributes)
+        else:
+            item_dictionary = dict_put(previous_snapshot['item'], attributes)
+
+        new_snapshots[journal_key] = {
+                                      'timestamp': timestamp,
+                                      'previous': previous_snapshot['timestamp'],
+                                      'item': dict(item_dictionary)
+                                     }
+
+    store_snapshots(new_snapshots)
+
+def store_snapshots(new_snapshots):
+    snapshots = client.snapshots
+
+    if snapshots is not None and new_snapshots:
+        snapshots.set_many(new_snapshots)
 
 # Helpers:
-def current_timestamp():
-    """Returns a string representing the current date and time in ISO 8601
-    
-    All the timestamps in this module are in the UTC tz.
+def select_attributes(item_dictionary, attributes, include_missing=True):
+    """Returns a copy of item_dictionary with only the given attributes (all
+    the attributes if attributes is empty), structured as
+    connection.get_attributes() results: the given attributes the item
+    doesn't have hold empty sets, unless include_missing is False (as in
+    select results).
 
     """
 
-    return datetime.datetime.utcnow().isoformat()
+    result = defaultdict(OrderedSet)
+
+    for attribute, values in item_dictionary.items():
+        if not attributes or attribute in attributes:
+            result[attribute] = OrderedSet(values)
+
+    for attribute in (attributes or []):
+        if include_missing and attribute not in result:
+            result[attribute] = OrderedSet()
+
+    return result
+
+def changed_items(journal_entries):
+    """Returns dictionary of the domains of journal_entries (see
+    log_actions()) and lists of their items.
 
-def parse_timestamp(timestamp):
-    """Get ISO 8601 string of the format:"%Y-%m-%dT%H:%M:%S.%f" and returns
-    datetime.datetime object set according to this string
-    
     """
 
-    format = "%Y-%m-%dT%H:%M:%S.%f"
+    items = defaultdict(list)
+    for domain, item, timestamp, action, attributes in journal_entries:
+        items[domain].append(item)
+
+    return dict(items)
+
+def split_to_chunks(sequence, chunk_size):
+    """Returns list of lists, each holds up to chunk_size consecutive items of
+    sequence
+
+    """
 
-    return datetime.datetime.strptime(timestamp, format)
+    sequence = list(sequence)
 
-# We perform cleaning on some random actions journal on each load of this
-# module.
-# See random_journal_cleaning() docstring: 
-for i in range(settings.random_journal_cleans):
-    random_journal_cleaning()
+    return [
+            sequence[i:i + chunk_size] for
+            i in range(0, len(sequence), chunk_size)
+           ]
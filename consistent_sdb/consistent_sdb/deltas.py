@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Composition of action logs into deltas
+
+A sequence of action logs (see consistent_sdb.log_action()) is composed into a
+single delta with the same effect as performing the actions in order, so
+replaying a journal rebuilds each changed attribute once (see
+consistent_sdb.apply_actions()).
+
+A delta is (cleared, attributes_deltas): cleared is whether the entire item is
+deleted before the attributes_deltas apply, and attributes_deltas is
+dictionary in which the keys are the changed attributes and the values are
+(absolute, removed, added) tuples. An absolute delta sets the attribute's
+values to `added`, otherwise the `removed` values are removed from the
+attribute and the `added` values are added to it.
+
+Applying a delta on an item that already reflects some of the composed actions
+has the same result as applying it on the item before them, which lets the
+journal compact entries into a single 'delta' action log (see
+delta_action_log()).
+
+"""
+
+from orderedset import OrderedSet
+
+def action_operations(action_log):
+    """Returns list of the (operation, attribute, values) tuples an action log
+    performs, in order. operation is one of 'clear' (delete the entire item),
+    'set', 'add' and 'remove'.
+
+    Journal truncation markers ('truncated' action logs) perform nothing.
+
+    """
+
+    records = action_log['attributes'] or {}
+    operations = []
+
+    if action_log['action'] == 'delete':
+        if not records:
+            return [('clear', None, None)]
+
+        for attribute, values in records.items():
+            if values:
+                operations.append(('remove', attribute, values))
+            else: # delete the entire attribute
+                operations.append(('set', attribute, []))
+
+    elif action_log['action'] == 'put':
+        for attribute, record in records.items():
+            if record['replace']:
+                operations.append(('set', attribute, record['values']))
+            else:
+                operations.append(('add', attribute, record['values']))
+
+    elif action_log['action'] == 'delta':
+        if records['cleared']:
+            operations.append(('clear', None, None))
+
+        for attribute, (absolute, removed, added) in records['attributes'].items():
+            if absolute:
+                operations.append(('set', attribute, added))
+            else:
+                operations.append(('remove', attribute, removed))
+                operations.append(('add', attribute, added))
+
+    return operations
+
+def compose_actions(action_logs):
+    """Composes action logs into a single delta (see the module docstring).
+
+    The action logs aren't changed.
+
+    """
+
+    cleared = False
+    attributes_deltas = {}
+
+    for action_log in action_logs:
+        for operation, attribute, values in action_operations(action_log):
+            if operation == 'clear':
+                # Following changes apply to an empty item, i.e. are absolute
+                cleared = True
+                attributes_deltas = {}
+                continue
+
+            if operation == 'set':
+                attributes_deltas[attribute] = \
+                    (True, OrderedSet(), OrderedSet(values))
+                continue
+
+            if attribute not in attributes_deltas:
+                attributes_deltas[attribute] = (cleared, OrderedSet(), OrderedSet())
+
+            absolute, removed, added = attributes_deltas[attribute]
+
+            for value in values:
+                if operation == 'add':
+                    removed.discard(value)
+                    added.add(value)
+                else:
+                    added.discard(value)
+                    if not absolute:
+                        removed.add(value)
+
+    return cleared, attributes_deltas
+
+def apply_delta(dictionary, delta):
+    """Applies delta on dictionary, in place, and returns it.
+
+    Only the changed attributes get new values sets, other values that aren't
+    OrderedSets are transformed to ones (see consistent_sdb's local actions).
+
+    """
+
+    cleared, attributes_deltas = delta
+
+    if cleared:
+        dictionary.clear()
+
+    for attribute, (absolute, removed, added) in attributes_deltas.items():
+        if absolute or attribute not in dictionary:
+            values = OrderedSet(added)
+        else:
+            values = OrderedSet([
+                                 value for value in dictionary[attribute] if
+                                 value not in removed
+                                ])
+            for value in added:
+                values.add(value)
+
+        if values:
+            dictionary[attribute] = values
+        else:
+            dictionary.pop(attribute, None)
+
+    for attribute, values in dictionary.items():
+        if not isinstance(values, OrderedSet):
+            dictionary[attribute] = OrderedSet(values)
+
+    return dictionary
+
+def delta_action_log(delta):
+    """Returns a 'delta' action log that performs delta, made of builtin types
+    only (so it can be pickled by the journal backends).
+
+    """
+
+    cleared, attributes_deltas = delta
+
+    return {
+            'action': 'delta',
+            'attributes': {
+                           'cleared': cleared,
+                           'attributes': dict([
+                               (attribute, (absolute, list(removed), list(added))) for
+                               (attribute, (absolute, removed, added)) in
+                               attributes_deltas.items()
+                           ])
+                          }
+           }
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Background journal janitor
+
+Journal entries can't expire on their own (see
+consistent_sdb.random_journal_cleaning()), the janitor sweeps all the
+journals incrementally and deletes their expired entries.
+
+Each tick scans the next journals_per_tick journals
+(settings.janitor_journals_per_tick by default), ticks are tick_interval
+seconds (settings.janitor_tick_interval) apart, so the janitor load on the
+journal backend is bounded.
+
+The janitor is opt-in, it can be run as a thread of the application process:
+
+    consistent_sdb.start_janitor()
+
+or as a separate process:
+
+    python -m consistent_sdb.janitor
+
+Its work is reported on the status module.
+
+"""
+
+import sys
+import threading
+
+import status
+
+class Janitor(threading.Thread):
+    def __init__(self, journal, journals_per_tick, tick_interval):
+        threading.Thread.__init__(self, name='consistent_sdb janitor')
+        self.daemon = True
+
+        self.journal = journal
+        self.journals_per_tick = journals_per_tick
+        self.tick_interval = tick_interval
+
+        self.cursor = 0
+        self._stop_event = threading.Event()
+
+    def tick(self):
+        """Deletes the expired entries of the next journals of the sweep,
+        returns the amount of entries deleted.
+
+        """
+
+        self.cursor, journal_keys = \
+            self.journal.scan(self.cursor, self.journals_per_tick)
+
+        deleted = self.journal.expire(journal_keys)
+
+        status.increment('janitor_scanned_journals', len(journal_keys))
+        status.increment('janitor_expired_items_deletes', deleted)
+
+        if self.cursor == 0:
+            status.increment('janitor_sweeps')
+
+        return deleted
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.tick()
+            except Exception:
+                # The journal backend might be temporarily unavailable, we'll
+                # try again on the next tick
+                status.increment('janitor_errors')
+
+            self._stop_event.wait(self.tick_interval)
+
+    def stop(self):
+        self._stop_event.set()
+
+def main():
+    import consistent_sdb
+
+    janitor = consistent_sdb.start_janitor()
+
+    print 'Sweeping journals, %d journals every %s seconds' % \
+        (janitor.journals_per_tick, janitor.tick_interval)
+
+    try:
+        while janitor.is_alive():
+            janitor.join(1)
+    except KeyboardInterrupt:
+        janitor.stop()
+
+    print 'Deleted %d expired journal entries in %d sweeps' % \
+        (status.janitor_expired_items_deletes, status.janitor_sweeps)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1189 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Journal backends
+
+The journal keeps, for each simpledb item changed by this server, the log of
+the actions performed on it in the last `ttl` seconds (see the journaling
+section of the consistent_sdb module).
+
+A journal backend implements the Journal interface:
+append() - log a list of actions
+read() - read the live actions logged for items, optionally only those newer
+         than a timestamp per item
+expire() - delete the expired entries of journals
+scan() - iterate over the journals keys, a bounded amount at a time
+domain_versions() - read the domains' versions, a value that changes whenever
+                    actions on the domain's items are appended
+journaled_items() - list the items of a domain that have live actions
+heads() - read the latest timestamp journaled for items, which lets readers
+          skip the journals of items whose simpledb state is at least as new
+
+Journals longer than the backend's compaction_threshold are compacted when
+appended to: their live entries are merged into a single 'delta' action log
+(see the deltas module) at the latest entry's timestamp, so the journal of an
+item stays short however often it's changed.
+
+Journals are also capped at the backend's max_entries: the oldest entries of
+a longer journal are dropped, and replaced by a truncation marker, an entry
+with a 'truncated' action log at the timestamp of the newest dropped entry.
+Items whose simpledb state is older than a live truncation marker can't be
+brought up to date by replaying their journals (see
+consistent_sdb.replay_is_safe()).
+
+Available backends:
+RedisJournal - the journal is kept on redis, shared by all the servers'
+               processes that use the same redis.
+MemoryJournal - the journal is kept in the process memory.
+FileJournal - the journal is kept on a memory-mapped local file, shared by
+              the processes of a single node.
+
+"""
+
+import contextlib
+import copy
+import datetime
+import fcntl
+import mmap
+import os
+import pickle
+import random
+import struct
+import threading
+
+import redis
+
+import paths
+import status
+import deltas
+from timestamps import parse_timestamp
+
+def action_log_key(domain, item, timestamp):
+    """Returns the redis key for the action log for the action performed on
+    item in timestamp
+
+    """
+
+    return domain + ':' + item + ':' + timestamp
+
+def actions_journal_key(domain, item):
+    """Returns the redis key that holds the timestamps list for the actions log
+    available for item in redis. (the item's action journal)
+
+    """
+
+    return domain + ':' + item
+
+def domain_version_key(domain):
+    """Returns the redis key of the domain's version counter (see
+    Journal.domain_versions())
+
+    """
+
+    return 'domain_version::' + domain
+
+def journaled_items_key(domain):
+    """Returns the redis key of the hash of the domain's journaled items and
+    their latest timestamps (see Journal.journaled_items() and
+    Journal.heads())
+
+    """
+
+    return 'journaled_items::' + domain
+
+# Sets a field of a hash to a timestamp unless the field holds a later one
+# (ISO 8601 timestamps sort lexicographically), so concurrent appends can't
+# move an item's head back
+set_later_timestamp_script = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if not current or current < ARGV[2] then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+"""
+
+# The redis journal keeps compacted entries under their timestamp with this
+# suffix, so their action logs don't collide with the action log of the latest
+# entry they merged (which the journal mirror might still hold)
+compacted_suffix = '+compacted'
+# Truncation markers are kept under their timestamp with this suffix, without
+# an action log
+truncated_suffix = '+truncated'
+
+def entry_timestamp(entry):
+    """Returns the timestamp of a redis journal entry"""
+
+    for suffix in [compacted_suffix, truncated_suffix]:
+        if entry.endswith(suffix):
+            return entry[:-len(suffix)]
+
+    return entry
+
+def truncated_action_log():
+    """Returns the action log of truncation markers"""
+
+    return {'action': 'truncated', 'attributes': None}
+
+def compact_entries(entries):
+    """Returns the (timestamp, action_log) entries that replace entries, a
+    list of live (timestamp, action_log) tuples in the order they were
+    logged: the entry that merges them, preceded by their latest truncation
+    marker (the merged entry doesn't reflect the actions the marker stands
+    for).
+
+    """
+
+    markers = [
+               (timestamp, action_log) for (timestamp, action_log) in entries if
+               action_log['action'] == 'truncated'
+              ]
+    action_entries = [
+                      (timestamp, action_log) for (timestamp, action_log) in entries if
+                      action_log['action'] != 'truncated'
+                     ]
+
+    result = markers[-1:]
+    if action_entries:
+        result.append((
+            action_entries[-1][0],
+            deltas.delta_action_log(deltas.compose_actions([
+                action_log for (timestamp, action_log) in action_entries
+            ]))
+        ))
+
+    return result
+
+class Journal(object):
+    """The journal backend interface.
+
+    Action logs are dictionaries with the keys 'action' and 'attributes' (see
+    consistent_sdb.log_action()), timestamps are the ISO 8601 strings returned
+    by timestamps.current_timestamp().
+
+    """
+
+    def __init__(self, ttl, compaction_threshold=0, max_entries=0):
+        self.ttl_seconds = ttl
+        self.ttl = datetime.timedelta(seconds=ttl)
+
+        # 0 disables compaction
+        self.compaction_threshold = compaction_threshold
+        # 0 for journals of any length, otherwise at least 2 (a truncation
+        # marker and an entry)
+        self.max_entries = max_entries and max(max_entries, 2)
+
+        # The last time the expired entries of all the journals were dropped,
+        # see _sweep_due()
+        self._swept_at = datetime.datetime.utcnow()
+
+    def is_expired(self, timestamp, now=None):
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        return now - parse_timestamp(timestamp) >= self.ttl
+
+    def append(self, entries):
+        """Logs entries, a list of (domain, item, timestamp, action_log)
+        tuples, in the given order.
+
+        """
+
+        raise NotImplementedError
+
+    def read(self, domain, item_names, newer_than=None):
+        """Returns dictionary in which the keys are item_names and the values
+        are lists of the (timestamp, action_log) tuples logged for the item
+        and not expired, in the order they were logged.
+
+        newer_than, if given, is a dictionary of items names and timestamps,
+        only entries newer than the item's timestamp are returned for items
+        that are in it.
+
+        """
+
+        raise NotImplementedError
+
+    def expire(self, journal_keys):
+        """Deletes the expired entries of the given journals. Returns the
+        amount of entries deleted.
+
+        """
+
+        raise NotImplementedError
+
+    def random_journal_key(self):
+        """Returns the key of a random journal, or None if there are no
+        journals.
+
+        """
+
+        raise NotImplementedError
+
+    def scan(self, cursor, count):
+        """Returns (next cursor, journal keys) with about count journal keys.
+
+        Start a scan with cursor 0 and pass the returned cursor to the next
+        call, the scan completed once the returned cursor is 0 again. Journals
+        added or removed during the scan might be skipped or returned twice.
+
+        """
+
+        raise NotImplementedError
+
+    def domain_versions(self, domains):
+        """Returns list of the domains' versions. A domain's version changes
+        whenever entries of the domain's items are appended, so it can be used
+        to invalidate data cached for the domain.
+
+        """
+
+        raise NotImplementedError
+
+    def journaled_items(self, domain):
+        """Returns set of the names of the domain's items that have live
+        (not expired) entries.
+
+        """
+
+        raise NotImplementedError
+
+    def heads(self, domain, item_names):
+        """Returns dictionary in which the keys are item_names and the values
+        are the latest timestamps journaled for the items, None for items
+        without live entries.
+
+        """
+
+        raise NotImplementedError
+
+    def _live_heads(self, item_names, timestamps):
+        # heads() of the items' latest timestamps (None for unknown ones)
+        now = datetime.datetime.utcnow()
+
+        return dict([
+                     (
+                      item_name,
+                      timestamp if
+                      timestamp is not None and not self.is_expired(timestamp, now) else
+                      None
+                     ) for
+                     (item_name, timestamp) in zip(item_names, timestamps)
+                    ])
+
+    def _latest_timestamps(self, latest_timestamps, domain, item, timestamp):
+        # Keeps in latest_timestamps, a dictionary of domains and dictionaries
+        # of items and timestamps, the latest timestamp logged for each item
+        domain_items = latest_timestamps.setdefault(domain, {})
+
+        if domain_items.get(item) is None or \
+           parse_timestamp(domain_items[item]) < parse_timestamp(timestamp):
+            domain_items[item] = timestamp
+
+    def _sweep_due(self, now):
+        # Whether the local backends should drop the expired entries of all
+        # their journals now (every half ttl), so the journals of items that
+        # aren't changed or read anymore don't stay forever, with or without
+        # a janitor
+        if now - self._swept_at < self.ttl / 2:
+            return False
+
+        self._swept_at = now
+
+        return True
+
+    def _expire_latest(self, latest_timestamps, now):
+        # Drops the items whose latest timestamp expired from
+        # latest_timestamps (see _latest_timestamps())
+        for domain, items_timestamps in latest_timestamps.items():
+            for item, timestamp in items_timestamps.items():
+                if self.is_expired(timestamp, now):
+                    del items_timestamps[item]
+
+            if not items_timestamps:
+                del latest_timestamps[domain]
+
+    def _needs_compaction(self, journal_length):
+        return self.compaction_threshold and journal_length > self.compaction_threshold
+
+    def _compacted_entries(self, entries):
+        # compact_entries(), counted
+        status.increment('journal_compactions')
+
+        return compact_entries(entries)
+
+    def _needs_truncation(self, journal_length):
+        return self.max_entries and journal_length > self.max_entries
+
+    def _split_truncated(self, entries):
+        # Returns (dropped entries, kept entries) of a journal longer than
+        # max_entries, the kept entries are the last max_entries - 1 (the
+        # truncation marker takes the remaining place)
+        status.increment('journal_truncations')
+
+        dropped_amount = len(entries) - self.max_entries + 1
+
+        return entries[:dropped_amount], entries[dropped_amount:]
+
+    def _scan_sorted_keys(self, journal_keys, cursor, count):
+        # scan() for backends that can list their journals keys, the cursor is
+        # the position in the sorted keys list
+        journal_keys = sorted(journal_keys)
+
+        next_cursor = cursor + count
+        if next_cursor >= len(journal_keys):
+            next_cursor = 0
+
+        return next_cursor, journal_keys[cursor:cursor + count]
+
+    def _newer(self, timestamp, item_name, newer_than):
+        if newer_than is None or newer_than.get(item_name) is None:
+            return True
+
+        return parse_timestamp(newer_than[item_name]) < parse_timestamp(timestamp)
+
+class RedisJournal(Journal):
+    """Journal kept on two redis dbs: journals_db holds for each item a list of
+    its entries' timestamps, logs_db holds the pickled action log of each
+    entry (with redis expiry set to the journal ttl), the domains' version
+    counters and, for each domain, a hash of its journaled items and their
+    latest entry timestamps.
+
+    If a cache.JournalMirror is given, action logs found in it aren't read
+    from redis.
+
+    Compaction and truncation replace a journal's entries in a redis
+    transaction, which is retried (up to rewrite_attempts times) if the
+    journal changed meanwhile.
+
+    """
+
+    rewrite_attempts = 3
+
+    def __init__(self,
+                 journals_db,
+                 logs_db,
+                 ttl,
+                 mirror=None,
+                 compaction_threshold=0,
+                 max_entries=0
+                ):
+        Journal.__init__(self, ttl, compaction_threshold, max_entries)
+
+        self.journals_db = journals_db
+        self.logs_db = logs_db
+        self.mirror = mirror
+
+    def append(self, entries):
+        if not entries:
+            return
+
+        logs_pipeline = self.logs_db.pipeline()
+        journals_pipeline = self.journals_db.pipeline()
+
+        for domain, item, timestamp, action_log in entries:
+            logs_pipeline.set(
+                              action_log_key(domain, item, timestamp),
+                              pickle.dumps(action_log)
+                             )
+
+            # expire after it safe to assume that simpledb will be consistent
+            # for that action
+            logs_pipeline.expire(
+                                 action_log_key(domain, item, timestamp),
+                                 self.ttl_seconds
+                                )
+
+            # Add the timestamp to the list represents the item's actions
+            # journal.
+            #
+            # we use the item's journal list to store only the timestamps, and
+            # not the entire action logs, to avoid the need to pickle each
+            # action item to find it's timestamp (reduce cpu) and to be able to
+            # apply the redis command `expire` on the action log key, something
+            # we can't do on list items (reduce memory usage)
+            journals_pipeline.rpush(actions_journal_key(domain, item), timestamp)
+
+        # The action logs have to exist before their timestamps appear in the
+        # journals
+        logs_pipeline.execute()
+        journals_lengths = journals_pipeline.execute()
+
+        latest_timestamps = {}
+        for domain, item, timestamp, action_log in entries:
+            self._latest_timestamps(latest_timestamps, domain, item, timestamp)
+
+        # The versions change only once the entries can be read, so data read
+        # with the new versions reflects the entries
+        versions_pipeline = self.logs_db.pipeline()
+        for domain, items_timestamps in latest_timestamps.items():
+            versions_pipeline.incr(domain_version_key(domain))
+
+            # An item of the hash is dropped once its latest entry expires
+            # (see journaled_items()), the whole hash expires with the latest
+            # entry of the domain
+            for item, timestamp in items_timestamps.items():
+                versions_pipeline.eval(
+                                       set_later_timestamp_script,
+                                       1,
+                                       journaled_items_key(domain),
+                                       item,
+                                       timestamp
+                                      )
+            versions_pipeline.expire(journaled_items_key(domain), self.ttl_seconds)
+        versions_pipeline.execute()
+
+        long_journals = set([
+                             (domain, item) for
+                             ((domain, item, timestamp, action_log), journal_length) in
+                             zip(entries, journals_lengths) if
+                             self._needs_compaction(journal_length) or
+                             self._needs_truncation(journal_length)
+                            ])
+
+        # Journals we failed to compact (or don't compact) are truncated
+        for domain, item in long_journals:
+            if not (self.compaction_threshold and self.compact(domain, item)):
+                self.truncate(domain, item)
+
+    def compact(self, domain, item):
+        """Merges the live entries of the item's journal into a single entry.
+        Returns whether the journal was compacted.
+
+        """
+
+        def compacted(live_entries):
+            if len(live_entries) < 2:
+                return None
+
+            action_logs = self._action_logs(domain, item, live_entries)
+
+            compacted_entries = []
+            logs_pipeline = self.logs_db.pipeline()
+            for timestamp, action_log in self._compacted_entries([
+                (entry_timestamp(entry), action_log) for
+                (entry, action_log) in zip(live_entries, action_logs) if
+                # the action log might have expired after we read the journal
+                action_log is not None
+            ]):
+                if action_log['action'] == 'truncated':
+                    compacted_entries.append(timestamp + truncated_suffix)
+                    continue
+
+                compacted_entry = timestamp + compacted_suffix
+                compacted_entries.append(compacted_entry)
+
+                logs_pipeline.set(
+                                  action_log_key(domain, item, compacted_entry),
+                                  pickle.dumps(action_log)
+                                 )
+                logs_pipeline.expire(
+                                     action_log_key(domain, item, compacted_entry),
+                                     self.ttl_seconds
+                                    )
+            logs_pipeline.execute()
+
+            return compacted_entries
+
+        return self._rewrite(actions_journal_key(domain, item), compacted)
+
+    def truncate(self, domain, item):
+        """Drops the oldest entries of the item's journal if it's longer than
+        max_entries (see the module docstring). Returns whether the journal
+        was truncated.
+
+        """
+
+        def truncated(live_entries):
+            if not self._needs_truncation(len(live_entries)):
+                return None
+
+            dropped_entries, kept_entries = self._split_truncated(live_entries)
+
+            return [entry_timestamp(dropped_entries[-1]) + truncated_suffix] + kept_entries
+
+        return self._rewrite(actions_journal_key(domain, item), truncated)
+
+    def _rewrite(self, journal_key, rewrite):
+        # Replaces the journal's entries with rewrite(live entries), unless it
+        # returns None. Returns whether the journal was rewritten.
+        pipeline = self.journals_db.pipeline()
+        try:
+            for attempt in range(self.rewrite_attempts):
+                try:
+                    # The transaction fails if the journal changes after we
+                    # read it
+                    pipeline.watch(journal_key)
+                    journal_entries = pipeline.lrange(journal_key, 0, -1)
+
+                    now = datetime.datetime.utcnow()
+                    new_entries = rewrite([
+                                           entry for entry in journal_entries if
+                                           not self.is_expired(entry_timestamp(entry), now)
+                                          ])
+
+                    if new_entries is None:
+                        return False
+
+                    pipeline.multi()
+                    pipeline.delete(journal_key)
+                    if new_entries:
+                        pipeline.rpush(journal_key, *new_entries)
+                    pipeline.execute()
+
+                    return True
+                except redis.WatchError:
+                    continue
+
+            return False
+        finally:
+            pipeline.reset()
+
+    def _action_logs(self, domain, item, entries):
+        # Returns list of the action logs of the item's journal entries, None
+        # for those whose action log expired
+        action_logs = dict([
+                            (entry, truncated_action_log()) for
+                            entry in entries if
+                            entry.endswith(truncated_suffix)
+                           ])
+
+        logged_entries = [entry for entry in entries if entry not in action_logs]
+
+        if logged_entries:
+            for entry, action_log in zip(
+                                         logged_entries,
+                                         self.logs_db.mget([
+                                             action_log_key(domain, item, entry) for
+                                             entry in logged_entries
+                                         ])
+                                        ):
+                if action_log is not None:
+                    action_logs[entry] = pickle.loads(str(action_log))
+
+        return [action_logs.get(entry) for entry in entries]
+
+    def read(self, domain, item_names, newer_than=None):
+        result = dict([(item_name, []) for item_name in item_names])
+
+        if not item_names:
+            return result
+
+        journals_pipeline = self.journals_db.pipeline()
+        for item_name in item_names:
+            journals_pipeline.lrange(actions_journal_key(domain, item_name), 0, -1)
+        items_journals = journals_pipeline.execute()
+
+        now = datetime.datetime.utcnow()
+
+        # Go over the items' journals, delete entries we find expired
+        expired_pipeline = self.journals_db.pipeline()
+        has_expired = False
+        live_entries = []
+        for item_name, item_journal in zip(item_names, items_journals):
+            for entry in item_journal:
+                # If the entry ttl passed delete it
+                if self.is_expired(entry_timestamp(entry), now):
+                    expired_pipeline.lrem(
+                                          actions_journal_key(domain, item_name),
+                                          entry,
+                                          1
+                                         )
+                    has_expired = True
+                    continue
+
+                if self._newer(entry_timestamp(entry), item_name, newer_than):
+                    live_entries.append((item_name, entry))
+
+        if has_expired:
+            expired_pipeline.execute()
+
+        # Action logs this process logged are taken from the journal mirror,
+        # the rest (logged by other processes with the same server_id, evicted
+        # from the mirror, or compacted) are read from redis in a single round
+        # trip
+        items_logs = {}
+        for item_name in item_names:
+            if self.mirror is not None:
+                items_logs[item_name] = \
+                    self.mirror.action_logs(actions_journal_key(domain, item_name))
+            else:
+                items_logs[item_name] = {}
+
+        # Truncation markers have no action log
+        for item_name, entry in live_entries:
+            if entry.endswith(truncated_suffix):
+                items_logs[item_name][entry] = truncated_action_log()
+
+        missing_entries = [
+                           (item_name, entry) for
+                           (item_name, entry) in live_entries if
+                           entry not in items_logs[item_name]
+                          ]
+
+        if missing_entries:
+            action_logs = self.logs_db.mget([
+                                             action_log_key(domain, item_name, entry) for
+                                             (item_name, entry) in missing_entries
+                                            ])
+
+            for (item_name, entry), action_log in zip(missing_entries, action_logs):
+                # the action log might have expired after we read the journal
+                if action_log is not None:
+                    items_logs[item_name][entry] = \
+                        pickle.loads(str(action_log))
+
+        for item_name, entry in live_entries:
+            if entry in items_logs[item_name]:
+                result[item_name].append(
+                    (entry_timestamp(entry), items_logs[item_name][entry])
+                )
+
+        return result
+
+    def expire(self, journal_keys):
+        if not journal_keys:
+            return 0
+
+        journals_pipeline = self.journals_db.pipeline()
+        for journal_key in journal_keys:
+            journals_pipeline.lrange(journal_key, 0, -1)
+        journals = journals_pipeline.execute()
+
+        now = datetime.datetime.utcnow()
+
+        expired_pipeline = self.journals_db.pipeline()
+        deleted = 0
+        for journal_key, item_journal in zip(journal_keys, journals):
+            for entry in item_journal:
+                if self.is_expired(entry_timestamp(entry), now):
+                    expired_pipeline.lrem(journal_key, entry, 1)
+                    deleted += 1
+
+        if deleted:
+            expired_pipeline.execute()
+
+        return deleted
+
+    def random_journal_key(self):
+        # Note: to be able to use redis random command and know for sure we
+        # received actions journal, the actions journals have a db of their
+        # own.
+        return self.journals_db.randomkey() or None
+
+    def scan(self, cursor, count):
+        # The journals db holds only journals (see random_journal_key())
+        return self.journals_db.scan(cursor, count=count)
+
+    def domain_versions(self, domains):
+        if not domains:
+            return []
+
+        return self.logs_db.mget([domain_version_key(domain) for domain in domains])
+
+    def journaled_items(self, domain):
+        items_timestamps = self.logs_db.hgetall(journaled_items_key(domain))
+
+        now = datetime.datetime.utcnow()
+
+        expired_items = [
+                         item for (item, timestamp) in items_timestamps.items() if
+                         self.is_expired(timestamp, now)
+                        ]
+
+        if expired_items:
+            self.logs_db.hdel(journaled_items_key(domain), *expired_items)
+
+        return set(items_timestamps.keys()) - set(expired_items)
+
+    def heads(self, domain, item_names):
+        if not item_names:
+            return {}
+
+        return self._live_heads(
+                                item_names,
+                                self.logs_db.hmget(journaled_items_key(domain), item_names)
+                               )
+
+class MemoryJournal(Journal):
+    """Journal kept in the process memory, for single process deployments
+    and for benchmarking the layer without redis.
+
+    """
+
+    def __init__(self, ttl, compaction_threshold=0, max_entries=0):
+        Journal.__init__(self, ttl, compaction_threshold, max_entries)
+
+        self._journals = {} # journal key -> list of (timestamp, action_log)
+        self._domain_versions = {}
+        self._latest = {} # domain -> item -> latest timestamp
+        self._lock = threading.Lock()
+
+    def append(self, entries):
+        with self._lock:
+            self._sweep(datetime.datetime.utcnow())
+
+            for domain, item, timestamp, action_log in entries:
+                self._domain_versions[domain] = \
+                    self._domain_versions.get(domain, 0) + 1
+                self._latest_timestamps(self._latest, domain, item, timestamp)
+                journal_entries = self._journals.setdefault(
+                                                            actions_journal_key(domain, item),
+                                                            []
+                                                           )
+                journal_entries.append((timestamp, copy.deepcopy(action_log)))
+
+                if self._needs_compaction(len(journal_entries)):
+                    self._compact(actions_journal_key(domain, item))
+                elif self._needs_truncation(len(journal_entries)):
+                    self._truncate(actions_journal_key(domain, item))
+
+    def _sweep(self, now):
+        # Called with the lock held
+        if self._sweep_due(now):
+            self._expire(self._journals.keys(), now)
+            self._expire_latest(self._latest, now)
+
+    def _live_entries(self, journal_key):
+        now = datetime.datetime.utcnow()
+
+        return [
+                (timestamp, action_log) for
+                (timestamp, action_log) in self._journals[journal_key] if
+                not self.is_expired(timestamp, now)
+               ]
+
+    def _compact(self, journal_key):
+        # Called with the lock held
+        live_entries = self._live_entries(journal_key)
+
+        if len(live_entries) < 2:
+            self._journals[journal_key] = live_entries
+            return
+
+        self._journals[journal_key] = self._compacted_entries(live_entries)
+
+    def _truncate(self, journal_key):
+        # Called with the lock held
+        live_entries = self._live_entries(journal_key)
+
+        if not self._needs_truncation(len(live_entries)):
+            self._journals[journal_key] = live_entries
+            return
+
+        dropped_entries, kept_entries = self._split_truncated(live_entries)
+
+        self._journals[journal_key] = \
+            [(dropped_entries[-1][0], truncated_action_log())] + kept_entries
+
+    def read(self, domain, item_names, newer_than=None):
+        now = datetime.datetime.utcnow()
+        result = {}
+
+        with self._lock:
+            self._sweep(now)
+
+            for item_name in item_names:
+                result[item_name] = [
+                    (timestamp, action_log) for
+                    (timestamp, action_log) in
+                    self._journals.get(actions_journal_key(domain, item_name), []) if
+                    not self.is_expired(timestamp, now) and
+                    self._newer(timestamp, item_name, newer_than)
+                ]
+
+        return result
+
+    def expire(self, journal_keys):
+        with self._lock:
+            return self._expire(journal_keys, datetime.datetime.utcnow())
+
+    def _expire(self, journal_keys, now):
+        # Called with the lock held
+        deleted = 0
+
+        for journal_key in journal_keys:
+            entries = self._journals.get(journal_key, [])
+            live_entries = [
+                            (timestamp, action_log) for
+                            (timestamp, action_log) in entries if
+                            not self.is_expired(timestamp, now)
+                           ]
+
+            deleted += len(entries) - len(live_entries)
+
+            if live_entries:
+                self._journals[journal_key] = live_entries
+            else:
+                self._journals.pop(journal_key, None)
+
+        return deleted
+
+    def random_journal_key(self):
+        with self._lock:
+            if not self._journals:
+                return None
+
+            return random.choice(self._journals.keys())
+
+    def scan(self, cursor, count):
+        with self._lock:
+            return self._scan_sorted_keys(self._journals.keys(), cursor, count)
+
+    def domain_versions(self, domains):
+        with self._lock:
+            return [self._domain_versions.get(domain) for domain in domains]
+
+    def journaled_items(self, domain):
+        now = datetime.datetime.utcnow()
+
+        with self._lock:
+            items_timestamps = self._latest.get(domain, {})
+
+            for item, timestamp in items_timestamps.items():
+                if self.is_expired(timestamp, now):
+                    del items_timestamps[item]
+
+            return set(items_timestamps.keys())
+
+    def heads(self, domain, item_names):
+        with self._lock:
+            items_timestamps = self._latest.get(domain, {})
+
+            return self._live_heads(
+                                    item_names,
+                                    [items_timestamps.get(item_name) for item_name in item_names]
+                                   )
+
+class FileJournal(Journal):
+    """Journal kept on a local file, shared by the processes of a single node.
+
+    The file is a sequence of records, each is a 4 bytes length followed by a
+    pickled (domain, item, timestamp, action_log) tuple. Records are only
+    appended (under an exclusive file lock), each process keeps in memory an
+    index of the records' offsets and reads records through a memory map of
+    the file.
+
+    Expired records are dropped from the index, by expire() and every half
+    ttl by any other operation. Once most of the file is expired records, the
+    next append (or expire()) compacts it: the live records are written to a
+    new file that replaces the old one, processes notice the replacement and
+    re-index the new file.
+
+    Records are unpickled, so the file must be owned by the current user and
+    not writable by others (see the paths module), InsecurePathError is raised
+    otherwise.
+
+    A domain's version is the amount of records of the domain's items in the
+    file, together with the file's inode (which changes on compaction).
+
+    A compacted journal entry is appended as a record of its own, indexing it
+    drops the item's records that precede it from the index.
+
+    The records of a journal longer than max_entries are kept (each process
+    indexes the file on its own), reads truncate the journal instead.
+
+    """
+
+    record_header = struct.Struct('!I')
+
+    def __init__(self, path, ttl, compaction_threshold=0, max_entries=0):
+        Journal.__init__(self, ttl, compaction_threshold, max_entries)
+
+        self.path = path
+
+        self._lock = threading.RLock()
+        self._file = None
+        self._map = None
+
+    def _open(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+        if self._file is not None:
+            self._file.close()
+
+        self._file = os.fdopen(
+                               paths.open_owned(
+                                                self.path,
+                                                os.O_RDWR | os.O_CREAT | os.O_APPEND
+                                               ),
+                               'ab+'
+                              )
+        self._inode = os.fstat(self._file.fileno()).st_ino
+
+        # journal key -> list of (timestamp, record offset, record length)
+        self._index = {}
+        # domain -> amount of records in the file
+        self._domain_records = {}
+        # domain -> item -> latest timestamp
+        self._latest = {}
+        self._indexed_size = 0
+        # The size of the live records in the index
+        self._live_size = 0
+
+    def _replaced(self):
+        # Whether the file was replaced by a compaction since we opened it
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except OSError:
+            return True
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        with self._lock:
+            while True:
+                if self._file is None or self._replaced():
+                    self._open()
+
+                fcntl.flock(self._file.fileno(), operation)
+
+                # The file might have been replaced while we waited for the
+                # lock
+                if not self._replaced():
+                    break
+
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+            locked_file = self._file
+            try:
+                self._refresh()
+                self._sweep(datetime.datetime.utcnow())
+                yield
+            finally:
+                # a compaction closes the file, which releases the lock
+                if not locked_file.closed:
+                    fcntl.flock(locked_file.fileno(), fcntl.LOCK_UN)
+
+    def _refresh(self):
+        # Index the records appended since the last refresh
+        size = os.fstat(self._file.fileno()).st_size
+
+        if size == self._indexed_size:
+            return
+
+        if self._map is not None:
+            self._map.close()
+
+        self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+
+        offset = self._indexed_size
+        while offset + self.record_header.size <= size:
+            length, = self.record_header.unpack_from(self._map, offset)
+            record_offset = offset + self.record_header.size
+
+            if record_offset + length > size:
+                # partially written record, we'll index it on the next refresh
+                break
+
+            domain, item, timestamp, action_log = \
+                self._record(record_offset, length)
+
+            journal_key = actions_journal_key(domain, item)
+
+            # A compacted entry replaces the entries appended before it
+            if action_log['action'] == 'delta':
+                self._live_size -= sum([
+                    self.record_header.size + indexed_length for
+                    (indexed_timestamp, indexed_offset, indexed_length) in
+                    self._index.get(journal_key, [])
+                ])
+                self._index[journal_key] = []
+
+            self._index.setdefault(journal_key, []).append(
+                (timestamp, record_offset, length)
+            )
+            self._domain_records[domain] = \
+                self._domain_records.get(domain, 0) + 1
+            self._latest_timestamps(self._latest, domain, item, timestamp)
+            self._live_size += self.record_header.size + length
+
+            offset = record_offset + length
+
+        self._indexed_size = offset
+
+    def _sweep(self, now):
+        # Called with the file lock held
+        if self._sweep_due(now):
+            self._expire_index(self._index.keys(), now)
+            self._expire_latest(self._latest, now)
+
+    def _expire_index(self, journal_keys, now):
+        # Drops the expired entries of journal_keys from the index, returns
+        # the amount of entries dropped
+        deleted = 0
+
+        for journal_key in journal_keys:
+            entries = self._index.get(journal_key, [])
+            live_entries = [
+                            entry for entry in entries if
+                            not self.is_expired(entry[0], now)
+                           ]
+
+            deleted += len(entries) - len(live_entries)
+            self._live_size -= sum([
+                self.record_header.size + length for
+                (timestamp, record_offset, length) in entries if
+                self.is_expired(timestamp, now)
+            ])
+
+            if live_entries:
+                self._index[journal_key] = live_entries
+            else:
+                self._index.pop(journal_key, None)
+
+        return deleted
+
+    def _needs_file_compaction(self):
+        return self._live_size * 2 < self._indexed_size
+
+    def _record(self, record_offset, length):
+        return pickle.loads(self._map[record_offset:record_offset + length])
+
+    def _write(self, entries):
+        # Called with the exclusive file lock held
+        data = ''.join([
+            self.record_header.pack(len(record)) + record for
+            record in [
+                       pickle.dumps(entry, pickle.HIGHEST_PROTOCOL) for
+                       entry in entries
+                      ]
+        ])
+
+        self._file.write(data)
+        self._file.flush()
+        self._refresh()
+
+    def append(self, entries):
+        if not entries:
+            return
+
+        with self._locked(fcntl.LOCK_EX):
+            self._write(entries)
+
+            now = datetime.datetime.utcnow()
+
+            compacted_entries = []
+            for domain, item in set([(entry[0], entry[1]) for entry in entries]):
+                journal_key = actions_journal_key(domain, item)
+
+                if not self._needs_compaction(len(self._index.get(journal_key, []))):
+                    continue
+
+                live_entries = [
+                    (timestamp, self._record(record_offset, length)[3]) for
+                    (timestamp, record_offset, length) in self._index[journal_key] if
+                    not self.is_expired(timestamp, now)
+                ]
+
+                if len(live_entries) > 1:
+                    compacted_entries.extend([
+                        (domain, item, timestamp, action_log) for
+                        (timestamp, action_log) in
+                        self._compacted_entries(live_entries)
+                    ])
+
+            if compacted_entries:
+                self._write(compacted_entries)
+
+            if self._needs_file_compaction():
+                self._compact(now)
+
+    def read(self, domain, item_names, newer_than=None):
+        now = datetime.datetime.utcnow()
+        result = {}
+
+        with self._locked(fcntl.LOCK_SH):
+            for item_name in item_names:
+                live_entries = [
+                    (timestamp, record_offset, length) for
+                    (timestamp, record_offset, length) in
+                    self._index.get(actions_journal_key(domain, item_name), []) if
+                    not self.is_expired(timestamp, now)
+                ]
+
+                entries = []
+                if self._needs_truncation(len(live_entries)):
+                    dropped_entries, live_entries = self._split_truncated(live_entries)
+                    entries.append((dropped_entries[-1][0], truncated_action_log()))
+
+                entries.extend([
+                    (timestamp, self._record(record_offset, length)[3]) for
+                    (timestamp, record_offset, length) in live_entries
+                ])
+
+                result[item_name] = [
+                                     (timestamp, action_log) for
+                                     (timestamp, action_log) in entries if
+                                     self._newer(timestamp, item_name, newer_than)
+                                    ]
+
+        return result
+
+    def expire(self, journal_keys):
+        now = datetime.datetime.utcnow()
+
+        with self._locked(fcntl.LOCK_EX):
+            deleted = self._expire_index(journal_keys, now)
+
+            if self._needs_file_compaction():
+                self._compact(now)
+
+        return deleted
+
+    def _compact(self, now):
+        # Called with the exclusive file lock held
+        compacted_path = '%s.%d.compact' % (self.path, os.getpid())
+
+        with os.fdopen(paths.create_owned(compacted_path), 'wb') as compacted_file:
+            for journal_key, entries in self._index.items():
+                for timestamp, record_offset, length in entries:
+                    if not self.is_expired(timestamp, now):
+                        compacted_file.write(
+                            self._map[
+                                      record_offset - self.record_header.size:
+                                      record_offset + length
+                                     ]
+                        )
+
+        os.rename(compacted_path, self.path)
+
+        # Closing the replaced file releases its lock, the compacted file is
+        # indexed on the next operation
+        self._open()
+
+    def random_journal_key(self):
+        with self._locked(fcntl.LOCK_SH):
+            if not self._index:
+                return None
+
+            return random.choice(self._index.keys())
+
+    def scan(self, cursor, count):
+        with self._locked(fcntl.LOCK_SH):
+            return self._scan_sorted_keys(self._index.keys(), cursor, count)
+
+    def domain_versions(self, domains):
+        with self._locked(fcntl.LOCK_SH):
+            return [
+                    (self._inode, self._domain_records.get(domain, 0)) for
+                    domain in domains
+                   ]
+
+    def journaled_items(self, domain):
+        now = datetime.datetime.utcnow()
+
+        with self._locked(fcntl.LOCK_SH):
+            return set([
+                        item for
+                        (item, timestamp) in self._latest.get(domain, {}).items() if
+                        not self.is_expired(timestamp, now)
+                       ])
+
+    def heads(self, domain, item_names):
+        with self._locked(fcntl.LOCK_SH):
+            items_timestamps = self._latest.get(domain, {})
+
+            return self._live_heads(
+                                    item_names,
+                                    [items_timestamps.get(item_name) for item_name in item_names]
+                                   )
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Local paths used by the consistent_sdb module
+
+The file journal and the sidecar socket carry pickles, which are unpickled by
+the processes using them, so they must not be created or replaced by other
+local users. By default they are kept in a directory accessible to the
+current user only (see private_directory()).
+
+"""
+
+import os
+import stat
+import errno
+import tempfile
+
+class InsecurePathError(Exception):
+    """Raised when a path other local users could have created or changed is
+    used
+
+    """
+
+def private_directory():
+    """Returns the path of a directory accessible to the current user only,
+    <temp dir>/consistent_sdb-<uid>, creates it if it doesn't exist.
+
+    Raises InsecurePathError if it exists but isn't a directory of the current
+    user, or other users can access it.
+
+    """
+
+    path = os.path.join(tempfile.gettempdir(), 'consistent_sdb-%d' % os.getuid())
+
+    try:
+        os.mkdir(path, 0700)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+
+    # lstat, so a symbolic link planted at the path isn't followed
+    path_stat = os.lstat(path)
+
+    if not stat.S_ISDIR(path_stat.st_mode) or path_stat.st_uid != os.getuid():
+        raise InsecurePathError('%s is not a directory of the current user' % path)
+
+    if path_stat.st_mode & 0077:
+        raise InsecurePathError('%s is accessible to other users' % path)
+
+    return path
+
+def private_path(name):
+    """Returns the path of name in private_directory()"""
+
+    return os.path.join(private_directory(), name)
+
+def check_owned(path_stat, path):
+    """Raises InsecurePathError unless path_stat (the os.stat() result of
+    path) is of a file of the current user, that other users can't write.
+
+    """
+
+    if path_stat.st_uid != os.getuid():
+        raise InsecurePathError('%s is not owned by the current user' % path)
+
+    if path_stat.st_mode & 0022:
+        raise InsecurePathError('%s is writable by other users' % path)
+
+def open_owned(path, flags):
+    """Opens path (os.open() flags, O_CREAT creates it accessible to the
+    current user only) and returns the file descriptor, raises
+    InsecurePathError if it isn't owned by the current user (see
+    check_owned()). Symbolic links aren't followed.
+
+    """
+
+    descriptor = os.open(path, flags | os.O_NOFOLLOW, 0600)
+
+    try:
+        check_owned(os.fstat(descriptor), path)
+    except:
+        os.close(descriptor)
+        raise
+
+    return descriptor
+
+def create_owned(path):
+    """Creates path, a new file accessible to the current user only, and
+    returns its file descriptor (opened for writing). A file already at the
+    path is replaced (removing it fails unless the current user may).
+
+    """
+
+    if os.path.lexists(path):
+        os.remove(path)
+
+    return os.open(
+                   path,
+                   os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+                   0600
+                  )
@@ -0,0 +1,414 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Sidecar server sharing a single consistent_sdb between processes
+
+Each process using consistent_sdb has its own simpledb connections, redis
+connection pools, journal mirror and caches. The sidecar runs them once for
+all the processes of a node, which call it over a unix socket instead:
+
+    python -m consistent_sdb.sidecar
+
+and in the application:
+
+    from consistent_sdb import sidecar
+    sidecar.get({'domain': {'item': []}})
+
+The sidecar's functions (get(), put(), delete(), select() and the bulk
+actions) take the same arguments and return the same results as those of
+the consistent_sdb module. The sidecar's configuration (settings) applies to
+all of them, the sidecar serves up to settings.sidecar_max_concurrent_requests
+requests at a time, others wait for a free slot.
+
+The deadline in effect when a function is called (see aws_simpledb.deadlines)
+applies to the action the sidecar runs for it as well.
+
+Protocol: each request and response is a frame, a 4 bytes (network order)
+length followed by a binary pickle of the request, an (action, args, kwargs,
+timeout) tuple in which timeout is the seconds left to the caller's deadline
+(None if it has none), or of the response, an (ok, value) tuple in which value
+is the action's result or the state of the exception it raised (see
+error_state()). A connection serves any amount of requests, one at a time.
+
+Note: Requests and responses are unpickled, so the socket is created
+accessible to its owner only, by default in a directory accessible to the
+current user only (see paths.private_directory()), and both ends check the
+user of their peer (see trusted_peer()) before unpickling anything.
+
+"""
+
+import os
+import sys
+import stat
+import socket
+import struct
+import threading
+import cPickle as pickle
+import SocketServer
+
+import paths
+
+from aws_simpledb import deadlines
+
+# The consistent_sdb functions the sidecar serves
+actions = set([
+               'get',
+               'put',
+               'delete',
+               'select',
+               'bulk_get',
+               'bulk_put',
+               'bulk_delete'
+              ])
+
+frame_header = struct.Struct('!I')
+
+# struct ucred, the SO_PEERCRED option's value (pid, uid, gid). Python 2
+# doesn't define SO_PEERCRED, 17 is its value on linux.
+peer_credentials = struct.Struct('3i')
+so_peercred = getattr(socket, 'SO_PEERCRED', 17)
+
+class SidecarError(Exception):
+    """Raised when the sidecar can't be reached or can't serve a request"""
+
+def default_socket_path():
+    """settings.sidecar_socket_path, sidecar.sock in a private directory (see
+    paths.private_path()) if it's None.
+
+    """
+
+    import consistent_sdb
+
+    socket_path = consistent_sdb.get_client().setting('sidecar_socket_path')
+    if socket_path is None:
+        socket_path = paths.private_path('sidecar.sock')
+
+    return socket_path
+
+def trusted_peer(connection):
+    """Returns whether the process at the other end of connection, a
+    connected unix socket, runs as the current user or as root.
+
+    """
+
+    pid, uid, gid = peer_credentials.unpack(
+        connection.getsockopt(socket.SOL_SOCKET, so_peercred, peer_credentials.size)
+    )
+
+    return uid in (os.getuid(), 0)
+
+def error_state(error):
+    """Returns (class, args, attributes) of the exception error, which
+    rebuild_error() turns back into an equal exception. Unlike pickling the
+    exception itself, it keeps the attributes set outside args (e.g.
+    DeadlineExceeded.partial).
+
+    """
+
+    return (error.__class__, error.args, error.__dict__)
+
+def rebuild_error(error_class, args, attributes):
+    """Returns the exception of an error_state()"""
+
+    # Exceptions' constructors take arguments other than their args, so
+    # the state is restored without calling them
+    error = error_class.__new__(error_class)
+    error.args = args
+    error.__dict__.update(attributes)
+
+    return error
+
+def read_frame(connection):
+    """Returns the object of the next frame read from connection, None if the
+    connection was closed before a frame started.
+
+    """
+
+    header = _receive(connection, frame_header.size)
+    if header is None:
+        return None
+
+    length, = frame_header.unpack(header)
+
+    payload = _receive(connection, length)
+    if payload is None:
+        raise SidecarError('Connection closed in the middle of a frame')
+
+    return pickle.loads(payload)
+
+def write_frame(connection, obj):
+    payload = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    connection.sendall(frame_header.pack(len(payload)) + payload)
+
+def _receive(connection, size):
+    chunks = []
+    remaining = size
+
+    while remaining:
+        chunk = connection.recv(remaining)
+        if not chunk:
+            if remaining == size:
+                return None
+
+            raise SidecarError('Connection closed in the middle of a frame')
+
+        chunks.append(chunk)
+        remaining -= len(chunk)
+
+    return ''.join(chunks)
+
+# SERVER:
+class SidecarRequestHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        try:
+            self.serve_requests()
+        except (SidecarError, socket.error):
+            # The client went away in the middle of a frame, there's no one
+            # left to answer
+            pass
+
+    def serve_requests(self):
+        while True:
+            request = read_frame(self.request)
+            if request is None:
+                return
+
+            action, args, kwargs, timeout = request
+
+            with self.server.slots:
+                ok, value = self.server.dispatch(action, args, kwargs, timeout)
+
+            if not ok:
+                value = error_state(value)
+
+            try:
+                write_frame(self.request, (ok, value))
+            except (pickle.PicklingError, TypeError):
+                write_frame(
+                            self.request,
+                            (False, error_state(SidecarError(repr(value))))
+                           )
+
+class SidecarServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Serves the consistent_sdb module on a unix socket at socket_path
+    (default_socket_path() by default), a thread per connection.
+
+    Connections of processes of other users are closed (see trusted_peer()).
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=None, max_concurrent_requests=None):
+        import consistent_sdb
+
+        self.consistent_sdb = consistent_sdb
+
+        if socket_path is None:
+            socket_path = default_socket_path()
+
+        if max_concurrent_requests is None:
+            max_concurrent_requests = \
+                consistent_sdb.get_client().setting('sidecar_max_concurrent_requests')
+
+        self.slots = threading.BoundedSemaphore(max_concurrent_requests)
+
+        self._remove_stale_socket(socket_path)
+
+        # The socket is created accessible to its owner only, chmod()ing it
+        # after the bind would leave a window in which others can connect
+        umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.__init__(
+                                                   self,
+                                                   socket_path,
+                                                   SidecarRequestHandler
+                                                  )
+        finally:
+            os.umask(umask)
+
+    def _remove_stale_socket(self, socket_path):
+        # A socket left by a previous sidecar would fail the bind. Anything
+        # else at the path (e.g. a socket of another user waiting for our
+        # clients) is refused.
+        try:
+            path_stat = os.lstat(socket_path)
+        except OSError:
+            return
+
+        if not stat.S_ISSOCK(path_stat.st_mode) or path_stat.st_uid != os.getuid():
+            raise paths.InsecurePathError(
+                '%s is not a socket of the current user' % socket_path
+            )
+
+        os.remove(socket_path)
+
+    def verify_request(self, request, client_address):
+        return trusted_peer(request)
+
+    def dispatch(self, action, args, kwargs, timeout=None):
+        """Returns (ok, value) of a request: the action's result or the
+        exception it raised. The action must finish within timeout seconds,
+        if it isn't None.
+
+        """
+
+        if action not in actions:
+            return (False, SidecarError('Unknown action: %s' % action))
+
+        try:
+            if timeout is None:
+                return (True, getattr(self.consistent_sdb, action)(*args, **kwargs))
+
+            with deadlines.deadline(timeout):
+                return (True, getattr(self.consistent_sdb, action)(*args, **kwargs))
+        except Exception as error:
+            return (False, error)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+# CLIENT:
+class SidecarClient(object):
+    """Calls the sidecar listening on socket_path (default_socket_path() by
+    default). Sidecars of other users are refused (see trusted_peer()).
+
+    Each thread gets its own connection, connections made by a parent process
+    aren't used by its children.
+
+    """
+
+    def __init__(self, socket_path=None):
+        if socket_path is None:
+            socket_path = default_socket_path()
+
+        self.socket_path = socket_path
+
+        self._local = threading.local()
+
+    def _connection(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.pid = os.getpid()
+            self._local.connection = None
+
+        if self._local.connection is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            try:
+                connection.connect(self.socket_path)
+            except socket.error as error:
+                connection.close()
+                raise SidecarError('Sidecar unavailable: %s' % error)
+
+            if not trusted_peer(connection):
+                connection.close()
+                raise SidecarError(
+                    'The sidecar at %s runs as another user' % self.socket_path
+                )
+
+            self._local.connection = connection
+
+        return self._local.connection
+
+    def call(self, action, *args, **kwargs):
+        """Runs consistent_sdb's action(*args, **kwargs) on the sidecar, within
+        the deadline in effect, and returns its result, or raises the
+        exception it raised.
+
+        """
+
+        # Raises DeadlineExceeded if the deadline already passed
+        timeout = deadlines.timeout(None)
+
+        connection = self._connection()
+
+        try:
+            write_frame(connection, (action, args, kwargs, timeout))
+            response = read_frame(connection)
+        except:
+            # The connection state is unknown, don't let other calls use it
+            self.close()
+            raise
+
+        if response is None:
+            self.close()
+            raise SidecarError('Sidecar closed the connection')
+
+        ok, value = response
+        if not ok:
+            raise rebuild_error(*value)
+
+        return value
+
+    def close(self):
+        """Closes the calling thread's connection"""
+
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+
+        if connection is not None:
+            connection.close()
+
+_default_client = None
+
+def default_client():
+    """The SidecarClient used by the module's functions"""
+
+    global _default_client
+
+    if _default_client is None:
+        _default_client = SidecarClient()
+
+    return _default_client
+
+def get(records):
+    return default_client().call('get', records)
+
+def put(records):
+    return default_client().call('put', records)
+
+def delete(records):
+    return default_client().call('delete', records)
+
+def select(output_list, domain_name, expression=None, sort_instructions=None, limit=None, correct_membership=None):
+    return default_client().call(
+                                 'select',
+                                 output_list,
+                                 domain_name,
+                                 expression,
+                                 sort_instructions,
+                                 limit,
+                                 correct_membership
+                                )
+
+def bulk_get(records, max_concurrency=None):
+    return default_client().call('bulk_get', records, max_concurrency)
+
+def bulk_put(records, max_concurrency=None):
+    return default_client().call('bulk_put', records, max_concurrency)
+
+def bulk_delete(records, max_concurrency=None):
+    return default_client().call('bulk_delete', records, max_concurrency)
+
+def main():
+    server = SidecarServer()
+
+    # The sidecar serves many processes, its first requests shouldn't wait
+    # for connections
+    server.consistent_sdb.warmup()
+
+    print 'Serving consistent_sdb on %s' % server.server_address
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,5 +5,31 @@
 
 """
 
+import threading
+
 random_expired_items_deletes = 0
 latest_changes_applied = 0
+snapshot_cache_hits = 0
+select_cache_hits = 0
+journal_compactions = 0
+journal_truncations = 0
+consistent_read_fallbacks = 0
+journal_reads_skipped = 0
+coalesced_gets = 0
+stale_reads = 0
+
+# journal janitor (see the janitor module)
+janitor_scanned_journals = 0
+janitor_expired_items_deletes = 0
+janitor_sweeps = 0
+janitor_errors = 0
+
+# The counters are incremented by concurrent threads, so they are changed only
+# through increment()
+_lock = threading.Lock()
+
+def increment(counter, amount=1):
+    """Adds amount to the counter named counter, atomically"""
+
+    with _lock:
+        globals()[counter] += amount
@@ -0,0 +1,27 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Timestamps used by the journaling layer
+
+"""
+
+import datetime
+
+def current_timestamp():
+    """Returns a string representing the current date and time in ISO 8601
+    
+    All the timestamps in this module are in the UTC tz.
+
+    """
+
+    return datetime.datetime.utcnow().isoformat()
+
+def parse_timestamp(timestamp):
+    """Get ISO 8601 string of the format:"%Y-%m-%dT%H:%M:%S.%f" and returns
+    datetime.datetime object set according to this string
+    
+    """
+
+    format = "%Y-%m-%dT%H:%M:%S.%f"
+
+    return datetime.datetime.strptime(timestamp, format)
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""In memory stand-ins for the connections consistent_sdb makes, so its
+actions can be tested without simpledb (see connect_fakes()).
+
+"""
+
+import time
+import threading
+from collections import defaultdict
+
+from orderedset import OrderedSet
+
+import consistent_sdb
+from aws_simpledb import expression as select_expression
+
+class FakeSimpleDB(object):
+    """Keeps the domains in memory, with the interface of aws_simpledb's
+    SimpleDB connection.
+
+    calls lists the (action, domain, items) of the requests made, items is
+    the amount of items of batch requests and the item's name otherwise.
+    Each request takes delay seconds, max_in_flight is the largest amount of
+    requests that were made concurrently. Select results are paged by
+    page_size items (or by their limit).
+
+    """
+
+    max_batch_items = 25
+
+    def __init__(self, delay=0, page_size=100):
+        self.delay = delay
+        self.page_size = page_size
+
+        # {domain: {item: {attribute: OrderedSet}}}
+        self.domains = defaultdict(dict)
+
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def _request(self, action, domain, items):
+        with self._lock:
+            self.calls.append((action, domain, items))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        if self.delay:
+            time.sleep(self.delay)
+
+        with self._lock:
+            self.in_flight -= 1
+
+    def calls_of(self, action):
+        return [call for call in self.calls if call[0] == action]
+
+    def put_attributes(self, domain, item, attributes):
+        self._request('put_attributes', domain, item)
+        self._put(domain, item, attributes)
+
+    def batch_put_attributes(self, domain, items):
+        assert len(items) <= self.max_batch_items
+
+        self._request('batch_put_attributes', domain, len(items))
+        for item, attributes in items.items():
+            self._put(domain, item, attributes)
+
+    def _put(self, domain, item, attributes):
+        with self._lock:
+            item_dictionary = self.domains[domain].setdefault(item, {})
+
+            for attribute, params in attributes.items():
+                if params['replace'] or attribute not in item_dictionary:
+                    item_dictionary[attribute] = OrderedSet(params['values'])
+                else:
+                    for value in params['values']:
+                        item_dictionary[attribute].add(value)
+
+    def delete_attributes(self, domain, item, attributes=None):
+        self._request('delete_attributes', domain, item)
+        self._delete(domain, item, attributes)
+
+    def batch_delete_attributes(self, domain, items):
+        assert len(items) <= self.max_batch_items
+
+        self._request('batch_delete_attributes', domain, len(items))
+        for item, attributes in items.items():
+            self._delete(domain, item, attributes)
+
+    def _delete(self, domain, item, attributes):
+        with self._lock:
+            item_dictionary = self.domains[domain].get(item)
+            if item_dictionary is None:
+                return
+
+            if not attributes:
+                del self.domains[domain][item]
+                return
+
+            for attribute, values in attributes.items():
+                if not values:
+                    item_dictionary.pop(attribute, None)
+                elif attribute in item_dictionary:
+                    item_dictionary[attribute] = OrderedSet([
+                        value for value in item_dictionary[attribute] if
+                        value not in values
+                    ])
+
+                    if not item_dictionary[attribute]:
+                        del item_dictionary[attribute]
+
+            if not item_dictionary:
+                del self.domains[domain][item]
+
+    def get_attributes(self, domain, item, attributes=None, consistent_read=False):
+        self._request('get_attributes', domain, item)
+
+        result = defaultdict(OrderedSet)
+        for attribute in (attributes or []):
+            result[attribute] = OrderedSet()
+
+        with self._lock:
+            for attribute, values in self.domains[domain].get(item, {}).items():
+                if not attributes or attribute in attributes:
+                    result[attribute] = OrderedSet(values)
+
+        return result
+
+    def select(self, output_list, domain_name, expression=None, sort_instructions=None, limit=None):
+        return [
+                item for
+                page in self.select_pages(output_list, domain_name, expression, sort_instructions, limit) for
+                item in page
+               ]
+
+    def select_pages(self, output_list, domain_name, expression=None, sort_instructions=None, limit=None):
+        matches = select_expression.compile_expression(expression)
+
+        with self._lock:
+            items = [
+                     (item_name, dict(item_dictionary)) for
+                     (item_name, item_dictionary) in sorted(self.domains[domain_name].items()) if
+                     matches(item_name, item_dictionary)
+                    ]
+
+        if sort_instructions is not None:
+            items = select_expression.compile_sort(sort_instructions)(items)
+
+        page_size = limit or self.page_size
+
+        for start in range(0, len(items), page_size):
+            self._request('select', domain_name, None)
+
+            page = []
+            for item_name, item_dictionary in items[start:start + page_size]:
+                values = defaultdict(OrderedSet)
+
+                if output_list != 'itemName()':
+                    for attribute, attribute_values in item_dictionary.items():
+                        if output_list == '*' or attribute in output_list:
+                            values[attribute] = OrderedSet(attribute_values)
+
+                page.append({item_name: values})
+
+            yield page
+
+def connect_fakes(**config):
+    """Configures consistent_sdb (see consistent_sdb.configure()) with the
+    memory journal and config, connected to a new FakeSimpleDB, and returns
+    the fake.
+
+    """
+
+    fake = FakeSimpleDB()
+
+    config.setdefault('journal_backend', 'memory')
+    consistent_sdb.configure(**config)
+
+    client = consistent_sdb.get_client()
+    client._check_process()
+    client._connection = fake
+
+    return fake
@@ -0,0 +1,18 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""This module runs all the consistent_sdb tests
+"""
+
+import unittest
+import helpers
+
+test_modules = ['test_consistent_sdb', 'test_journal', 'test_concurrency', 'test_cache', 'test_deltas', 'test_sidecar', 'test_offline_actions']
+
+modules_suites = []
+for module in test_modules:
+    module = __import__(module)
+    modules_suites.append(unittest.TestLoader().loadTestsFromModule(module))
+
+all_tests = unittest.TestSuite(modules_suites)
+unittest.TextTestRunner(verbosity=2).run(all_tests)
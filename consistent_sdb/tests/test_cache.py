@@ -0,0 +1,179 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+import unittest
+
+import startup
+
+import time
+import datetime
+
+import consistent_sdb
+from consistent_sdb import cache
+
+class TestCache(unittest.TestCase):
+    """Tests the process local caches (no simpledb or redis connection
+    required).
+    """
+
+    def setUp(self):
+        self.start = datetime.datetime.utcnow()
+
+    def timestamp(self, index):
+        return (self.start + datetime.timedelta(microseconds=index)).isoformat()
+
+    def put_action_log(self, value):
+        return {
+                'action': 'put',
+                'attributes': {'a': {'values': [value], 'replace': False}}
+               }
+
+    def test_00_lru_eviction(self):
+        evicted = []
+        lru = cache.LRUCache(2, 60, on_evict=evicted.append)
+
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a') # 'b' is now the least recently used
+        lru.set('c', 3)
+
+        self.assertEqual(evicted, ['b'])
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('b'), None)
+        self.assertTrue('c' in lru)
+        self.assertEqual(len(lru), 2)
+
+    def test_01_lru_ttl(self):
+        lru = cache.LRUCache(2, 0.01)
+
+        lru.set('a', 1)
+        time.sleep(0.02)
+
+        self.assertEqual(lru.get('a', 'missing'), 'missing')
+        self.assertFalse('a' in lru)
+
+    def test_02_mirror_entries(self):
+        mirror = cache.JournalMirror(10, 60)
+
+        for index in range(3):
+            mirror.append('key', self.timestamp(index), self.put_action_log(str(index)))
+
+        self.assertEqual(
+                         mirror.entries('key'),
+                         [(self.timestamp(index), self.put_action_log(str(index))) for index in range(3)]
+                        )
+        self.assertEqual(
+                         mirror.entries('key', self.timestamp(1)),
+                         [(self.timestamp(2), self.put_action_log('2'))]
+                        )
+        self.assertEqual(mirror.head('key'), self.timestamp(2))
+        self.assertEqual(mirror.head('other'), None)
+        self.assertEqual(mirror.entries('other'), [])
+
+    def test_03_mirror_entries_are_copies(self):
+        mirror = cache.JournalMirror(10, 60)
+        mirror.append('key', self.timestamp(0), self.put_action_log('0'))
+
+        mirror.entries('key').append('changed')
+
+        self.assertEqual(len(mirror.entries('key')), 1)
+
+    def test_04_mirror_compaction(self):
+        mirror = cache.JournalMirror(10, 60, max_entries=4)
+
+        for index in range(5):
+            mirror.append('key', self.timestamp(index), self.put_action_log(str(index)))
+
+        (timestamp, action_log), = mirror.entries('key')
+
+        self.assertEqual(timestamp, self.timestamp(4))
+        self.assertEqual(action_log['action'], 'delta')
+        # Compacted entries don't reflect their timestamp's action alone
+        self.assertEqual(mirror.action_logs('key'), {})
+
+        mirror.append('key', self.timestamp(5), self.put_action_log('5'))
+
+        self.assertEqual(
+                         mirror.action_logs('key'),
+                         {self.timestamp(5): self.put_action_log('5')}
+                        )
+
+    def test_05_mirror_drops_expired_entries(self):
+        mirror = cache.JournalMirror(10, 0.05)
+
+        mirror.append('key', self.timestamp(0), self.put_action_log('0'))
+        time.sleep(0.06)
+
+        self.assertEqual(mirror.entries('key'), [])
+        self.assertEqual(mirror.head('key'), None)
+
+        timestamp = datetime.datetime.utcnow().isoformat()
+        mirror.append('key', timestamp, self.put_action_log('1'))
+
+        self.assertEqual(mirror._journals.get('key'), [(timestamp, self.put_action_log('1'))])
+
+    def test_06_mirror_authority(self):
+        self.assertFalse(cache.JournalMirror(10, 0.01).is_authoritative())
+
+        mirror = cache.JournalMirror(1, 0.05, exclusive=True)
+        self.assertFalse(mirror.is_authoritative())
+
+        time.sleep(0.06)
+        self.assertTrue(mirror.is_authoritative())
+
+        # Evicting live entries makes the mirror incomplete
+        now = datetime.datetime.utcnow()
+        mirror.append('key1', now.isoformat(), self.put_action_log('1'))
+        mirror.append('key2', now.isoformat(), self.put_action_log('2'))
+        self.assertFalse(mirror.is_authoritative())
+
+        # A disabled mirror is never authoritative
+        self.assertFalse(cache.JournalMirror(0, 0, exclusive=True).is_authoritative())
+
+    def test_07_snapshots_are_copies(self):
+        snapshots = cache.MemorySnapshotCache(10, 60)
+        snapshot = {'timestamp': self.timestamp(0), 'previous': None, 'item': {'a': ['1']}}
+
+        snapshots.set_many({'key': snapshot})
+        snapshot['item']['a'].append('2')
+
+        cached, missing = snapshots.get_many(['key', 'other'])
+
+        self.assertEqual(cached['item'], {'a': ['1']})
+        self.assertEqual(missing, None)
+
+        cached['item']['a'].append('3')
+
+        self.assertEqual(snapshots.get_many(['key'])[0]['item'], {'a': ['1']})
+
+    def test_08_select_cache_key(self):
+        key = consistent_sdb.select_cache_key(
+                                              ['b', 'a', 'b'],
+                                              'domain',
+                                              " a = '1' ",
+                                              'a asc ',
+                                              10
+                                             )
+
+        self.assertEqual(
+                         key,
+                         consistent_sdb.select_cache_key(['a', 'b'], 'domain', "a = '1'", 'a asc', 10)
+                        )
+        self.assertNotEqual(
+                            key,
+                            consistent_sdb.select_cache_key(['a', 'b'], 'domain', "a = '1'", 'a asc', 20)
+                           )
+        self.assertNotEqual(
+                            key,
+                            consistent_sdb.select_cache_key(['a', 'b'], 'domain', "a = '1'", 'a asc', 10, True)
+                           )
+        self.assertEqual(
+                         consistent_sdb.select_cache_key('*', 'domain', None, None, None),
+                         ('*', 'domain', None, None, None, False)
+                        )
+
+        # Keys are used in dictionaries
+        hash(key)
+
+if __name__ == '__main__':
+    unittest.main()
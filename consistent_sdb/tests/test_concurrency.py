@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+import unittest
+
+import startup
+
+import time
+import threading
+
+from consistent_sdb import concurrency
+from aws_simpledb import deadlines
+
+class TestConcurrency(unittest.TestCase):
+    """Tests the threading helpers (no simpledb or redis connection
+    required).
+    """
+
+    def test_00_future_result(self):
+        future = concurrency.run_in_background(lambda x: x * 2, 21)
+
+        self.assertEqual(future.result(1), 42)
+        self.assertTrue(future.done())
+        self.assertEqual(future.exception(), None)
+
+    def test_01_future_exception(self):
+        def fail():
+            raise ValueError('failed')
+
+        future = concurrency.run_in_background(fail)
+
+        self.assertTrue(future.wait(1))
+        self.assertTrue(isinstance(future.exception(), ValueError))
+        self.assertRaises(ValueError, future.result)
+
+    def test_02_future_not_done(self):
+        event = threading.Event()
+        future = concurrency.run_in_background(event.wait)
+
+        self.assertRaises(RuntimeError, future.result, 0.01)
+
+        event.set()
+        future.wait(1)
+
+    def test_03_done_callbacks(self):
+        future = concurrency.Future()
+        called = []
+
+        def failing_callback(future):
+            raise ValueError('failed')
+
+        future.add_done_callback(failing_callback)
+        future.add_done_callback(lambda future: called.append(future.result()))
+        future.set_result('result')
+
+        # Callbacks added once the future is done are called right away
+        future.add_done_callback(lambda future: called.append('late'))
+
+        self.assertEqual(called, ['result', 'late'])
+
+    def test_04_executor_bounds_threads(self):
+        executor = concurrency.Executor(3)
+        running = []
+        max_running = []
+        lock = threading.Lock()
+
+        def call(index):
+            with lock:
+                running.append(index)
+                max_running.append(len(running))
+
+            time.sleep(0.01)
+
+            with lock:
+                running.remove(index)
+
+            return index
+
+        futures = [executor.submit(call, index) for index in range(20)]
+
+        self.assertEqual([future.result(5) for future in futures], range(20))
+        self.assertTrue(max(max_running) <= 3)
+        self.assertTrue(len(executor._workers) <= 3)
+
+    def test_05_executor_reuses_threads(self):
+        executor = concurrency.Executor(3)
+
+        for index in range(10):
+            executor.submit(threading.current_thread).result(1)
+
+        self.assertEqual(len(executor._workers), 1)
+
+    def test_06_run_limited(self):
+        executor = concurrency.Executor(10)
+        running = []
+        max_running = []
+        lock = threading.Lock()
+
+        def call(index):
+            with lock:
+                running.append(index)
+                max_running.append(len(running))
+
+            time.sleep(0.01)
+
+            with lock:
+                running.remove(index)
+
+            if index == 3:
+                raise ValueError(index)
+
+            return index
+
+        futures = concurrency.run_limited(
+                                          executor,
+                                          [(call, (index,)) for index in range(10)],
+                                          2
+                                         )
+
+        self.assertTrue(max(max_running) <= 2)
+        self.assertTrue(all([future.done() for future in futures]))
+        self.assertTrue(isinstance(futures[3].exception(), ValueError))
+        self.assertEqual(futures[4].result(), 4)
+
+    def test_07_run_concurrently(self):
+        executor = concurrency.Executor(2)
+
+        futures = concurrency.run_concurrently(
+                                               executor,
+                                               [(lambda x: x + 1, (index,)) for index in range(10)],
+                                               4
+                                              )
+
+        self.assertEqual([future.result() for future in futures], range(1, 11))
+        self.assertTrue(len(executor._workers) <= 2)
+
+    def test_08_single_call_runs_in_calling_thread(self):
+        executor = concurrency.Executor(2)
+
+        futures = concurrency.run_concurrently(executor, [(threading.current_thread, ())], 4)
+
+        self.assertTrue(futures[0].result() is threading.current_thread())
+        self.assertEqual(executor._workers, [])
+
+    def test_09_deadline_inherited(self):
+        executor = concurrency.Executor(2)
+
+        with deadlines.deadline(10) as deadline_in_effect:
+            background = concurrency.run_in_background(deadlines.current)
+            pooled = executor.submit(deadlines.current)
+
+            self.assertTrue(background.result(1) is deadline_in_effect)
+            self.assertTrue(pooled.result(1) is deadline_in_effect)
+
+        # The pool's threads don't keep the deadline of a previous call
+        self.assertEqual(executor.submit(deadlines.current).result(1), None)
+
+    def test_10_shutdown(self):
+        executor = concurrency.Executor(2)
+        futures = [executor.submit(time.sleep, 0.01) for index in range(4)]
+
+        executor.shutdown(1)
+
+        self.assertTrue(all([future.done() for future in futures]))
+        self.assertFalse(any([worker.is_alive() for worker in executor._workers]))
+        self.assertRaises(RuntimeError, executor.submit, time.sleep, 0)
+
+if __name__ == '__main__':
+    unittest.main()
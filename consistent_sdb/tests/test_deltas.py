@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+import unittest
+
+import startup
+
+from consistent_sdb import deltas
+from orderedset import OrderedSet
+
+class TestDeltas(unittest.TestCase):
+    """Tests the composition of action logs into deltas (no simpledb or redis
+    connection required).
+    """
+
+    def put(self, attribute, values, replace=False):
+        return {
+                'action': 'put',
+                'attributes': {attribute: {'values': values, 'replace': replace}}
+               }
+
+    def delete(self, attributes=None):
+        return {'action': 'delete', 'attributes': attributes}
+
+    def replayed(self, item, action_logs):
+        item = dict([(attribute, OrderedSet(values)) for (attribute, values) in item.items()])
+
+        return dict([
+                     (attribute, list(values)) for
+                     (attribute, values) in
+                     deltas.apply_delta(item, deltas.compose_actions(action_logs)).items()
+                    ])
+
+    def test_00_puts(self):
+        self.assertEqual(
+                         self.replayed(
+                                       {'a': ['1'], 'b': ['x']},
+                                       [self.put('a', ['2']), self.put('b', ['y'], replace=True)]
+                                      ),
+                         {'a': ['1', '2'], 'b': ['y']}
+                        )
+
+    def test_01_deletes(self):
+        self.assertEqual(
+                         self.replayed(
+                                       {'a': ['1', '2'], 'b': ['x'], 'c': ['z']},
+                                       [self.delete({'a': ['1'], 'b': []})]
+                                      ),
+                         {'a': ['2'], 'c': ['z']}
+                        )
+        self.assertEqual(
+                         self.replayed(
+                                       {'a': ['1']},
+                                       [self.delete(), self.put('b', ['x'])]
+                                      ),
+                         {'b': ['x']}
+                        )
+
+    def test_02_add_then_remove(self):
+        self.assertEqual(
+                         self.replayed(
+                                       {'a': ['1']},
+                                       [self.put('a', ['2']), self.delete({'a': ['2']})]
+                                      ),
+                         {'a': ['1']}
+                        )
+        self.assertEqual(
+                         self.replayed(
+                                       {'a': ['1']},
+                                       [self.delete({'a': ['1']}), self.put('a', ['1'])]
+                                      ),
+                         {'a': ['1']}
+                        )
+
+    def test_03_idempotent(self):
+        action_logs = [
+                       self.put('a', ['2']),
+                       self.delete({'a': ['1']}),
+                       self.put('b', ['y'], replace=True)
+                      ]
+
+        once = self.replayed({'a': ['1'], 'b': ['x']}, action_logs)
+
+        # An item that already reflects some of the actions ends up the same
+        self.assertEqual(self.replayed({'a': ['2'], 'b': ['x']}, action_logs), once)
+        self.assertEqual(self.replayed(once, action_logs), once)
+
+    def test_04_delta_action_log(self):
+        action_logs = [self.delete(), self.put('a', ['1']), self.put('b', ['2'])]
+        delta_action_log = deltas.delta_action_log(deltas.compose_actions(action_logs))
+
+        self.assertEqual(
+                         self.replayed({'c': ['3']}, [delta_action_log]),
+                         self.replayed({'c': ['3']}, action_logs)
+                        )
+
+    def test_05_truncation_markers(self):
+        self.assertEqual(
+                         deltas.action_operations({'action': 'truncated', 'attributes': None}),
+                         []
+                        )
+
+    def test_06_action_logs_unchanged(self):
+        action_log = self.put('a', ['1'])
+
+        deltas.apply_delta({}, deltas.compose_actions([action_log]))['a'].add('2')
+
+        self.assertEqual(action_log, self.put('a', ['1']))
+
+if __name__ == '__main__':
+    unittest.main()
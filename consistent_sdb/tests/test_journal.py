@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+import unittest
+
+import startup
+
+import os
+import time
+import shutil
+import datetime
+import tempfile
+
+import consistent_sdb
+from consistent_sdb.journal import MemoryJournal, FileJournal, compact_entries
+from consistent_sdb.paths import InsecurePathError
+
+class TestJournal(unittest.TestCase):
+    """Tests the local journal backends, their compaction and truncation, and
+    consistent_sdb.replay_is_safe() (no redis or simpledb connection
+    required).
+    """
+
+    def setUp(self):
+        self.start = datetime.datetime.utcnow()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'journal')
+
+    def tearDown(self):
+        consistent_sdb.configure()
+        shutil.rmtree(self.directory)
+
+    def timestamp(self, index):
+        return (self.start + datetime.timedelta(microseconds=index)).isoformat()
+
+    def put_action_log(self, attribute, value, replace=False):
+        return {
+                'action': 'put',
+                'attributes': {attribute: {'values': [value], 'replace': replace}}
+               }
+
+    def test_00_compaction_merges_into_a_delta(self):
+        journal = MemoryJournal(60, compaction_threshold=3)
+
+        journal.append([
+                        ('domain', 'item', self.timestamp(index), self.put_action_log('a', str(index))) for
+                        index in range(4)
+                       ])
+
+        entries = journal.read('domain', ['item'])['item']
+
+        self.assertEqual(len(entries), 1)
+
+        timestamp, action_log = entries[0]
+        self.assertEqual(timestamp, self.timestamp(3))
+        self.assertEqual(action_log['action'], 'delta')
+        self.assertEqual(action_log['attributes']['cleared'], False)
+        self.assertEqual(
+                         action_log['attributes']['attributes'],
+                         {'a': (False, [], ['0', '1', '2', '3'])}
+                        )
+
+    def test_01_compaction_disabled(self):
+        journal = MemoryJournal(60)
+
+        journal.append([
+                        ('domain', 'item', self.timestamp(index), self.put_action_log('a', str(index))) for
+                        index in range(40)
+                       ])
+
+        self.assertEqual(len(journal.read('domain', ['item'])['item']), 40)
+
+    def test_02_compaction_keeps_replacements_absolute(self):
+        journal = MemoryJournal(60, compaction_threshold=2)
+
+        journal.append([
+                        ('domain', 'item', self.timestamp(0), self.put_action_log('a', '1')),
+                        ('domain', 'item', self.timestamp(1), {'action': 'delete', 'attributes': None}),
+                        ('domain', 'item', self.timestamp(2), self.put_action_log('a', '2', replace=True))
+                       ])
+
+        (timestamp, action_log), = journal.read('domain', ['item'])['item']
+
+        self.assertEqual(action_log['attributes']['cleared'], True)
+        self.assertEqual(
+                         action_log['attributes']['attributes'],
+                         {'a': (True, [], ['2'])}
+                        )
+
+    def test_03_compaction_per_item(self):
+        journal = MemoryJournal(60, compaction_threshold=2)
+
+        journal.append([
+                        ('domain', 'item1', self.timestamp(index), self.put_action_log('a', str(index))) for
+                        index in range(3)
+                       ] + [
+                        ('domain', 'item2', self.timestamp(3), self.put_action_log('a', '3'))
+                       ])
+
+        entries = journal.read('domain', ['item1', 'item2'])
+
+        self.assertEqual(len(entries['item1']), 1)
+        self.assertEqual(entries['item2'], [(self.timestamp(3), self.put_action_log('a', '3'))])
+        self.assertEqual(
+                         journal.heads('domain', ['item1', 'item2']),
+                         {'item1': self.timestamp(2), 'item2': self.timestamp(3)}
+                        )
+
+    def test_04_truncation_marker(self):
+        journal = MemoryJournal(60, max_entries=3)
+
+        journal.append([
+                        ('domain', 'item', self.timestamp(index), self.put_action_log('a', str(index))) for
+                        index in range(5)
+                       ])
+
+        entries = journal.read('domain', ['item'])['item']
+
+        self.assertEqual(
+                         entries,
+                         [
+                          (self.timestamp(2), {'action': 'truncated', 'attributes': None}),
+                          (self.timestamp(3), self.put_action_log('a', '3')),
+                          (self.timestamp(4), self.put_action_log('a', '4'))
+                         ]
+                        )
+
+    def test_05_compaction_keeps_truncation_marker(self):
+        marker = (self.timestamp(1), {'action': 'truncated', 'attributes': None})
+
+        entries = compact_entries([
+                                   (self.timestamp(0), self.put_action_log('a', '0')),
+                                   marker,
+                                   (self.timestamp(2), self.put_action_log('a', '2')),
+                                   (self.timestamp(3), self.put_action_log('a', '3'))
+                                  ])
+
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0], marker)
+        self.assertEqual(entries[1][0], self.timestamp(3))
+        self.assertEqual(entries[1][1]['action'], 'delta')
+
+    def test_06_replay_is_safe(self):
+        consistent_sdb.configure(journal_max_entries=2)
+
+        actions = [
+                   (self.timestamp(index), self.put_action_log('a', str(index))) for
+                   index in range(3)
+                  ]
+
+        self.assertTrue(consistent_sdb.replay_is_safe(self.timestamp(0), actions))
+        # More actions to replay than journal_max_entries
+        self.assertFalse(consistent_sdb.replay_is_safe(None, actions))
+
+        truncated = [(self.timestamp(1), {'action': 'truncated', 'attributes': None})] + actions[2:]
+
+        # The item precedes the dropped actions
+        self.assertFalse(consistent_sdb.replay_is_safe(self.timestamp(0), truncated))
+        self.assertFalse(consistent_sdb.replay_is_safe(None, truncated))
+        # The item reflects the dropped actions
+        self.assertTrue(consistent_sdb.replay_is_safe(self.timestamp(1), truncated))
+
+    def test_07_replay_is_safe_without_limit(self):
+        consistent_sdb.configure(journal_max_entries=0)
+
+        actions = [
+                   (self.timestamp(index), self.put_action_log('a', str(index))) for
+                   index in range(100)
+                  ]
+
+        self.assertTrue(consistent_sdb.replay_is_safe(None, actions))
+
+    def test_08_file_journal_shared(self):
+        writer = FileJournal(self.path, 60)
+        reader = FileJournal(self.path, 60)
+
+        writer.append([
+                       ('domain', 'item', self.timestamp(index), self.put_action_log('a', str(index))) for
+                       index in range(3)
+                      ])
+
+        self.assertEqual(
+                         reader.read('domain', ['item', 'other'], {'item': self.timestamp(0)}),
+                         {
+                          'item': [
+                                   (self.timestamp(1), self.put_action_log('a', '1')),
+                                   (self.timestamp(2), self.put_action_log('a', '2'))
+                                  ],
+                          'other': []
+                         }
+                        )
+        self.assertEqual(reader.heads('domain', ['item']), {'item': self.timestamp(2)})
+        self.assertEqual(reader.journaled_items('domain'), set(['item']))
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0600)
+
+    def test_09_file_journal_refuses_shared_files(self):
+        open(self.path, 'w').close()
+        os.chmod(self.path, 0666)
+
+        journal = FileJournal(self.path, 60)
+
+        self.assertRaises(InsecurePathError, journal.read, 'domain', ['item'])
+
+    def test_10_file_journal_compacts_expired_records(self):
+        journal = FileJournal(self.path, 0.05)
+
+        for index in range(20):
+            journal.append([(
+                             'domain',
+                             'item%d' % index,
+                             datetime.datetime.utcnow().isoformat(),
+                             self.put_action_log('a', str(index))
+                           )])
+
+        full_size = os.path.getsize(self.path)
+        time.sleep(0.06)
+
+        journal.append([(
+                         'domain',
+                         'item',
+                         datetime.datetime.utcnow().isoformat(),
+                         self.put_action_log('a', '1')
+                       )])
+
+        self.assertTrue(os.path.getsize(self.path) < full_size / 10)
+        self.assertEqual(journal.journaled_items('domain'), set(['item']))
+
+if __name__ == '__main__':
+    unittest.main()
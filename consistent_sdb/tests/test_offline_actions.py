@@ -0,0 +1,379 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+import unittest
+
+import startup
+
+import copy
+import time
+import datetime
+from collections import defaultdict
+
+from orderedset import OrderedSet
+
+import consistent_sdb
+from consistent_sdb import status
+from consistent_sdb.janitor import Janitor
+from aws_simpledb import deadlines
+
+from fakes import connect_fakes
+
+class TestOfflineActions(unittest.TestCase):
+    """Tests the consistent_sdb actions against a fake simpledb and the
+    memory journal (no simpledb or redis connection required).
+    """
+
+    domain = 'test_domain'
+
+    def setUp(self):
+        self.sdb = connect_fakes()
+
+    def tearDown(self):
+        consistent_sdb.configure()
+
+    def item_names(self, amount):
+        return ['item_%02d' % index for index in range(amount)]
+
+    def put_items(self, item_names):
+        consistent_sdb.put({
+            self.domain: dict([
+                               (item_name, {'a': {'values': ['1'], 'replace': True}}) for
+                               item_name in item_names
+                              ])
+        })
+
+        del self.sdb.calls[:]
+
+    def test_00_delete_batches_with_markers(self):
+        item_names = self.item_names(30)
+        self.put_items(item_names)
+
+        consistent_sdb.delete({
+                               self.domain: dict([
+                                                  (item_name, {}) for
+                                                  item_name in item_names
+                                                 ])
+                              })
+
+        # Each batch delete is followed by the batch put of its items'
+        # last changed attribute
+        self.assertEqual(
+                         [(action, items) for (action, domain, items) in self.sdb.calls],
+                         [
+                          ('batch_delete_attributes', 25),
+                          ('batch_put_attributes', 25),
+                          ('batch_delete_attributes', 5),
+                          ('batch_put_attributes', 5)
+                         ]
+                        )
+
+        marker = consistent_sdb.last_changed_attribute_key()
+        for item_name in item_names:
+            self.assertEqual(self.sdb.domains[self.domain][item_name].keys(), [marker])
+
+            actions = consistent_sdb.fetch_latest_actions(self.domain, item_name)
+            self.assertEqual(actions[-1][1]['action'], 'delete')
+
+        result = consistent_sdb.get({self.domain: {item_names[0]: []}})
+        self.assertEqual(dict(result[self.domain][item_names[0]]), {})
+
+    def test_01_put_chunks_concurrently(self):
+        self.sdb = connect_fakes(max_concurrent_requests=3)
+        self.sdb.delay = 0.05
+
+        item_names = self.item_names(60)
+        records = {
+                   self.domain: dict([
+                                      (item_name, {'a': {'values': set(['1']), 'replace': False}}) for
+                                      item_name in item_names
+                                     ]),
+                   'other_domain': {'single': {'b': {'values': set(['2']), 'replace': True}}}
+                  }
+        original_records = copy.deepcopy(records)
+
+        consistent_sdb.put(records)
+
+        self.assertEqual(records, original_records)
+
+        # Chunks of up to 25 items, a single item is put without a batch
+        self.assertEqual(
+                         sorted([items for (action, domain, items) in self.sdb.calls_of('batch_put_attributes')]),
+                         [10, 25, 25]
+                        )
+        self.assertEqual(self.sdb.calls_of('put_attributes'), [('put_attributes', 'other_domain', 'single')])
+        self.assertTrue(1 < self.sdb.max_in_flight <= 3)
+
+        marker = consistent_sdb.last_changed_attribute_key()
+        self.assertEqual(sorted(self.sdb.domains[self.domain][item_names[0]].keys()), ['a', marker])
+
+        for domain, item_name in [(self.domain, item_names[-1]), ('other_domain', 'single')]:
+            actions = consistent_sdb.fetch_latest_actions(domain, item_name)
+            self.assertEqual([action_log['action'] for (timestamp, action_log) in actions], ['put'])
+
+    def make_stale(self, change):
+        # Makes change through consistent_sdb while the fake simpledb keeps
+        # showing the items as they were before it
+        stale_domain = copy.deepcopy(self.sdb.domains[self.domain])
+
+        change()
+
+        self.sdb.domains[self.domain] = stale_domain
+        del self.sdb.calls[:]
+
+    def test_02_iter_select_pages(self):
+        self.sdb.page_size = 3
+
+        item_names = self.item_names(7)
+        self.put_items(item_names)
+        self.make_stale(lambda: consistent_sdb.put({
+            self.domain: {'item_04': {'a': {'values': ['2'], 'replace': True}}}
+        }))
+
+        results = consistent_sdb.iter_select('*', self.domain)
+
+        # Pages are read only as they're consumed
+        self.assertEqual(self.sdb.calls_of('select'), [])
+
+        item_name, item_values = next(results)
+        self.assertEqual(item_name, 'item_00')
+        self.assertEqual(len(self.sdb.calls_of('select')), 1)
+
+        results = dict([(item_name, item_values)] + list(results))
+
+        self.assertEqual(len(self.sdb.calls_of('select')), 3)
+        self.assertEqual(sorted(results), item_names)
+        # The page's journals are applied
+        self.assertEqual(list(results['item_04']['a']), ['2'])
+        self.assertEqual(list(results['item_03']['a']), ['1'])
+        self.assertFalse(consistent_sdb.last_changed_attribute_key() in results['item_00'])
+
+        self.assertEqual(consistent_sdb.select('*', self.domain), results)
+
+    def test_03_janitor_ticks(self):
+        expired_timestamp = (
+                             datetime.datetime.utcnow() -
+                             datetime.timedelta(seconds=consistent_sdb.client.setting('journal_ttl') + 60)
+                            ).isoformat()
+        action_log = {'action': 'put', 'attributes': {'a': {'values': ['1'], 'replace': True}}}
+
+        item_names = self.item_names(5)
+        consistent_sdb.journal.append([
+                                       (self.domain, item_name, expired_timestamp, action_log) for
+                                       item_name in item_names
+                                      ])
+        self.put_items(item_names[:1])
+
+        janitor = Janitor(consistent_sdb.journal, 2, 1)
+        sweeps = status.janitor_sweeps
+
+        def sweep():
+            deleted = [janitor.tick()]
+            while janitor.cursor != 0:
+                deleted.append(janitor.tick())
+
+            return deleted
+
+        first_sweep = sweep()
+
+        # Each tick scans only the next journals
+        self.assertTrue(len(first_sweep) > 1)
+        # Journals removed during a sweep might be skipped until the next one
+        self.assertEqual(sum(first_sweep) + sum(sweep()), 5)
+        self.assertEqual(status.janitor_sweeps, sweeps + 2)
+
+        # Live entries are kept
+        self.assertEqual(len(consistent_sdb.fetch_latest_actions(self.domain, item_names[0])), 1)
+        self.assertEqual(consistent_sdb.journal.scan(0, 100)[1], [consistent_sdb.actions_journal_key(self.domain, item_names[0])])
+
+    def test_04_corrected_select(self):
+        consistent_sdb.put({
+            self.domain: {
+                          'item_01': {'a': {'values': ['1'], 'replace': True}},
+                          'item_02': {'a': {'values': ['5'], 'replace': True}},
+                          'item_03': {'a': {'values': ['7'], 'replace': True}}
+                         }
+        })
+
+        def change():
+            consistent_sdb.put({
+                self.domain: {
+                              'item_01': {'a': {'values': ['6'], 'replace': True}},
+                              'item_04': {
+                                          'a': {'values': ['9'], 'replace': True},
+                                          'b': {'values': ['x'], 'replace': True}
+                                         }
+                             }
+            })
+            consistent_sdb.delete({self.domain: {'item_03': {}}})
+
+        self.make_stale(change)
+        # Changed by another server, simpledb's view of it is current
+        self.sdb.domains[self.domain]['item_05'] = {'a': OrderedSet(['8'])}
+
+        results = list(consistent_sdb.iter_select(
+                                                  ['b'],
+                                                  self.domain,
+                                                  "a > '4'",
+                                                  'a desc',
+                                                  correct_membership=True
+                                                 ))
+
+        # New matches are added in their sort position, items that no longer
+        # match are dropped
+        self.assertEqual(
+                         [item_name for (item_name, item_values) in results],
+                         ['item_04', 'item_05', 'item_01', 'item_02']
+                        )
+        self.assertTrue(all([type(item_values) is defaultdict for (item_name, item_values) in results]))
+        # Missing attributes are left out, as in simpledb's results
+        self.assertEqual(
+                         [dict(item_values) for (item_name, item_values) in results],
+                         [{'b': OrderedSet(['x'])}, {}, {}, {}]
+                        )
+
+        limited = consistent_sdb.iter_select(
+                                             '*',
+                                             self.domain,
+                                             "a > '4'",
+                                             'a desc',
+                                             limit=2,
+                                             correct_membership=True
+                                            )
+        self.assertEqual([item_name for (item_name, item_values) in limited], ['item_04', 'item_05'])
+
+        names = consistent_sdb.select('itemName()', self.domain, "a > '4'", correct_membership=True)
+        self.assertEqual(
+                         sorted([item.keys()[0] for item in names]),
+                         ['item_01', 'item_02', 'item_04', 'item_05']
+                        )
+
+    def test_05_journal_head_check(self):
+        self.sdb.domains[self.domain]['unjournaled'] = {'a': OrderedSet(['1'])}
+        self.put_items(['current', 'stale'])
+        self.make_stale(lambda: consistent_sdb.put({
+            self.domain: {'stale': {'a': {'values': ['2'], 'replace': True}}}
+        }))
+
+        skipped = status.journal_reads_skipped
+
+        # An item without live journal entries is served without reading its
+        # journal
+        result = consistent_sdb.get({self.domain: {'unjournaled': []}})
+        self.assertEqual(list(result[self.domain]['unjournaled']['a']), ['1'])
+        self.assertEqual(status.journal_reads_skipped, skipped + 1)
+
+        result = consistent_sdb.get({self.domain: {'stale': []}})
+        self.assertEqual(list(result[self.domain]['stale']['a']), ['2'])
+        self.assertEqual(status.journal_reads_skipped, skipped + 1)
+
+        # Selected items at least as new as their journal's head aren't
+        # replayed
+        results = consistent_sdb.select('*', self.domain)
+        self.assertEqual(sorted(results), ['current', 'stale', 'unjournaled'])
+        self.assertEqual(list(results['stale']['a']), ['2'])
+        self.assertEqual(status.journal_reads_skipped, skipped + 2)
+
+    def test_06_async_actions(self):
+        self.put_items(['item_00'])
+
+        put = consistent_sdb.put_async({self.domain: {'item_01': {'a': {'values': ['2'], 'replace': True}}}})
+        self.assertEqual(put.result(5), None)
+
+        get = consistent_sdb.get_async({self.domain: {'item_00': [], 'item_01': ['a']}})
+        select = consistent_sdb.select_async('*', self.domain, "a = '2'")
+
+        self.assertEqual(
+                         dict([(item_name, list(item_values['a'])) for (item_name, item_values) in get.result(5)[self.domain].items()]),
+                         {'item_00': ['1'], 'item_01': ['2']}
+                        )
+        self.assertEqual(select.result(5).keys(), ['item_01'])
+
+        consistent_sdb.delete_async({self.domain: {'item_00': {}}}).result(5)
+        self.assertEqual(dict(consistent_sdb.get({self.domain: {'item_00': []}})[self.domain]['item_00']), {})
+
+    def test_07_async_actions_inherit_deadline(self):
+        with deadlines.deadline(0.01):
+            time.sleep(0.02)
+            future = consistent_sdb.get_async({self.domain: {'item_00': []}})
+
+        self.assertTrue(future.wait(5))
+        self.assertTrue(isinstance(future.exception(), deadlines.DeadlineExceeded))
+        self.assertEqual(self.sdb.calls, [])
+
+    def test_08_bulk_actions(self):
+        item_names = self.item_names(60)
+
+        consistent_sdb.bulk_put({
+            self.domain: dict([
+                               (item_name, {'a': {'values': ['1'], 'replace': True}}) for
+                               item_name in item_names
+                              ])
+        }, max_concurrency=2)
+
+        # A part per simpledb request
+        self.assertEqual(
+                         sorted([items for (action, domain, items) in self.sdb.calls_of('batch_put_attributes')]),
+                         [10, 25, 25]
+                        )
+
+        result = consistent_sdb.bulk_get({self.domain: dict([(item_name, []) for item_name in item_names])})
+        self.assertEqual(sorted(result[self.domain]), item_names)
+        self.assertEqual(len(self.sdb.calls_of('get_attributes')), 60)
+
+        consistent_sdb.bulk_delete({self.domain: dict([(item_name, {}) for item_name in item_names[:30]])})
+        self.assertEqual(
+                         sorted([items for (action, domain, items) in self.sdb.calls_of('batch_delete_attributes')]),
+                         [5, 25]
+                        )
+
+        result = consistent_sdb.get({self.domain: {item_names[0]: [], item_names[-1]: []}})
+        self.assertEqual(dict(result[self.domain][item_names[0]]), {})
+        self.assertEqual(list(result[self.domain][item_names[-1]]['a']), ['1'])
+
+    def test_09_bulk_action_failures(self):
+        self.put_items(['item_00', 'item_01'])
+
+        get_attributes = self.sdb.get_attributes
+
+        def failing_get_attributes(domain, item, attributes=None, consistent_read=False):
+            if item == 'item_01':
+                raise ValueError('failed')
+
+            return get_attributes(domain, item, attributes, consistent_read)
+
+        self.sdb.get_attributes = failing_get_attributes
+
+        try:
+            consistent_sdb.bulk_get({self.domain: {'item_00': [], 'item_01': []}})
+        except consistent_sdb.BulkActionError as error:
+            # The other parts aren't stopped
+            self.assertEqual(error.result[self.domain].keys(), ['item_00'])
+            self.assertEqual(len(error.failures), 1)
+            self.assertEqual(error.failures[0][0], {self.domain: {'item_01': []}})
+            self.assertTrue(isinstance(error.failures[0][1], ValueError))
+        else:
+            self.fail('BulkActionError not raised')
+
+    def test_10_snapshots_of_compacted_journals(self):
+        self.sdb = connect_fakes(snapshot_cache='memory', journal_compaction_threshold=2)
+        self.put_items(['item_00'])
+
+        # Reading the entire item stores its snapshot, the following puts
+        # update it
+        consistent_sdb.get({self.domain: {'item_00': []}})
+
+        for value in ['2', '3', '4', '5']:
+            consistent_sdb.put({self.domain: {'item_00': {'a': {'values': [value], 'replace': False}}}})
+
+        actions = consistent_sdb.fetch_latest_actions(self.domain, 'item_00')
+        self.assertEqual(actions[-1][1]['action'], 'delta')
+
+        hits = status.snapshot_cache_hits
+        result = consistent_sdb.get({self.domain: {'item_00': []}})
+
+        self.assertEqual(status.snapshot_cache_hits, hits + 1)
+        self.assertEqual(list(result[self.domain]['item_00']['a']), ['1', '2', '3', '4', '5'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+import unittest
+
+import startup
+
+import os
+import stat
+import shutil
+import socket
+import pickle
+import tempfile
+import threading
+
+import consistent_sdb
+from consistent_sdb import sidecar
+from consistent_sdb.paths import InsecurePathError
+from aws_simpledb import deadlines
+
+class TestSidecar(unittest.TestCase):
+    """Tests the sidecar's framing and socket handling (no simpledb or redis
+    connection required).
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'sidecar.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_00_frames(self):
+        left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            request = ('get', ({'domain': {'item': []}},), {}, None)
+            sidecar.write_frame(left, request)
+            sidecar.write_frame(left, 'x' * 100000)
+
+            self.assertEqual(sidecar.read_frame(right), request)
+            self.assertEqual(sidecar.read_frame(right), 'x' * 100000)
+
+            left.close()
+
+            self.assertEqual(sidecar.read_frame(right), None)
+        finally:
+            right.close()
+
+    def test_01_truncated_frame(self):
+        left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            left.sendall(sidecar.frame_header.pack(10) + 'abc')
+            left.close()
+
+            self.assertRaises(sidecar.SidecarError, sidecar.read_frame, right)
+        finally:
+            right.close()
+
+    def test_02_trusted_peer(self):
+        left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            self.assertTrue(sidecar.trusted_peer(left))
+        finally:
+            left.close()
+            right.close()
+
+    def test_03_server(self):
+        server = sidecar.SidecarServer(self.socket_path, 2)
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode), 0600)
+
+            client = sidecar.SidecarClient(self.socket_path)
+            self.assertRaises(sidecar.SidecarError, client.call, 'configure')
+            client.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_04_server_refuses_other_files(self):
+        open(self.socket_path, 'w').close()
+
+        self.assertRaises(InsecurePathError, sidecar.SidecarServer, self.socket_path, 2)
+        self.assertTrue(os.path.exists(self.socket_path))
+
+    def test_05_unavailable(self):
+        client = sidecar.SidecarClient(self.socket_path)
+
+        self.assertRaises(sidecar.SidecarError, client.call, 'get', {})
+
+    def test_06_bulk_action_error_pickled(self):
+        error = consistent_sdb.BulkActionError(
+                                               [({'domain': {'item': []}}, ValueError('failed'))],
+                                               {'domain': {}}
+                                              )
+
+        unpickled = pickle.loads(pickle.dumps(error, pickle.HIGHEST_PROTOCOL))
+
+        self.assertEqual(str(unpickled), str(error))
+        self.assertEqual(unpickled.failures[0][0], {'domain': {'item': []}})
+        self.assertEqual(unpickled.result, {'domain': {}})
+
+    def test_07_error_state(self):
+        error = deadlines.DeadlineExceeded(partial={'items': {'item': {}}})
+
+        state = pickle.loads(pickle.dumps(sidecar.error_state(error), pickle.HIGHEST_PROTOCOL))
+        rebuilt = sidecar.rebuild_error(*state)
+
+        self.assertTrue(isinstance(rebuilt, deadlines.DeadlineExceeded))
+        self.assertEqual(str(rebuilt), str(error))
+        self.assertEqual(rebuilt.partial, {'items': {'item': {}}})
+
+    def test_08_deadline_forwarded(self):
+        class Actions(object):
+            def get(self, records):
+                deadline_in_effect = deadlines.current()
+
+                return deadline_in_effect and deadline_in_effect.remaining()
+
+            def put(self, records):
+                raise deadlines.DeadlineExceeded(partial={'records': records})
+
+        server = sidecar.SidecarServer(self.socket_path, 2)
+        server.consistent_sdb = Actions()
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            client = sidecar.SidecarClient(self.socket_path)
+
+            self.assertEqual(client.call('get', {}), None)
+
+            with deadlines.deadline(10):
+                remaining = client.call('get', {})
+            self.assertTrue(0 < remaining <= 10)
+
+            try:
+                client.call('put', {'domain': {}})
+            except deadlines.DeadlineExceeded as error:
+                self.assertEqual(error.partial, {'records': {'domain': {}}})
+            else:
+                self.fail('DeadlineExceeded not raised')
+
+            client.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_09_disconnect_mid_frame(self):
+        left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            left.sendall(sidecar.frame_header.pack(10) + 'abc')
+            left.close()
+
+            # The handler closes quietly, it doesn't raise to the server
+            sidecar.SidecarRequestHandler(right, None, None)
+        finally:
+            right.close()
+
+if __name__ == '__main__':
+    unittest.main()